@@ -2,14 +2,29 @@ from loguru import logger
 from argparse import ArgumentParser
 import os
 import os.path as osp
+import shutil
+import sys
+import time
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from traceback import format_exc
 
 from open3d.cpu.pybind.visualization import VisualizerWithEditing
 
-from extract_bag import BagExtractor
-from merge_pointcloud import SimpleMerge, SimpleMergeWithoutOdometer
+from extract_bag import BagExtractor, ODOMETRY_FORMATS
+from utils.pcd_utils import PCD_ENCODINGS
+from merge_pointcloud import SimpleMerge, SimpleMergeWithoutOdometer, StreamMerge, MERGE_MODES
+from merge_pipeline import MergePipeline
+from utils.metrics import Metrics
+from utils.manifest import Manifest
+from utils.pose_utils import load_extrinsics
+from utils.cloud_writer import CLOUD_FORMATS
 import open3d as o3d
 
+# 性能统计文件，与merged.pcd放在同一目录
+METRICS_FILENAME = 'bag2pcd_metrics.json'
+
 def generate_res_dir_from_bag_filepath(bag_filepath: str):
     '''
     根据bag_filepath生成结果文件目录，并返回
@@ -30,11 +45,55 @@ def generate_res_dir_from_bag_filepath(bag_filepath: str):
     return bag_filepath, res_dir
 
 
-def extract_single_bag(bag_filepath_and_res_dir: tuple):
+def topic_options(lidar_topics: list = None, odometry_topic: str = None, extrinsics: str = None):
+    '''
+    :param lidar_topics: 雷达topic列表，为None时自动选择
+    :param odometry_topic: 里程计topic，为None时自动选择
+    :param extrinsics: 外参配置文件路径，格式见utils.pose_utils.load_extrinsics
+    :return: 传给BagExtractor的 pcd_topics, odometry_topic, extrinsics
+    '''
+    return {'pcd_topics': lidar_topics, 'odometry_topic': odometry_topic,
+            'extrinsics': load_extrinsics(extrinsics) if extrinsics else None}
+
+
+def extract_params(encoding: str = 'binary', odometry_format: str = 'npy', topics: dict = None):
+    '''
+    :param topics: topic_options()的结果
+    :return: 记录在manifest中的解析参数
+    '''
+    params = {'encoding': encoding, 'odometry_format': odometry_format}
+    if topics:
+        extrinsics = topics['extrinsics'] or {}
+        params.update(pcd_topics=topics['pcd_topics'], odometry_topic=topics['odometry_topic'],
+                      extrinsics={topic: extrinsic.tolist() for topic, extrinsic in extrinsics.items()})
+    return params
+
+
+def clear_extract_dir(bag2pcd_dir: str):
+    '''
+    从头解析前清空tmp目录，避免上次解析留下的帧、里程计（如换了topic、odometry_format或bag已改变）混入本次合并
+    :param bag2pcd_dir:
+    :return:
+    '''
+    if os.listdir(bag2pcd_dir):
+        logger.info(f'清空 {bag2pcd_dir} 中上次解析的结果')
+        shutil.rmtree(bag2pcd_dir)
+        os.mkdir(bag2pcd_dir)
+
+
+def extract_single_bag(bag_filepath_and_res_dir: tuple, encoding: str = 'binary', odometry_format: str = 'npy',
+                       metrics: Metrics = None, manifest: Manifest = None, topics: dict = None,
+                       extract_workers: int = 1):
     '''
     处理单个bag包，并把结果放在bag_dir/tmp中
     :param bag_filepath:
     :param bag_dir:
+    :param encoding: tmp中pcd文件的编码
+    :param odometry_format: tmp中里程计的保存格式
+    :param metrics: 记录解析各步骤的统计
+    :param manifest: 不为None时，已解析完成则跳过，解析到一半则从中断处继续；从头解析时先清空tmp目录
+    :param topics: topic_options()的结果，为None时自动选择topic
+    :param extract_workers: >1时把bag按时间窗口分给多个进程并行解析；从中断处继续解析时仍为单进程
     :return:
     '''
     bag_filepath = bag_filepath_and_res_dir[0]
@@ -42,27 +101,259 @@ def extract_single_bag(bag_filepath_and_res_dir: tuple):
     bag2pcd_dir = osp.join(res_dir, 'tmp') # 解析bag出的txt+pcd放在bag2pcd_dir中
     if not osp.exists(bag2pcd_dir):
         os.mkdir(bag2pcd_dir)
-    BagExtractor(bag_filepath, bag2pcd_dir).run()
+    metrics = metrics or Metrics()
+    topics = topics or {}
+    params = extract_params(encoding, odometry_format, topics)
+    extractor = BagExtractor(bag_filepath, bag2pcd_dir, encoding, odometry_format, metrics, **topics)
+    if manifest is None:
+        clear_extract_dir(bag2pcd_dir)
+        with metrics.measure('extract'):
+            if extract_workers > 1:
+                extractor.run_parallel(extract_workers)
+            else:
+                extractor.run()
+        return bag2pcd_dir, res_dir
+    if manifest.extract_done(params):
+        logger.info(f'{bag_filepath} 已解析完成，跳过解析')
+        return bag2pcd_dir, res_dir
+    skip = manifest.resume_extract(params)
+    if skip:
+        logger.info(f'{bag_filepath} 从第{skip + 1}条消息继续解析')
+    else:
+        clear_extract_dir(bag2pcd_dir)
+    with metrics.measure('extract'):
+        if extract_workers > 1 and not skip:
+            total = extractor.run_parallel(extract_workers)
+        else:
+            total = extractor.run(skip, manifest.update_extract_progress)
+    manifest.finish_extract(total)
     return bag2pcd_dir, res_dir
 
 
-def process_bag_dir(bag2pcd_dir_and_res_dir_list: tuple):
+def load_pipeline(profile: str = None):
+    '''
+    :param profile: 合并流程配置文件（yaml或toml），为None时使用conf/pc_conf.py中的默认流程
+    :return: MergePipeline
+    '''
+    return MergePipeline.from_profile(profile) if profile else MergePipeline.default()
+
+
+def merge_params(merge_mode: str = 'posed', profile: str = None):
+    '''
+    :return: 记录在manifest中的合并参数，变化时需要重新合并
+    '''
+    if merge_mode == 'raw':
+        return {'merge_mode': merge_mode}
+    return {'merge_mode': merge_mode, 'pipeline': load_pipeline(profile).to_dict()}
+
+
+def merge_outputs(res_dir: str, merge_mode: str = 'posed', output_format: str = 'pcd'):
+    '''
+    :param output_format: 合并结果的格式，见utils.cloud_writer.CLOUD_FORMATS
+    :return: 合并结果路径列表，第一个为返回给调用方的路径
+    '''
+    merged_pcd_filepath = osp.join(res_dir, f'merged.{output_format}')
+    raw_pcd_filepath = osp.join(res_dir, f'merged_raw.{output_format}') # 未经变换、滤波的直接拼接结果
+    return {'posed': [merged_pcd_filepath], 'raw': [raw_pcd_filepath],
+            'both': [merged_pcd_filepath, raw_pcd_filepath]}[merge_mode]
+
+
+def process_bag_dir(bag2pcd_dir_and_res_dir_list: tuple, merge_workers: int = 1, profile: str = None,
+                    metrics: Metrics = None, merge_mode: str = 'posed', manifest: Manifest = None,
+                    output_format: str = 'pcd'):
     '''
     merge point cloud
     :param bag_dir:
-    :return:
+    :param merge_workers: 合并时单帧处理的进程数
+    :param profile: 合并流程配置文件
+    :param metrics: 记录合并各步骤的统计
+    :param merge_mode: posed - 按位姿合并到merged.pcd；raw - 不做处理直接拼接到merged_raw.pcd；
+                       both - 一次读取同时生成两者
+    :param manifest: 不为None时，合并参数与上次相同且结果存在则跳过合并
+    :param output_format: 合并结果的格式：pcd、ply、las或laz
+    :return: 合并后的点云路径，raw时为merged_raw.<output_format>
     '''
+    if merge_mode not in MERGE_MODES:
+        raise ValueError(f'不支持的合并方式：{merge_mode}，可选：{MERGE_MODES}')
     bag2pcd_dir = bag2pcd_dir_and_res_dir_list[0]
     res_dir = bag2pcd_dir_and_res_dir_list[1] # 存放合并后的pcd的目录
 
-    merged_pcd_filepath = osp.join(res_dir, 'merged.pcd')
+    outputs = merge_outputs(res_dir, merge_mode, output_format)
+    if manifest is not None:
+        params = merge_params(merge_mode, profile)
+        if manifest.merge_done(params, outputs):
+            logger.info(f'合并参数未变，跳过合并：{outputs}')
+            return outputs[0]
+        manifest.start_merge(params)
     # 简单拼接
     # SimpleMerge(bag2pcd_dir, merged_pcd_filepath).merge()
 
-    SimpleMerge(bag2pcd_dir, merged_pcd_filepath).merge()
-    SimpleMergeWithoutOdometer(bag2pcd_dir, merged_pcd_filepath).merge()
+    metrics = metrics or Metrics()
+    with metrics.measure('merge'):
+        if merge_mode == 'raw':
+            SimpleMergeWithoutOdometer(bag2pcd_dir, outputs[0], metrics).merge()
+        else:
+            SimpleMerge(bag2pcd_dir, outputs[0], merge_workers, load_pipeline(profile), metrics,
+                        outputs[1] if merge_mode == 'both' else None).merge()
+    if manifest is not None:
+        manifest.finish_merge(outputs)
+    return outputs[0]
+
+
+def stream_single_bag(bag_filepath_and_res_dir: tuple, encoding: str = 'binary', keep_tmp: bool = False,
+                      odometry_format: str = 'npy', profile: str = None, metrics: Metrics = None,
+                      topics: dict = None, output_format: str = 'pcd'):
+    '''
+    流式处理单个bag：解析出的帧直接送入合并，默认不生成tmp目录
+    :param bag_filepath_and_res_dir:
+    :param encoding: tmp中pcd文件的编码，仅keep_tmp时有效
+    :param keep_tmp: 是否同时生成tmp目录
+    :param odometry_format: tmp中里程计的保存格式，仅keep_tmp时有效
+    :param profile: 合并流程配置文件
+    :param metrics: 记录解析和合并各步骤的统计
+    :param topics: topic_options()的结果，为None时自动选择topic
+    :param output_format: 合并结果的格式：pcd、ply、las或laz
+    :return: 合并后的点云路径
+    '''
+    bag_filepath = bag_filepath_and_res_dir[0]
+    res_dir = bag_filepath_and_res_dir[1]
+    bag2pcd_dir = None
+    if keep_tmp:
+        bag2pcd_dir = osp.join(res_dir, 'tmp')
+        if not osp.exists(bag2pcd_dir):
+            os.mkdir(bag2pcd_dir)
+    merged_pcd_filepath = merge_outputs(res_dir, 'posed', output_format)[0]
+    metrics = metrics or Metrics()
+    with metrics.measure('stream_merge'):
+        StreamMerge(bag_filepath, merged_pcd_filepath, bag2pcd_dir, encoding, odometry_format,
+                    load_pipeline(profile), metrics, **(topics or {})).merge()
     return merged_pcd_filepath
-    pass
+
+
+def process_single_bag(bag_filepath: str, encoding: str = 'binary', stream: bool = False, keep_tmp: bool = False,
+                       odometry_format: str = 'npy', merge_workers: int = 1, profile: str = None,
+                       merge_mode: str = 'posed', resume: bool = True, lidar_topics: list = None,
+                       odometry_topic: str = None, extrinsics: str = None, extract_workers: int = 1,
+                       output_format: str = 'pcd'):
+    '''
+    处理单个bag：解析 -> 合并
+    该bag的日志额外写入结果目录下的bag2pcd.log，各步骤的耗时、点数和内存写入结果目录下的bag2pcd_metrics.json
+    任何异常都在这里捕获，不影响其他bag
+    :param bag_filepath:
+    :param encoding: tmp中pcd文件的编码
+    :param odometry_format: tmp中里程计的保存格式
+    :param merge_workers: 合并时单帧处理的进程数（流式处理时不生效）
+    :param stream: 是否流式处理（不经过tmp目录）
+    :param keep_tmp: 流式处理时是否仍然生成tmp目录
+    :param profile: 合并流程配置文件（yaml或toml），为None时使用默认流程
+    :param merge_mode: 合并方式，见process_bag_dir（流式处理时只支持posed）
+    :param resume: 非流式处理时，根据结果目录中的manifest.json跳过已完成的步骤、从中断处继续解析；
+                   为False时全部重新处理
+    :param lidar_topics: 雷达topic列表，为None时自动选择；多个时按extrinsics中的外参合并
+    :param odometry_topic: 里程计topic，为None时自动选择
+    :param extrinsics: 雷达外参配置文件（yaml），格式见utils.pose_utils.load_extrinsics
+    :param extract_workers: 按时间窗口并行解析单个bag的进程数（流式处理时不生效）
+    :param output_format: 合并结果的格式：pcd、ply、las或laz
+    :return: 结果字典 {bag, status, seconds, merged, error}，status为ok、skipped（已处理完成）或failed
+    '''
+    bag_name = osp.basename(bag_filepath)
+    result = {'bag': bag_name, 'status': 'failed', 'seconds': 0., 'merged': '', 'error': ''}
+    start = time.time()
+    handler_id = None
+    bag_filepath_and_res_dir = None
+    metrics = Metrics()
+    with logger.contextualize(bag=bag_name):
+        try:
+            bag_filepath_and_res_dir = generate_res_dir_from_bag_filepath(bag_filepath)
+            if bag_filepath_and_res_dir is None:
+                raise FileNotFoundError(bag_filepath)
+            handler_id = logger.add(osp.join(bag_filepath_and_res_dir[1], 'bag2pcd.log'),
+                                    filter=lambda record: record['extra'].get('bag') == bag_name)
+            logger.info(f'开始处理 {bag_filepath}')
+            topics = topic_options(lidar_topics, odometry_topic, extrinsics)
+            if stream and merge_mode != 'posed':
+                raise ValueError(f'流式处理只支持posed合并方式，当前：{merge_mode}')
+            if stream:
+                result['merged'] = stream_single_bag(bag_filepath_and_res_dir, encoding, keep_tmp, odometry_format,
+                                                     profile, metrics, topics, output_format)
+                result['status'] = 'ok'
+            else:
+                res_dir = bag_filepath_and_res_dir[1]
+                manifest = Manifest.load(res_dir, bag_filepath, fresh=not resume)
+                if manifest.extract_done(extract_params(encoding, odometry_format, topics)) and \
+                        manifest.merge_done(merge_params(merge_mode, profile),
+                                            merge_outputs(res_dir, merge_mode, output_format)):
+                    logger.info(f'{bag_filepath} 已处理完成，参数未变，跳过')
+                    result['merged'] = merge_outputs(res_dir, merge_mode, output_format)[0]
+                    result['status'] = 'skipped'
+                else:
+                    bag2pcd_dir_and_res_dir = extract_single_bag(bag_filepath_and_res_dir, encoding, odometry_format,
+                                                                 metrics, manifest, topics, extract_workers)
+                    result['merged'] = process_bag_dir(bag2pcd_dir_and_res_dir, merge_workers, profile, metrics,
+                                                       merge_mode, manifest, output_format)
+                    result['status'] = 'ok'
+        except Exception as e:
+            logger.error(f'{bag_filepath} 处理失败：\n{format_exc()}')
+            result['error'] = f'{type(e).__name__}: {e}'
+        finally:
+            result['seconds'] = time.time() - start
+            logger.info(f'{bag_name} 处理结束，状态：{result["status"]}，耗时：{result["seconds"]:.1f}s')
+            if bag_filepath_and_res_dir is not None and result['status'] != 'skipped':
+                try:
+                    metrics.dump(osp.join(bag_filepath_and_res_dir[1], METRICS_FILENAME),
+                                 bag=bag_filepath, status=result['status'], stream=stream, encoding=encoding,
+                                 merge_workers=merge_workers, extract_workers=extract_workers, profile=profile,
+                                 merge_mode=merge_mode, lidar_topics=lidar_topics, odometry_topic=odometry_topic,
+                                 extrinsics=extrinsics, output_format=output_format)
+                except OSError as e:
+                    logger.warning(f'性能统计写入失败：{e}')
+            if handler_id is not None:
+                logger.remove(handler_id)
+    return result
+
+
+def process_bags(bag_filepath_list: list, workers: int = 1, **options):
+    '''
+    处理多个bag，workers > 1时每个bag的 解析 -> 合并 在独立进程中进行
+    :param bag_filepath_list:
+    :param workers: 进程数
+    :param options: 传给process_single_bag的参数
+    :return: 结果字典列表，顺序与bag_filepath_list一致
+    '''
+    if workers <= 1:
+        return [process_single_bag(bag_filepath, **options) for bag_filepath in bag_filepath_list]
+
+    results = {}
+    # spawn避免fork继承open3d的线程状态
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as executor:
+        futures = {executor.submit(process_single_bag, bag_filepath, **options): bag_filepath
+                   for bag_filepath in bag_filepath_list}
+        for future in as_completed(futures):
+            bag_filepath = futures[future]
+            try:
+                results[bag_filepath] = future.result()
+            except Exception as e:
+                # 子进程异常退出（例如被系统kill）
+                logger.error(f'{bag_filepath} 处理进程异常退出：{e}')
+                results[bag_filepath] = {'bag': osp.basename(bag_filepath), 'status': 'failed', 'seconds': 0.,
+                                         'merged': '', 'error': f'{type(e).__name__}: {e}'}
+            logger.info(f'已完成 {len(results)}/{len(bag_filepath_list)} 个bag')
+    return [results[bag_filepath] for bag_filepath in bag_filepath_list]
+
+
+def format_summary(results: list):
+    '''
+    生成处理结果汇总表
+    :param results: process_single_bag的结果列表
+    :return: str
+    '''
+    rows = [('bag', 'status', 'seconds', 'merged / error')]
+    rows += [(r['bag'], r['status'], f'{r["seconds"]:.1f}', r['merged'] if r['status'] != 'failed' else r['error'])
+             for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    lines = [' | '.join([row[i].ljust(widths[i]) for i in range(3)] + [row[3]]) for row in rows]
+    lines.insert(1, '-+-'.join(['-' * width for width in widths] + ['-' * 14]))
+    return '\n'.join(lines)
 
 #
 # def show_pcd_with_editing(merged_pcd_filepath: str):
@@ -89,17 +380,88 @@ def main():
     parser.add_argument('bag_dir',
                         default='C:\\Users\\Administrator\\Desktop\\bag_test',
                         help='存放bag文件的文件夹')
+    parser.add_argument('--encoding',
+                        default='binary',
+                        choices=PCD_ENCODINGS,
+                        help='tmp目录中pcd文件的编码，默认binary')
+    parser.add_argument('--odometry-format',
+                        default='npy',
+                        choices=ODOMETRY_FORMATS,
+                        help='tmp目录中里程计的保存格式：npy - 每个bag一个轨迹文件；txt - 每条里程计一个txt文件，默认npy')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='并行处理bag的进程数，默认1（串行）')
+    parser.add_argument('--merge-workers',
+                        type=int,
+                        default=1,
+                        help='合并时并行处理各帧的进程数，默认1（串行）')
+    parser.add_argument('--extract-workers',
+                        type=int,
+                        default=1,
+                        help='把单个bag按时间窗口分给多个进程并行解析，默认1（串行）；总进程数约为workers * extract-workers')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='流式处理：解析出的帧直接合并，不生成tmp目录')
+    parser.add_argument('--keep-tmp',
+                        action='store_true',
+                        help='流式处理时仍然生成tmp目录')
+    parser.add_argument('--merge-mode',
+                        default='posed',
+                        choices=MERGE_MODES,
+                        help='合并方式：posed - 按位姿变换、滤波后合并为merged.pcd；raw - 不做处理直接拼接为merged_raw.pcd；'
+                             'both - 一次读取同时生成两者，默认posed')
+    parser.add_argument('--output-format',
+                        default='pcd',
+                        choices=CLOUD_FORMATS,
+                        help='合并结果的格式：pcd（binary）、ply（binary_little_endian）、las、laz（需要laspy[lazrs]），'
+                             'raw结果逐帧写出、内存中只保留一帧，posed结果在体素累加完成后分块写出；'
+                             'las、laz不写入坐标为NaN的点，默认pcd')
+    parser.add_argument('--profile',
+                        default=None,
+                        help='合并流程配置文件（yaml或toml），例如conf/merge_profile.yaml，默认使用conf/pc_conf.py中的参数')
+    parser.add_argument('--no-resume',
+                        action='store_true',
+                        help='忽略结果目录中的manifest.json，全部重新处理；默认跳过已完成的bag、从中断处继续解析、'
+                             '合并参数变化时只重新合并')
+    parser.add_argument('--lidar-topics',
+                        nargs='+',
+                        default=None,
+                        help='雷达topic（sensor_msgs/PointCloud2），可指定多个；默认自动选择，bag中有多个时选最后一个并给出警告')
+    parser.add_argument('--odometry-topic',
+                        default=None,
+                        help='里程计topic（nav_msgs/Odometry），默认自动选择')
+    parser.add_argument('--extrinsics',
+                        default=None,
+                        help='雷达外参配置文件（yaml），例如conf/extrinsics.yaml，多个雷达时用于统一到里程计坐标系')
     args = parser.parse_args()
+    if args.stream and args.merge_mode != 'posed':
+        parser.error('--stream只支持--merge-mode posed')
+    if args.profile:
+        # 提前加载一次，配置有误时在处理bag之前报错
+        logger.info(f'合并流程：{load_pipeline(args.profile)}')
+    if args.extrinsics:
+        logger.info(f'雷达外参：{list(load_extrinsics(args.extrinsics))}')
     # 获得bag_dir下的所有bag文件
     bag_filepath_list = glob(osp.join(args.bag_dir, '*.bag'))
     if len(bag_filepath_list) == 0:
         logger.error(f'{args.bag_dir}文件夹下没有bag文件')
         return
-    bag_filepath_and_res_dir_list = list(map(generate_res_dir_from_bag_filepath, bag_filepath_list))
-    bag2pcd_dir_and_res_dir_list = list(map(extract_single_bag, bag_filepath_and_res_dir_list))
-    merged_pcd_filepath_list = list(map(process_bag_dir, bag2pcd_dir_and_res_dir_list))
+    workers = max(1, min(args.workers, len(bag_filepath_list)))
+    logger.info(f'bag数量：{len(bag_filepath_list)}，进程数：{workers}')
+    results = process_bags(bag_filepath_list, workers,
+                           encoding=args.encoding, stream=args.stream, keep_tmp=args.keep_tmp,
+                           odometry_format=args.odometry_format, merge_workers=args.merge_workers,
+                           extract_workers=args.extract_workers, output_format=args.output_format,
+                           profile=args.profile, merge_mode=args.merge_mode, resume=not args.no_resume,
+                           lidar_topics=args.lidar_topics, odometry_topic=args.odometry_topic,
+                           extrinsics=args.extrinsics)
+    merged_pcd_filepath_list = [r['merged'] for r in results if r['status'] != 'failed']
     logger.info(f'生成的pcd文件列表：{merged_pcd_filepath_list}')
+    logger.info(f'处理结果汇总：\n{format_summary(results)}')
     logger.info('处理完成')
+    if len(merged_pcd_filepath_list) < len(results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+'''
+对比PointCloud2的两种解析方式：
+1. 原先的 np.array(list(pc2.read_points(msg)))[:, :3]
+2. utils.pc2_utils.pointcloud2_to_xyz（np.frombuffer + 结构化dtype）
+
+运行：python -m benchmark.bench_pc2_decode --points 131072 --repeat 10
+'''
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+from loguru import logger
+
+from benchmark.synthetic import make_pointcloud2
+from utils.pc2_utils import pointcloud2_to_xyz
+
+
+def read_points_legacy(msg):
+    '''
+    原先BagExtractor.to_pcd_ascii中的解析方式
+    '''
+    import sensor_msgs.point_cloud2 as pc2
+    return np.array(list(pc2.read_points(msg)))[:, :3]
+
+
+def timeit(func, msg, repeat):
+    '''
+    返回最好的一次耗时（秒）和结果
+    '''
+    best = float('inf')
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func(msg)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def main():
+    parser = ArgumentParser(description='PointCloud2解析benchmark')
+    parser.add_argument('--points', type=int, default=131072, help='每帧点数')
+    parser.add_argument('--repeat', type=int, default=10, help='重复次数')
+    args = parser.parse_args()
+
+    msg = make_pointcloud2(args.points)
+    logger.info(f'合成PointCloud2：{msg.width * msg.height}个点，point_step={msg.point_step}')
+
+    t_new, xyz_new = timeit(pointcloud2_to_xyz, msg, args.repeat)
+    logger.info(f'pointcloud2_to_xyz: {t_new * 1000:.2f} ms')
+
+    try:
+        t_old, xyz_old = timeit(read_points_legacy, msg, max(1, args.repeat // 5))
+    except ImportError:
+        logger.warning('未安装sensor_msgs，跳过pc2.read_points对比')
+        return
+    logger.info(f'pc2.read_points: {t_old * 1000:.2f} ms')
+    assert np.allclose(xyz_old, xyz_new), '两种解析方式结果不一致'
+    logger.info(f'加速比：{t_old / t_new:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
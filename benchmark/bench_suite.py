@@ -0,0 +1,263 @@
+'''
+bag2pcd全流程benchmark：用合成的bag和pcd目录测试各环节，不依赖ROS和雷达
+1. decode：BagExtractor解析PointCloud2
+2. pcd_write_*：各编码写pcd
+3. extract：BagExtractor.run()/run_parallel()（合成bag -> tmp目录，rosbag由benchmark.fake_rosbag替代），
+   --extract-workers > 1时检查并行解析与顺序解析的结果相同
+4. merge：SimpleMerge.merge()
+5. convex_hull：compute_convex_hull_volume.compute_convex_hull（compute_convex_hull_and_its_volume去掉窗口的部分）
+6. downsample：对整个点云按myApp降采样滑动条的各档分别降采样（PointCloud.voxel_down_sample）；
+   downsample_lod：myApp中构建LOD金字塔（utils.lod.LodPyramid，各层由上一层降采样）
+
+运行并与基线比较：python -m benchmark.bench_suite，默认与benchmark/baseline.json比较，有退化时退出码为1；
+    --no-baseline只运行不比较
+保存基线：python -m benchmark.bench_suite --save-baseline benchmark/baseline.json
+仓库中的baseline.json由默认参数生成，基线与机器相关，换机器后应先重新生成
+'''
+from argparse import ArgumentParser
+import filecmp
+import json
+import os
+import os.path as osp
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark import fake_rosbag
+
+# 必须在导入extract_bag之前替换rosbag；多进程合并时spawn的子进程也会先执行这里
+fake_rosbag.install()
+
+import numpy as np
+import open3d as o3d
+from loguru import logger
+
+from benchmark.synthetic import make_pointcloud2, write_synthetic_bag, write_pcd_dir
+from compute_convex_hull_volume import compute_convex_hull
+from extract_bag import BagExtractor
+from merge_pointcloud import SimpleMerge
+from utils.cloud_utils import split_cloud
+from utils.lod import LodPyramid, LOD_VOXEL_SIZES
+from utils.pc2_utils import pointcloud2_to_array, to_frame_array
+from utils.pcd_utils import PCD_ENCODINGS, write_pcd
+
+# 与基线相比耗时超过 (1 + tolerance) 倍时视为退化
+DEFAULT_TOLERANCE = .2
+
+# 默认的基线文件
+DEFAULT_BASELINE = osp.join(osp.dirname(osp.abspath(__file__)), 'baseline.json')
+
+
+def best_of(repeat: int, func, *args, setup=None):
+    '''
+    :param repeat: 重复次数
+    :param func:
+    :param args:
+    :param setup: 每次运行前调用，不计时
+    :return: 最短耗时(s), 最后一次的返回值
+    '''
+    best, res = float('inf'), None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        res = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def bench_decode(args, work_dir):
+    msgs = [make_pointcloud2(args.points, i / 10., args.seed + i) for i in range(min(args.frames, 10))]
+    extractor = BagExtractor(osp.join(work_dir, 'decode.bag'), work_dir)
+    seconds, _ = best_of(args.repeat, lambda: [extractor.decode(msg) for msg in msgs])
+    return {'decode': (seconds, sum(msg.width * msg.height for msg in msgs))}
+
+
+def bench_pcd_write(args, work_dir):
+    frame = to_frame_array(pointcloud2_to_array(make_pointcloud2(args.points, seed=args.seed)))
+    pcd_path = osp.join(work_dir, 'write.pcd')
+    res = {}
+    for encoding in PCD_ENCODINGS:
+        seconds, _ = best_of(args.repeat, write_pcd, pcd_path, frame, encoding)
+        res[f'pcd_write_{encoding}'] = (seconds, len(frame))
+    return res
+
+
+def check_extract_outputs(serial_dir, parallel_dir):
+    '''
+    按时间窗口并行解析的结果必须与顺序解析完全相同（文件列表、pcd和轨迹的内容），不同时抛出异常
+    '''
+    serial_files, parallel_files = sorted(os.listdir(serial_dir)), sorted(os.listdir(parallel_dir))
+    if serial_files != parallel_files:
+        missing = sorted(set(serial_files) - set(parallel_files))
+        extra = sorted(set(parallel_files) - set(serial_files))
+        raise RuntimeError(f'并行解析的文件与顺序解析不同：缺少{missing}，多出{extra}')
+    _, mismatch, errors = filecmp.cmpfiles(serial_dir, parallel_dir, serial_files, shallow=False)
+    if mismatch or errors:
+        raise RuntimeError(f'并行解析的文件内容与顺序解析不同：{mismatch + errors}')
+
+
+def bench_extract(args, work_dir):
+    bag_filepath = write_synthetic_bag(osp.join(work_dir, 'synthetic.bag'), args.frames, args.points,
+                                       seed=args.seed)
+    res = {}
+    dst_dirs = {}
+    for workers in sorted({1, args.extract_workers}):
+        dst_dir = dst_dirs[workers] = osp.join(work_dir, f'extract_{workers}')
+
+        def setup():
+            shutil.rmtree(dst_dir, ignore_errors=True)
+            os.makedirs(dst_dir)
+
+        extractor = BagExtractor(bag_filepath, dst_dir)
+        run = extractor.run if workers == 1 else lambda: extractor.run_parallel(workers)
+        seconds, _ = best_of(args.repeat, run, setup=setup)
+        res['extract' if workers == 1 else f'extract_workers_{workers}'] = (seconds, args.frames * args.points)
+    if args.extract_workers > 1:
+        check_extract_outputs(dst_dirs[1], dst_dirs[args.extract_workers])
+        logger.info(f'并行解析（{args.extract_workers}个窗口）与顺序解析的结果相同')
+    return res
+
+
+def bench_merge(args, work_dir):
+    pcd_dir = write_pcd_dir(osp.join(work_dir, 'merge_tmp'), args.frames, args.points, seed=args.seed)
+    merged_pcd_filepath = osp.join(work_dir, 'merged.pcd')
+    res = {}
+    for workers in sorted({1, args.merge_workers}):
+        seconds, _ = best_of(args.repeat, lambda: SimpleMerge(pcd_dir, merged_pcd_filepath, workers).merge())
+        res['merge' if workers == 1 else f'merge_workers_{workers}'] = (seconds, args.frames * args.points)
+    return res
+
+
+def _synthetic_point_cloud(args):
+    '''
+    所有帧的点拼在一起，近似合并后的点云
+    '''
+    points = [split_cloud(to_frame_array(pointcloud2_to_array(make_pointcloud2(args.points, seed=args.seed + i))))[0]
+              for i in range(min(args.frames, 10))]
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.concatenate(points)))
+
+
+def bench_convex_hull(args, work_dir):
+    pcd = _synthetic_point_cloud(args)
+    seconds, _ = best_of(args.repeat, compute_convex_hull, pcd)
+    return {'convex_hull': (seconds, len(pcd.points))}
+
+
+def bench_downsample(args, work_dir):
+    pcd = _synthetic_point_cloud(args)
+    seconds, _ = best_of(args.repeat, lambda: [pcd.voxel_down_sample(voxel) for voxel in LOD_VOXEL_SIZES])
+    lod_seconds, _ = best_of(args.repeat, lambda: LodPyramid(pcd).build())
+    return {'downsample': (seconds, len(pcd.points) * len(LOD_VOXEL_SIZES)),
+            'downsample_lod': (lod_seconds, len(pcd.points))}
+
+
+BENCHMARKS = {
+    'decode': bench_decode,
+    'pcd_write': bench_pcd_write,
+    'extract': bench_extract,
+    'merge': bench_merge,
+    'convex_hull': bench_convex_hull,
+    'downsample': bench_downsample,
+}
+
+
+def environment():
+    '''
+    运行环境，写入结果中便于比较不同机器的结果
+    '''
+    return {'python': sys.version.split()[0], 'numpy': np.__version__, 'open3d': o3d.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+
+def run(args):
+    '''
+    :return: {'params': ..., 'environment': ..., 'results': {名称: {seconds, points, points_per_second}}}
+    '''
+    params = {name: getattr(args, name)
+              for name in ('frames', 'points', 'repeat', 'seed', 'merge_workers', 'extract_workers')}
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='bag2pcd_bench_')
+    try:
+        for name in args.only or BENCHMARKS:
+            logger.info(f'运行 {name}')
+            for key, (seconds, points) in BENCHMARKS[name](args, work_dir).items():
+                results[key] = {'seconds': seconds, 'points': points, 'points_per_second': points / seconds}
+                logger.info(f'{key}: {seconds * 1000:.1f} ms, {points / seconds / 1e6:.2f} Mpts/s')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'params': params, 'environment': environment(), 'results': results}
+
+
+def compare(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE):
+    '''
+    与基线比较
+    :return: 退化的项目列表
+    '''
+    if report['params'] != baseline['params']:
+        logger.warning(f'参数与基线不同，结果不可直接比较：{report["params"]} vs {baseline["params"]}')
+    if report['environment'] != baseline.get('environment'):
+        logger.warning(f'基线在不同的环境中生成，结果仅供参考，应在本机用--save-baseline重新生成：'
+                       f'{report["environment"]} vs {baseline.get("environment")}')
+    regressions = []
+    for name, res in report['results'].items():
+        if name not in baseline['results']:
+            logger.info(f'{name}: 基线中没有该项')
+            continue
+        ratio = res['seconds'] / baseline['results'][name]['seconds']
+        status = 'ok'
+        if ratio > 1 + tolerance:
+            status = '退化'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            status = '提升'
+        logger.info(f'{name}: {res["seconds"] * 1000:.1f} ms, 基线 {baseline["results"][name]["seconds"] * 1000:.1f} ms, '
+                    f'{ratio:.2f}x, {status}')
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='bag2pcd benchmark（合成数据，不依赖ROS）')
+    parser.add_argument('--frames', type=int, default=20, help='帧数')
+    parser.add_argument('--points', type=int, default=65536, help='每帧点数')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数，取最短耗时')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--merge-workers', type=int, default=1, help='>1时额外测试多进程合并')
+    parser.add_argument('--extract-workers', type=int, default=1, help='>1时额外测试按时间窗口并行解析')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='只运行指定的项目')
+    parser.add_argument('--output', default=None, help='结果json路径')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基线json路径，与其比较，默认benchmark/baseline.json')
+    parser.add_argument('--no-baseline', action='store_true', help='不与基线比较')
+    parser.add_argument('--save-baseline', default=None, help='将本次结果保存为基线')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='允许的耗时增加比例')
+    args = parser.parse_args()
+
+    # 更新基线时不与自身比较
+    check_baseline = not args.no_baseline and not (
+            args.save_baseline and osp.abspath(args.save_baseline) == osp.abspath(args.baseline))
+    if check_baseline and not osp.exists(args.baseline):
+        logger.error(f'基线 {args.baseline} 不存在，无法检查性能退化：'
+                     f'先运行 python -m benchmark.bench_suite --save-baseline {args.baseline} 生成，'
+                     f'或用--no-baseline只运行不比较')
+        sys.exit(1)
+
+    report = run(args)
+    for json_filepath in (args.output, args.save_baseline):
+        if json_filepath:
+            with open(json_filepath, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            logger.info(f'结果已保存：{json_filepath}')
+    if not check_baseline:
+        logger.info('--no-baseline：未与基线比较' if args.no_baseline else f'已更新基线 {args.baseline}，本次不与其比较')
+        return
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        logger.error(f'性能退化：{regressions}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+对比位姿变换的几种方式：
+1. 原先SimpleMerge中的 pcd.rotate(R, center) + pcd.translate(t)
+2. utils.math_utils.apply_transform（一次4x4齐次变换）
+3. utils.math_utils.apply_transforms（多帧拼接后按帧号批量变换）
+
+运行：python -m benchmark.bench_transform --frames 20 --points 30000
+'''
+from argparse import ArgumentParser
+import time
+
+import numpy as np
+import open3d as o3d
+from loguru import logger
+from scipy.spatial.transform import Rotation as R
+
+from conf.pc_conf import ROTATE_CENTER
+from utils.math_utils import make_transform, make_transforms, apply_transform, apply_transforms
+
+
+def rotate_and_translate(frames, translations, rotations):
+    '''
+    原先的变换方式
+    '''
+    res = []
+    for points, translation_vector, rotation_matrix in zip(frames, translations, rotations):
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        pcd.rotate(rotation_matrix, center=ROTATE_CENTER)
+        pcd.translate(translation_vector)
+        res.append(np.asarray(pcd.points))
+    return res
+
+
+def single_transform(frames, translations, rotations):
+    '''
+    每帧一次齐次变换
+    '''
+    return [apply_transform(points, make_transform(translation_vector, rotation_matrix, ROTATE_CENTER))
+            for points, translation_vector, rotation_matrix in zip(frames, translations, rotations)]
+
+
+def main():
+    parser = ArgumentParser(description='位姿变换benchmark')
+    parser.add_argument('--frames', type=int, default=20, help='帧数')
+    parser.add_argument('--points', type=int, default=30000, help='每帧点数（降采样、滤波之后）')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    frames = [rng.uniform(-50, 50, size=(args.points, 3)) for _ in range(args.frames)]
+    translations = rng.uniform(-10, 10, size=(args.frames, 3))
+    rotations = R.random(args.frames, random_state=0).as_matrix()
+
+    def best_of(func, *func_args):
+        best, res = float('inf'), None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            res = func(*func_args)
+            best = min(best, time.perf_counter() - start)
+        return best, res
+
+    t_old, res_old = best_of(rotate_and_translate, frames, translations, rotations)
+    logger.info(f'rotate + translate: {t_old * 1000:.2f} ms')
+
+    t_new, res_new = best_of(single_transform, frames, translations, rotations)
+    logger.info(f'apply_transform: {t_new * 1000:.2f} ms, 加速比：{t_old / t_new:.1f}x')
+    assert all(np.allclose(a, b) for a, b in zip(res_old, res_new)), '变换结果不一致'
+
+    points = np.concatenate(frames)
+    frame_ids = np.repeat(np.arange(args.frames), args.points)
+    transforms = make_transforms(translations, rotations, ROTATE_CENTER)
+    t_batch, res_batch = best_of(apply_transforms, points, frame_ids, transforms)
+    logger.info(f'apply_transforms（批量）: {t_batch * 1000:.2f} ms, 加速比：{t_old / t_batch:.1f}x')
+    assert np.allclose(np.concatenate(res_old), res_batch), '批量变换结果不一致'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+rosbag的最小替代，用于在没有ROS环境的机器上运行benchmark
+只实现BagExtractor用到的接口：Bag(path, 'r')、get_type_and_topic_info()、read_messages()、
+get_start_time()、get_end_time()
+bag文件是synthetic.write_synthetic_bag写出的json描述，消息在读取时按固定随机种子生成
+'''
+import json
+import sys
+from types import SimpleNamespace
+
+from benchmark.synthetic import iter_synthetic_messages, synthetic_bag_topics
+
+
+def _to_nsec(t):
+    '''
+    :param t: genpy.Time或带secs、nsecs的对象（见extract_bag._to_time）
+    :return: 整数纳秒，与rosbag一样按整数比较
+    '''
+    if t is None:
+        return None
+    return t.secs * 10 ** 9 + t.nsecs
+
+
+class Bag:
+    def __init__(self, bag_file: str, mode: str = 'r'):
+        if mode != 'r':
+            raise ValueError('fake_rosbag只支持读取')
+        with open(bag_file, 'r', encoding='utf-8') as f:
+            self.spec = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_type_and_topic_info(self):
+        topics = {topic: SimpleNamespace(msg_type=msg_type, message_count=message_count, connections=1,
+                                         frequency=frequency)
+                  for topic, msg_type, message_count, frequency in synthetic_bag_topics(self.spec)}
+        return SimpleNamespace(topics=topics, msg_types={})
+
+    def get_start_time(self):
+        return self.spec['start']
+
+    def get_end_time(self):
+        return self.spec['start'] + self.spec['frames'] / self.spec['rate']
+
+    def read_messages(self, topics=None, start_time=None, end_time=None):
+        '''
+        :param topics: topic或topic列表，为None时返回全部
+        :param start_time: 起始时间（带secs、nsecs的对象），含
+        :param end_time: 结束时间，含
+        :return: 生成器，(topic, msg, t)
+        '''
+        if isinstance(topics, str):
+            topics = [topics]
+        start_time, end_time = _to_nsec(start_time), _to_nsec(end_time)
+        for topic, msg in iter_synthetic_messages(self.spec):
+            stamp = _to_nsec(msg.header.stamp)
+            if topics is not None and topic not in topics:
+                continue
+            if start_time is not None and stamp < start_time:
+                continue
+            if end_time is not None and stamp > end_time:
+                continue
+            yield topic, msg, msg.header.stamp
+
+
+def install():
+    '''
+    用本模块替代rosbag，需在导入extract_bag之前调用；已导入时同时替换extract_bag.rosbag
+    '''
+    module = sys.modules[__name__]
+    sys.modules['rosbag'] = module
+    if 'extract_bag' in sys.modules:
+        sys.modules['extract_bag'].rosbag = module
@@ -0,0 +1,201 @@
+import json
+import os
+import os.path as osp
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.pc2_utils import pointcloud2_to_array, to_frame_array
+from utils.pcd_utils import write_pcd
+from utils.pose_utils import TRAJECTORY_FILENAME, save_trajectory
+
+
+# ouster驱动输出的PointCloud2点格式（point_step=48）
+# (name, offset, datatype, count)，datatype同sensor_msgs/PointField
+OUSTER_FIELDS = [
+    ('x', 0, 7, 1),
+    ('y', 4, 7, 1),
+    ('z', 8, 7, 1),
+    ('intensity', 16, 7, 1),
+    ('t', 20, 6, 1),
+    ('reflectivity', 24, 4, 1),
+    ('ring', 26, 4, 1),
+    ('ambient', 28, 4, 1),
+    ('range', 32, 6, 1),
+]
+OUSTER_POINT_STEP = 48
+
+
+def make_header(stamp: float, frame_id: str = 'os_sensor'):
+    '''
+    构造与std_msgs/Header字段一致的对象
+    :param stamp: 秒
+    :param frame_id:
+    :return:
+    '''
+    secs = int(stamp)
+    nsecs = int(round((stamp - secs) * 1e9))
+    ros_stamp = SimpleNamespace(secs=secs, nsecs=nsecs, to_sec=lambda: secs + nsecs * 1e-9)
+    return SimpleNamespace(stamp=ros_stamp, frame_id=frame_id, seq=0)
+
+
+def make_pointcloud2(num_points: int = 131072, stamp: float = 0., seed: int = 0, width: int = 1024):
+    '''
+    构造一个合成的PointCloud2消息（字段与sensor_msgs/PointCloud2一致，不依赖ROS）
+    :param num_points: 点数，默认为128线ouster一帧的点数
+    :param stamp: 时间戳
+    :param seed: 随机种子
+    :param width: 每行点数
+    :return:
+    '''
+    rng = np.random.default_rng(seed)
+    fields = [SimpleNamespace(name=name, offset=offset, datatype=datatype, count=count)
+              for name, offset, datatype, count in OUSTER_FIELDS]
+    dtype = np.dtype({
+        'names': [f[0] for f in OUSTER_FIELDS],
+        'formats': ['<f4', '<f4', '<f4', '<f4', '<u4', '<u2', '<u2', '<u2', '<u4'],
+        'offsets': [f[1] for f in OUSTER_FIELDS],
+        'itemsize': OUSTER_POINT_STEP,
+    })
+    height = max(1, num_points // width)
+    num_points = width * height
+    cloud = np.zeros(num_points, dtype=dtype)
+    # 在球壳内随机撒点
+    directions = rng.normal(size=(num_points, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    ranges = rng.uniform(0.5, 80., size=num_points)
+    xyz = directions * ranges[:, None]
+    cloud['x'], cloud['y'], cloud['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    cloud['intensity'] = rng.uniform(0, 1000, size=num_points)
+    cloud['t'] = np.tile(np.linspace(0, 1e8, width, dtype=np.uint32), height)
+    cloud['ring'] = np.repeat(np.arange(height, dtype=np.uint16), width)
+    cloud['range'] = (ranges * 1000).astype(np.uint32)
+    return SimpleNamespace(
+        header=make_header(stamp),
+        height=height,
+        width=width,
+        fields=fields,
+        is_bigendian=False,
+        point_step=OUSTER_POINT_STEP,
+        row_step=OUSTER_POINT_STEP * width,
+        data=cloud.tobytes(),
+        is_dense=True,
+    )
+
+
+def make_odometry(stamp: float, translation_vector, quaternion, frame_id: str = 'odom'):
+    '''
+    构造与nav_msgs/Odometry字段一致的对象（只包含pose部分）
+    :param stamp: 秒
+    :param translation_vector: xyz
+    :param quaternion: (x, y, z, w)
+    :param frame_id:
+    :return:
+    '''
+    position = SimpleNamespace(x=float(translation_vector[0]), y=float(translation_vector[1]),
+                               z=float(translation_vector[2]))
+    orientation = SimpleNamespace(x=float(quaternion[0]), y=float(quaternion[1]), z=float(quaternion[2]),
+                                  w=float(quaternion[3]))
+    return SimpleNamespace(header=make_header(stamp, frame_id), child_frame_id='os_sensor',
+                           pose=SimpleNamespace(pose=SimpleNamespace(position=position, orientation=orientation)))
+
+
+def synthetic_pose(stamp: float, start: float = 0.):
+    '''
+    合成轨迹：以1m/s沿x方向前进，同时缓慢绕z轴转动
+    :param stamp: 秒
+    :param start: 轨迹起始时间
+    :return: 平移向量, 四元数(x, y, z, w)
+    '''
+    t = stamp - start
+    yaw = .1 * t
+    return np.array([t, .2 * np.sin(t), 0.]), np.array([0., 0., np.sin(yaw / 2), np.cos(yaw / 2)])
+
+
+# 合成bag中的topic
+SYNTHETIC_PCD_TOPIC = '/os_cloud_node/points'
+SYNTHETIC_ODOMETRY_TOPIC = '/odom'
+
+
+def write_synthetic_bag(bag_filepath: str, frames: int = 50, points: int = 131072, rate: float = 10.,
+                        odometry_rate: float = 20., seed: int = 0, start: float = 1700000000.):
+    '''
+    写出合成bag的描述文件，供benchmark.fake_rosbag读取；消息在读取时生成，文件本身很小
+    :param bag_filepath: 描述文件路径（一般以.bag结尾）
+    :param frames: 点云帧数
+    :param points: 每帧点数
+    :param rate: 点云频率(Hz)
+    :param odometry_rate: 里程计频率(Hz)
+    :param seed: 随机种子
+    :param start: 第一帧的时间戳
+    :return: bag_filepath
+    '''
+    spec = {'frames': frames, 'points': points, 'rate': rate, 'odometry_rate': odometry_rate, 'seed': seed,
+            'start': start, 'pcd_topic': SYNTHETIC_PCD_TOPIC, 'odometry_topic': SYNTHETIC_ODOMETRY_TOPIC}
+    with open(bag_filepath, 'w', encoding='utf-8') as f:
+        json.dump(spec, f, indent=2)
+    return bag_filepath
+
+
+def _odometry_stamps(spec: dict):
+    '''
+    里程计的时间范围比点云前后各多一个周期，保证每一帧都能插值出位姿
+    '''
+    period = 1. / spec['odometry_rate']
+    end = spec['start'] + (spec['frames'] - 1) / spec['rate'] + period
+    return spec['start'] - period + period * np.arange(int(np.ceil((end - spec['start']) / period)) + 2)
+
+
+def synthetic_bag_topics(spec: dict):
+    '''
+    :param spec: write_synthetic_bag写出的描述
+    :return: [(topic, msg_type, message_count, frequency)]
+    '''
+    return [
+        (spec['pcd_topic'], 'sensor_msgs/PointCloud2', spec['frames'], spec['rate']),
+        (spec['odometry_topic'], 'nav_msgs/Odometry', len(_odometry_stamps(spec)), spec['odometry_rate']),
+    ]
+
+
+def iter_synthetic_messages(spec: dict):
+    '''
+    按时间顺序生成合成bag中的消息
+    :param spec: write_synthetic_bag写出的描述
+    :return: 生成器，(topic, msg)
+    '''
+    frame_stamps = spec['start'] + np.arange(spec['frames']) / spec['rate']
+    odometry_stamps = _odometry_stamps(spec)
+    i = j = 0
+    while i < len(frame_stamps) or j < len(odometry_stamps):
+        if j >= len(odometry_stamps) or (i < len(frame_stamps) and frame_stamps[i] < odometry_stamps[j]):
+            yield spec['pcd_topic'], make_pointcloud2(spec['points'], frame_stamps[i], spec['seed'] + i)
+            i += 1
+        else:
+            translation_vector, quaternion = synthetic_pose(odometry_stamps[j], spec['start'])
+            yield spec['odometry_topic'], make_odometry(odometry_stamps[j], translation_vector, quaternion)
+            j += 1
+
+
+def write_pcd_dir(dst_dir: str, frames: int = 50, points: int = 131072, encoding: str = 'binary',
+                  rate: float = 10., seed: int = 0, start: float = 1700000000.):
+    '''
+    直接生成与BagExtractor.run()结果相同的tmp目录：每帧一个pcd文件 + trajectory.npy
+    :param dst_dir:
+    :param frames: 帧数
+    :param points: 每帧点数
+    :param encoding: pcd编码
+    :param rate: 点云频率(Hz)
+    :param seed: 随机种子
+    :param start: 第一帧的时间戳
+    :return: dst_dir
+    '''
+    os.makedirs(dst_dir, exist_ok=True)
+    spec = {'frames': frames, 'rate': rate, 'odometry_rate': 2 * rate, 'start': start}
+    for i in range(frames):
+        stamp = start + i / rate
+        msg = make_pointcloud2(points, stamp, seed + i)
+        write_pcd(osp.join(dst_dir, '%.3f.pcd' % stamp), to_frame_array(pointcloud2_to_array(msg)), encoding)
+    stamps = _odometry_stamps(spec)
+    poses = [synthetic_pose(stamp, start) for stamp in stamps]
+    save_trajectory(osp.join(dst_dir, TRAJECTORY_FILENAME), stamps, [t for t, _ in poses], [q for _, q in poses])
+    return dst_dir
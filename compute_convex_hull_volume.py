@@ -4,6 +4,21 @@ import os.path as osp
 import open3d as o3d
 
 
+def compute_convex_hull(pcd: o3d.geometry.PointCloud, down_sample_voxel: float = 0.3):
+    '''
+    体素降采样后计算凸包及其体积，不打开窗口
+    :param pcd:
+    :param down_sample_voxel: 降采样体素值
+    :return: 降采样后的点云, 凸包, 体积
+    '''
+    pcd = pcd.voxel_down_sample(down_sample_voxel)
+    logger.info(f'体素降采样{down_sample_voxel}')
+    # pcd.compute_mean_and_covariance()
+    hull,  _ = pcd.compute_convex_hull()
+    hull: o3d.geometry.TriangleMesh
+    return pcd, hull, hull.get_volume()
+
+
 def compute_convex_hull_and_its_volume(pcd_filepath: str):
     dir_path = osp.dirname(pcd_filepath)
     base_filename = osp.basename(pcd_filepath).replace('.pcd', '')
@@ -11,12 +26,7 @@ def compute_convex_hull_and_its_volume(pcd_filepath: str):
     pcd: o3d.geometry.PointCloud = o3d.io.read_point_cloud(pcd_filepath)
     down_sample_voxel = 0.3
 
-    pcd = pcd.voxel_down_sample(down_sample_voxel)
-    logger.info(f'体素降采样{down_sample_voxel}')
-    # pcd.compute_mean_and_covariance()
-    hull,  _ = pcd.compute_convex_hull()
-    hull: o3d.geometry.TriangleMesh
-    volume = hull.get_volume()
+    pcd, hull, volume = compute_convex_hull(pcd, down_sample_voxel)
     hull_ls = o3d.geometry.LineSet.create_from_triangle_mesh(hull)
     hull_ls.paint_uniform_color((1, 0, 0))
     vis = o3d.visualization.Visualizer()
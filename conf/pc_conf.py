@@ -1,10 +1,14 @@
 
 MIN_DISTANCE= .7
 MAX_DISTANCE= 70
+MIN_Z = None # z方向裁剪下限，None表示不裁剪
+MAX_Z = None # z方向裁剪上限，None表示不裁剪
+CROP_BOX = None # 轴对齐裁剪盒 ((x_min, y_min, z_min), (x_max, y_max, z_max))，None表示不裁剪
 ROTATE_CENTER = (0, 0, 0) # 旋转中心
 VOXEL_SIZE = .01 # 降采样体素值
 SPHERE_RADIUS = 0.2 # 默认球半径
 
 NB_NEIGHBORS = 20 # 统计滤波参数
 STD_RATIO = 2. # 统计滤波参数
-MOVE_STEP = .005
\ No newline at end of file
+MOVE_STEP = .005
+MAX_POSE_GAP = .2 # 位姿插值时前后两个里程计的最大时间间隔(s)
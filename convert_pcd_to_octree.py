@@ -0,0 +1,30 @@
+import os.path as osp
+from argparse import ArgumentParser
+
+from loguru import logger
+
+from utils.octree import OctreeConverter, NODE_POINTS
+
+
+def main():
+    parser = ArgumentParser(description="""
+        把合并得到的binary pcd转换为分块八叉树，转换时的内存占用与文件大小无关；
+        在myApp中打开生成的octree.json，只读取当前视角可见的节点，可以浏览比内存大的点云
+        """)
+    parser.add_argument('pcd_filepath',
+                        help='binary编码的pcd文件，例如bag2pcd生成的merged.pcd')
+    parser.add_argument('--output',
+                        default=None,
+                        help='八叉树目录，默认为pcd同级的<文件名>.octree')
+    parser.add_argument('--node-points',
+                        type=int,
+                        default=NODE_POINTS,
+                        help=f'每个节点最多的点数，默认{NODE_POINTS}')
+    args = parser.parse_args()
+    octree_dir = args.output or osp.splitext(args.pcd_filepath)[0] + '.octree'
+    index_filepath = OctreeConverter(args.pcd_filepath, octree_dir, node_points=args.node_points).convert()
+    logger.info(f'在myApp中打开 {index_filepath} 浏览')
+
+
+if __name__ == '__main__':
+    main()
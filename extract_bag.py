@@ -1,81 +1,128 @@
 
-import copy
 import os.path as osp
 import os
-import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from traceback import format_exc
+from types import SimpleNamespace
 
-import numpy as np
 import rosbag
-import sensor_msgs.point_cloud2 as pc2
-from cv_bridge import CvBridge
+
+try:
+    # rosbag按时间范围读取时需要genpy.Time；没有ROS时（benchmark中的fake_rosbag）用带secs、nsecs的对象代替
+    from genpy import Time
+except ImportError:
+    Time = None
 
 from loguru import logger
 # from utils.time_utils import get_current_time
-import open3d as o3d
-
-
-# PCD_ASCII_TEMPLATE = """VERSION 0.7
-# FIELDS x y z intensity
-# SIZE 4 4 4 2
-# TYPE F F F U
-# COUNT 1 1 1 1
-# WIDTH {}
-# HEIGHT 1
-# VIEWPOINT 0 0 0 1 0 0 0
-# POINTS {}
-# DATA ascii
-# """
-
-# PCD_BINARY_TEMPLATE = """VERSION 0.7
-# FIELDS x y z intensity
-# SIZE 4 4 4 4
-# TYPE F F F F
-# COUNT 1 1 1 1
-# WIDTH {}
-# HEIGHT 1
-# VIEWPOINT 0 0 0 1 0 0 0
-# POINTS {}
-# DATA binary
-# """
-
-PCD_ASCII_TEMPLATE = """# .PCD v0.7 - Point Cloud Data file format
-VERSION 0.7
-FIELDS x y z
-SIZE 4 4 4
-TYPE F F F
-COUNT 1 1 1
-WIDTH {}
-HEIGHT 1
-VIEWPOINT 0 0 0 1 0 0 0
-POINTS {}
-DATA ascii
-"""
-
-PCD_BINARY_TEMPLATE = """# .PCD v0.7 - Point Cloud Data file format
-VERSION 0.7
-FIELDS x y z intensity ring time
-SIZE 4 4 4 4 2 4
-TYPE F F F F U F
-COUNT 1 1 1 1 1 1
-WIDTH {}
-HEIGHT 1
-VIEWPOINT 0 0 0 1 0 0 0
-POINTS {}
-DATA binary
-"""
+from utils.pc2_utils import pointcloud2_to_array, to_frame_array
+from utils.pcd_utils import PCD_ENCODINGS, write_pcd
+from utils.math_utils import get_translation_and_quaternion_from_msg
+from utils.pose_utils import PoseIndex, TRAJECTORY_FILENAME, save_trajectory, get_sensor_name, \
+    save_sensor_extrinsics
+from utils.metrics import Metrics
+
+
+# 流式解析时，等待位姿的点云帧/用于插值的里程计的最大缓存数量
+MAX_PENDING = 50
+
+# 断点续传时，每写入多少条消息记录一次进度
+PROGRESS_INTERVAL = 100
+
+POINTCLOUD2_TYPE = 'sensor_msgs/PointCloud2'
+ODOMETRY_TYPE = 'nav_msgs/Odometry'
+
+# 里程计的保存格式：npy - 整条轨迹写入一个文件；txt - 每条里程计写一个txt文件
+ODOMETRY_FORMATS = ('npy', 'txt')
+
+
+def split_time_range(start_time, end_time, n):
+    '''
+    把[start_time, end_time]均分为n个时间窗口，边界为整数纳秒，避免浮点秒转换时截断
+    第一个窗口没有起始时间、最后一个窗口没有结束时间，bag两端的消息不会因边界的舍入而丢失
+    :param start_time: bag记录的起始时间（秒）
+    :param end_time: bag记录的结束时间（秒）
+    :return: [(窗口起始纳秒或None, 窗口结束纳秒或None), ...]，窗口含起始、不含结束
+    '''
+    n = max(1, int(n))
+    start_nsec, end_nsec = int(round(start_time * 1e9)), int(round(end_time * 1e9))
+    bounds = [None] + [start_nsec + (end_nsec - start_nsec) * i // n for i in range(1, n)] + [None]
+    return [(bounds[i], bounds[i + 1]) for i in range(n)]
+
+
+def to_nsec(t):
+    '''
+    :param t: genpy.Time或带secs、nsecs的时间戳
+    :return: 整数纳秒
+    '''
+    return t.secs * 10 ** 9 + t.nsecs
+
+
+def _to_time(nsec):
+    '''
+    整数纳秒 -> rosbag.read_messages的时间参数；没有genpy时（benchmark.fake_rosbag）为带secs、nsecs的对象
+    '''
+    secs, nsecs = divmod(nsec, 10 ** 9)
+    return Time(secs, nsecs) if Time is not None else SimpleNamespace(secs=secs, nsecs=nsecs)
+
+
+def _format_window(window):
+    return '-'.join('...' if nsec is None else '%.3f' % (nsec * 1e-9) for nsec in window)
+
+
+def _extract_window(bag_file, dst_folder, encoding, odometry_format, pcd_topics, odometry_topic, extrinsics,
+                    window):
+    '''
+    在子进程中解析一个时间窗口，见BagExtractor.run_parallel
+    :return: (消息数, 该窗口的里程计, 传感器外参, 各步骤统计)
+    '''
+    extractor = BagExtractor(bag_file, dst_folder, encoding, odometry_format, None, pcd_topics, odometry_topic,
+                             extrinsics)
+    with logger.contextualize(window=_format_window(window)):
+        count = extractor.extract(start_nsec=window[0], end_nsec=window[1])
+    return count, extractor.trajectory, extractor.sensor_extrinsics, extractor.metrics.stages
 
 
 class BagExtractor:
-    def __init__(self, bag_file, dst_folder):
+    def __init__(self, bag_file, dst_folder, encoding='binary', odometry_format='npy', metrics=None,
+                 pcd_topics=None, odometry_topic=None, extrinsics=None):
+        '''
+        :param bag_file: bag文件路径
+        :param dst_folder: 解析结果存放目录
+        :param encoding: pcd文件编码，ascii、binary或binary_compressed
+        :param odometry_format: 里程计保存格式，npy或txt
+        :param metrics: 记录read_bag、decode、write的统计，为None时新建
+        :param pcd_topics: 雷达点云topic列表，为None时自动选择bag中的PointCloud2 topic
+        :param odometry_topic: 里程计topic，为None时自动选择bag中的Odometry topic
+        :param extrinsics: {雷达topic: 4x4外参（传感器坐标系 -> 里程计坐标系）}，合并时并入各帧的位姿
+        '''
+        if encoding not in PCD_ENCODINGS:
+            raise ValueError(f'不支持的pcd编码：{encoding}，可选：{PCD_ENCODINGS}')
+        if odometry_format not in ODOMETRY_FORMATS:
+            raise ValueError(f'不支持的里程计格式：{odometry_format}，可选：{ODOMETRY_FORMATS}')
         self.bag_file = bag_file
         self.dst_folder = dst_folder
-        self.bridge = CvBridge()
+        self.encoding = encoding
+        self.odometry_format = odometry_format
+        self.metrics = metrics or Metrics()
+        self.pcd_topics = list(pcd_topics) if pcd_topics else None
+        self.odometry_topic = odometry_topic
+        self.extrinsics = extrinsics or {}
+        # {传感器名: 4x4外参}，read_messages中根据选中的topic生成
+        self.sensor_extrinsics = {}
+        # odometry_format为npy时，缓存(时间戳, 平移向量, 四元数)，最后一次性写入轨迹文件
+        self.trajectory = []
 
-    def run(self):
+    def read_messages(self, start_nsec=None, end_nsec=None):
         """
-        读取bag文件
-        :return:
+        读取bag文件中选中topic的点云和里程计消息，其他topic（例如图像）不会被反序列化
+        :param start_nsec: 只读取bag记录时间不早于start_nsec（整数纳秒）的消息，为None时从头读取
+        :param end_nsec: 只读取bag记录时间早于end_nsec的消息（不含），为None时读到结尾，
+                         相邻时间窗口不会重复读取边界上的消息
+        :return: 生成器，(类型 'pcd' 或 'odometry', 时间戳字符串, msg, 传感器名)
+                 只有一个雷达且没有外参时传感器名为None，里程计的传感器名为None
         """
         # 读取bag文件
         with rosbag.Bag(self.bag_file, 'r') as bag:
@@ -83,51 +130,245 @@ class BagExtractor:
             info = bag.get_type_and_topic_info()
 
             # 读取pcd坐标的topic
-            pcd_topic, odometry_topic, total = self.read_bag_point_topic(info)
-            logger.info("pcd_topic: {}, odometry_topic: {}, total: {}".format(pcd_topic, odometry_topic, total))
+            pcd_topics, odometry_topic, total = self.select_topics(info, self.pcd_topics, self.odometry_topic)
+            logger.info("pcd_topics: {}, odometry_topic: {}, total: {}".format(pcd_topics, odometry_topic, total))
             if total == 0:
                 logger.error(f'{self.bag_file}  文件数据无法获取')
                 raise RuntimeError(f'{self.bag_file}  文件数据无法获取')
+            self.total = total
+            # 多个雷达或有外参时，文件名中带传感器名以区分各雷达的帧
+            with_sensor = len(pcd_topics) > 1 or bool(self.extrinsics)
+            sensor_names = {topic: get_sensor_name(topic) if with_sensor else None for topic in pcd_topics}
+            self.sensor_extrinsics = {sensor_names[topic]: extrinsic for topic, extrinsic in self.extrinsics.items()
+                                      if topic in sensor_names}
+            unused = [topic for topic in self.extrinsics if topic not in sensor_names]
+            if unused:
+                logger.warning(f'外参中的topic未被读取：{unused}，已读取的雷达topic：{pcd_topics}')
             # 读取信息
-            cur = 0
-            for topic, msg, t in bag.read_messages():
-
-                if topic == pcd_topic:
+            topics = pcd_topics + [odometry_topic] if odometry_topic else pcd_topics
+            window = {}
+            if start_nsec is not None:
+                window['start_time'] = _to_time(start_nsec)
+            if end_nsec is not None:
+                window['end_time'] = _to_time(end_nsec)
+            for topic, msg, t in bag.read_messages(topics=topics, **window):
+                if end_nsec is not None and to_nsec(t) >= end_nsec:
+                    continue
+                if topic in sensor_names:
                     # 读取时间戳
-                    time_str = "%.3f" % msg.header.stamp.to_sec()
-                    # 文件地址
-                    pcd_path = os.path.join(self.dst_folder, "{}.pcd".format(time_str))
-                    cur += 1
-                    progress = "%.2f" % (cur / total * 100)
-                    # 转ascii码 生成文件
-                    self.to_pcd_ascii(pcd_path, msg)
-                    logger.info(f'文件总数：{total}, 生成第{cur}个文件：{pcd_path}, 进度：{progress}%')
+                    yield 'pcd', "%.3f" % msg.header.stamp.to_sec(), msg, sensor_names[topic]
                 elif topic == odometry_topic:
                     time = msg.header.stamp.secs + msg.header.stamp.nsecs * (10 ** -9)
                     # 读取时间戳
-                    time_str = "%.3f" % time
-                    logger.info("时间戳：{}".format(time_str))
-                    cur += 1
-                    progress = "%.2f" % (cur / total * 100)
-                    # 文件地址
-                    txt_path = os.path.join(self.dst_folder, "{}.txt".format(time_str))
-                    self.to_txt_ascii(txt_path, msg)
-                    logger.info(f'文件总数：{total}, 生成第{cur}个文件: {txt_path}, 进度：{progress}%')
+                    yield 'odometry', "%.3f" % time, msg, None
+
+    def run(self, skip=0, on_progress=None, progress_interval=PROGRESS_INTERVAL):
+        """
+        读取bag文件，将点云和里程计逐条写入dst_folder
+        :param skip: 前skip条消息已经写入（断点续传），不再解析和写入；npy格式的里程计仍然读取以生成完整轨迹
+        :param on_progress: 每写入progress_interval条消息调用一次on_progress(已完成的消息数)
+        :param progress_interval:
+        :return: 消息总数
+        """
+        cur = self.extract(skip, on_progress, progress_interval)
+        self.save_trajectory()
+        self.save_extrinsics()
+        return cur
+
+    def extract(self, skip=0, on_progress=None, progress_interval=PROGRESS_INTERVAL, start_nsec=None, end_nsec=None):
+        """
+        解析bag（或其中一个时间窗口）的消息并逐条写入dst_folder，npy格式的里程计缓存在self.trajectory中
+        :param skip: 见run()
+        :param on_progress: 见run()
+        :param progress_interval:
+        :param start_nsec: 见read_messages()
+        :param end_nsec: 见read_messages()
+        :return: 消息数
+        """
+        cur = 0
+        self.trajectory = []
+        messages = self.read_messages(start_nsec, end_nsec)
+        for kind, time_str, msg, sensor in self.metrics.timed_iter('read_bag', messages):
+            cur += 1
+            if cur <= skip:
+                if kind == 'odometry' and self.odometry_format == 'npy':
+                    self.trajectory.append((msg.header.stamp.to_sec(),) + get_translation_and_quaternion_from_msg(msg))
+                continue
+            self.write_message(kind, time_str, msg, cur, sensor)
+            if on_progress is not None and cur % progress_interval == 0:
+                on_progress(cur)
+        return cur
+
+    def run_parallel(self, workers):
+        """
+        把bag的记录时间范围均分为workers个窗口，每个子进程独立打开bag、解析并写入一个窗口的消息，
+        最后按窗口顺序拼接各窗口的里程计写入轨迹文件；pcd和txt以时间戳命名，各窗口直接写入dst_folder
+        不支持断点续传，中断后需要从头解析
+        :param workers: 进程数（窗口数）
+        :return: 消息总数
+        """
+        with rosbag.Bag(self.bag_file, 'r') as bag:
+            start_time, end_time = bag.get_start_time(), bag.get_end_time()
+        windows = split_time_range(start_time, end_time, workers)
+        logger.info(f'{self.bag_file} 分为{len(windows)}个时间窗口并行解析：{start_time:.3f} - {end_time:.3f}')
+        # spawn避免fork继承open3d的线程状态
+        with ProcessPoolExecutor(max_workers=len(windows), mp_context=get_context('spawn')) as executor:
+            futures = [executor.submit(_extract_window, self.bag_file, self.dst_folder, self.encoding,
+                                       self.odometry_format, self.pcd_topics, self.odometry_topic, self.extrinsics,
+                                       window)
+                       for window in windows]
+            results = [future.result() for future in futures]
+        total = 0
+        self.trajectory = []
+        for count, trajectory, sensor_extrinsics, stages in results:
+            total += count
+            self.trajectory.extend(trajectory)
+            self.sensor_extrinsics.update(sensor_extrinsics)
+            self.metrics.merge(stages)
+        # 窗口按bag记录时间划分，与消息头时间戳可能有少量交错
+        self.trajectory.sort(key=lambda pose: pose[0])
+        if total == 0:
+            logger.error(f'{self.bag_file}  文件数据无法获取')
+            raise RuntimeError(f'{self.bag_file}  文件数据无法获取')
+        self.save_trajectory()
+        self.save_extrinsics()
+        return total
+
+    def write_message(self, kind, time_str, msg, cur, sensor=None):
+        """
+        将一条点云或里程计消息写入dst_folder
+        :param kind: 'pcd' 或 'odometry'
+        :param time_str: 时间戳字符串，作为文件名
+        :param msg:
+        :param cur: 当前是第几条消息，用于打印进度
+        :param sensor: 传感器名，不为None时加在点云文件名中
+        :return:
+        """
+        progress = "%.2f" % (cur / self.total * 100)
+        if kind == 'pcd':
+            # 文件地址
+            pcd_name = time_str if sensor is None else f'{time_str}_{sensor}'
+            pcd_path = os.path.join(self.dst_folder, "{}.pcd".format(pcd_name))
+            frame = self.decode(msg)
+            # 按指定编码生成文件
+            with self.metrics.measure('write', len(frame)):
+                write_pcd(pcd_path, frame, self.encoding) # x y z intensity ring time
+            logger.info(f'文件总数：{self.total}, 生成第{cur}个文件：{pcd_path}, 进度：{progress}%')
+        elif self.odometry_format == 'npy':
+            self.trajectory.append((msg.header.stamp.to_sec(),) + get_translation_and_quaternion_from_msg(msg))
+            logger.info(f'文件总数：{self.total}, 读取第{cur}条里程计：{time_str}, 进度：{progress}%')
+        else:
+            logger.info("时间戳：{}".format(time_str))
+            # 文件地址
+            txt_path = os.path.join(self.dst_folder, "{}.txt".format(time_str))
+            self.to_txt_ascii(txt_path, msg)
+            logger.info(f'文件总数：{self.total}, 生成第{cur}个文件: {txt_path}, 进度：{progress}%')
+
+    def save_trajectory(self):
+        """
+        odometry_format为npy时，将缓存的里程计一次性写入dst_folder中的轨迹文件
+        :return:
+        """
+        if self.odometry_format != 'npy':
+            return
+        trajectory_path = os.path.join(self.dst_folder, TRAJECTORY_FILENAME)
+        stamps = [stamp for stamp, _, _ in self.trajectory]
+        translations = [translation for _, translation, _ in self.trajectory]
+        quaternions = [quaternion for _, _, quaternion in self.trajectory]
+        with self.metrics.measure('write_trajectory', len(self.trajectory)):
+            save_trajectory(trajectory_path, stamps, translations, quaternions)
+        logger.info(f'里程计数：{len(self.trajectory)}，轨迹文件：{trajectory_path}')
+
+    def save_extrinsics(self):
+        """
+        有外参时写入dst_folder，合并时据此把外参并入各帧的位姿
+        :return:
+        """
+        if self.sensor_extrinsics:
+            save_sensor_extrinsics(self.dst_folder, self.sensor_extrinsics)
+
+    def iter_posed_frames(self, dump=False, max_pending=MAX_PENDING):
+        """
+        流式读取bag：按时间戳为每一帧点云插值得到位姿后逐帧返回，不经过tmp目录
+        点云帧要等到时间戳不早于它的里程计到达后才能插值，因此最多缓存max_pending帧点云和max_pending条里程计
+        :param dump: 是否同时把消息写入dst_folder（与run()的结果相同）
+        :param max_pending: 缓存的最大数量
+        :return: 生成器，(时间戳字符串, FRAME_DTYPE结构化数组, 平移向量, 旋转矩阵, 外参)，没有外参时为None
+        """
+        pending_frames = deque()
+        poses = deque(maxlen=max_pending)
+        cur = 0
+        self.trajectory = []
+        for kind, time_str, msg, sensor in self.metrics.timed_iter('read_bag', self.read_messages()):
+            cur += 1
+            if dump:
+                self.write_message(kind, time_str, msg, cur, sensor)
+            # 与trajectory.npy一致，使用完整精度的时间戳，time_str只保留了毫秒
+            stamp = msg.header.stamp.to_sec()
+            if kind == 'pcd':
+                pending_frames.append((stamp, time_str, self.decode(msg), self.sensor_extrinsics.get(sensor)))
+            else:
+                poses.append((stamp,) + get_translation_and_quaternion_from_msg(msg))
+
+            if pending_frames and poses and pending_frames[0][0] <= poses[-1][0]:
+                pose_index = PoseIndex(*zip(*poses))
+                while pending_frames and pending_frames[0][0] <= poses[-1][0]:
+                    stamp, time_str, frame, extrinsic = pending_frames.popleft()
+                    translations, rotations, valid = pose_index.lookup([stamp])
+                    if valid[0]:
+                        yield time_str, frame, translations[0], rotations[0], extrinsic
+                    else:
+                        logger.warning(f'{time_str} 无法插值位姿，跳过该帧')
+            while len(pending_frames) > max_pending:
+                _, time_str, _, _ = pending_frames.popleft()
+                logger.warning(f'{time_str} 等待里程计超时，跳过该帧')
+        if dump:
+            self.save_trajectory()
+            self.save_extrinsics()
+
+    def decode(self, msg):
+        """
+        将PointCloud2消息解析为FRAME_DTYPE结构化数组，并记录decode的统计
+        :param msg:
+        :return:
+        """
+        with self.metrics.measure('decode', msg.width * msg.height) as measurement:
+            frame = to_frame_array(pointcloud2_to_array(msg))
+            measurement.points_out = len(frame)
+        return frame
 
     @staticmethod
-    def read_bag_point_topic(info):
+    def select_topics(info, pcd_topics=None, odometry_topic=None):
+        """
+        确定要读取的雷达topic和里程计topic
+        :param info: bag.get_type_and_topic_info()
+        :param pcd_topics: 指定的雷达topic列表，为None时使用bag中的PointCloud2 topic（有多个时取最后一个）
+        :param odometry_topic: 指定的里程计topic，为None时使用bag中的Odometry topic（有多个时取最后一个）
+        :return: 雷达topic列表, 里程计topic, 选中topic的消息总数
+        """
         logger.info(info.topics)
-        pcd_topic = None
-        odometry_topic = None
-        total = 0
-        for topic in info.topics:
-            if info.topics.get(topic).msg_type == 'nav_msgs/Odometry':
-                total += info.topics.get(topic).message_count
-                odometry_topic = topic
-            elif info.topics.get(topic).msg_type == 'sensor_msgs/PointCloud2':
-                total += info.topics.get(topic).message_count
-                pcd_topic = topic
-        return pcd_topic, odometry_topic, total
+        msg_types = {topic: info.topics.get(topic).msg_type for topic in info.topics}
+        if pcd_topics is None:
+            found = [topic for topic, msg_type in msg_types.items() if msg_type == POINTCLOUD2_TYPE]
+            pcd_topics = found[-1:]
+            if len(found) > 1:
+                logger.warning(f'bag中有多个PointCloud2 topic：{found}，只读取{pcd_topics}，可通过--lidar-topics指定')
+        if odometry_topic is None:
+            found = [topic for topic, msg_type in msg_types.items() if msg_type == ODOMETRY_TYPE]
+            odometry_topic = found[-1] if found else None
+        for topic, msg_type in [(topic, POINTCLOUD2_TYPE) for topic in pcd_topics] + [(odometry_topic, ODOMETRY_TYPE)]:
+            if topic is not None and msg_types.get(topic) != msg_type:
+                raise ValueError(f'bag中没有{msg_type}类型的topic：{topic}，可选：{msg_types}')
+        total = sum(info.topics.get(topic).message_count for topic in pcd_topics + [odometry_topic] if topic)
+        return pcd_topics, odometry_topic, total
+
+    @staticmethod
+    def read_bag_point_topic(info):
+        """
+        自动选择的雷达topic（单个）、里程计topic和消息总数
+        """
+        pcd_topics, odometry_topic, total = BagExtractor.select_topics(info)
+        return (pcd_topics[0] if pcd_topics else None), odometry_topic, total
 
     @staticmethod
     def to_txt_ascii(txt_path, msg):
@@ -143,32 +384,38 @@ class BagExtractor:
 
 
 
+    @staticmethod
+    def to_pcd(pcd_path, msg, encoding='binary'):
+        """
+        获取坐标及intensity、ring、time字段，按encoding生成pcd文件
+        :param pcd_path:
+        :param msg:
+        :param encoding: ascii、binary或binary_compressed
+        :return:
+        """
+        # 直接按msg.fields解析msg.data，避免pc2.read_points逐点生成tuple
+        cloud = pointcloud2_to_array(msg)
+        write_pcd(pcd_path, to_frame_array(cloud), encoding) # x y z intensity ring time
+
     @staticmethod
     def to_pcd_ascii(pcd_path, msg):
         """
-        获取坐标，利用open3d生成文件
+        获取坐标，生成ascii编码的pcd文件
+        :param pcd_path:
+        :param msg:
+        :return:
+        """
+        BagExtractor.to_pcd(pcd_path, msg, 'ascii')
+
+    @staticmethod
+    def to_pcd_binary(pcd_path, msg):
+        """
+        获取坐标，生成binary编码的pcd文件
         :param pcd_path:
         :param msg:
         :return:
         """
-        points_data = list(pc2.read_points(msg))
-        # logger.info(f'{points_data}')
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(np.array(points_data)[:, :3]) # 只取前三列
-        # logger.info(f'{pcd}')
-        o3d.io.write_point_cloud(pcd_path, pcd)
-
-
-    # @staticmethod
-    # def to_pcd_binary(pcd_path, msg):
-    #     with open(pcd_path, 'wb') as f:
-    #         points_data = np.array(list(pc2.read_points(msg)))
-    #         lidar = list(np.delete(points_data, np.where(np.isnan(points_data))[0], axis=0))
-    #         header = copy.deepcopy(PCD_BINARY_TEMPLATE).format(len(lidar), len(lidar))
-    #         f.write(header.encode())
-    #         for pi in lidar:
-    #             h = struct.pack('ffff', pi[0], pi[1], pi[2], pi[3])
-    #             f.write(h)
+        BagExtractor.to_pcd(pcd_path, msg, 'binary')
 
 
 def main():
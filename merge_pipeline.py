@@ -0,0 +1,254 @@
+from abc import ABCMeta, abstractmethod
+import os.path as osp
+
+import numpy as np
+import open3d as o3d
+import yaml
+from loguru import logger
+
+from conf.pc_conf import MAX_DISTANCE, MIN_DISTANCE, MIN_Z, MAX_Z, CROP_BOX, ROTATE_CENTER, VOXEL_SIZE, \
+    NB_NEIGHBORS, STD_RATIO
+from utils.accumulator import PointAccumulator, VoxelAccumulator
+from utils.cloud_utils import crop, select_attributes, voxel_down_sample
+from utils.math_utils import make_transform, apply_transform
+from utils.metrics import Metrics
+
+
+class IStage(metaclass=ABCMeta):
+    '''
+    单帧处理步骤
+    '''
+    # 配置文件中的type
+    type = None
+
+    def __init__(self, name: str = None):
+        self.name = name or self.type
+
+    def to_dict(self):
+        '''
+        :return: 与配置文件中一项stage相同的格式
+        '''
+        return {'type': self.type, **vars(self)}
+
+    @abstractmethod
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        '''
+        :param points: (N, 3)坐标
+        :param attributes: {字段名: (N,)数组}
+        :param translation_vector: 该帧的平移向量
+        :param rotation_matrix: 该帧的旋转矩阵
+        :return: 处理后的坐标和属性
+        '''
+        pass
+
+
+class CropStage(IStage):
+    '''
+    裁剪：距离范围、z范围、轴对齐包围盒
+    '''
+    type = 'crop'
+
+    def __init__(self, min_distance=None, max_distance=None, min_z=None, max_z=None, box=None, name=None):
+        super().__init__(name)
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.min_z = min_z
+        self.max_z = max_z
+        self.box = box
+
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        return crop(points, attributes, min_distance=self.min_distance, max_distance=self.max_distance,
+                    min_z=self.min_z, max_z=self.max_z, box=self.box)
+
+
+class VoxelStage(IStage):
+    '''
+    体素降采样
+    '''
+    type = 'voxel'
+
+    def __init__(self, voxel_size=VOXEL_SIZE, name=None):
+        super().__init__(name)
+        self.voxel_size = voxel_size
+
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        return voxel_down_sample(points, attributes, self.voxel_size)
+
+
+class StatisticalOutlierStage(IStage):
+    '''
+    统计滤波
+    '''
+    type = 'statistical_outlier'
+
+    def __init__(self, nb_neighbors=NB_NEIGHBORS, std_ratio=STD_RATIO, name=None):
+        super().__init__(name)
+        self.nb_neighbors = nb_neighbors
+        self.std_ratio = std_ratio
+
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        if len(points) == 0:
+            # 裁剪后为空的帧
+            return points, attributes
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        pcd, index = pcd.remove_statistical_outlier(nb_neighbors=self.nb_neighbors, std_ratio=self.std_ratio)
+        return np.asarray(pcd.points), select_attributes(attributes, index)
+
+
+class RadiusOutlierStage(IStage):
+    '''
+    半径滤波：邻域球内点数少于nb_points的点为噪声点
+    '''
+    type = 'radius_outlier'
+
+    def __init__(self, nb_points=20, radius=.05, name=None):
+        super().__init__(name)
+        self.nb_points = nb_points
+        self.radius = radius
+
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        if len(points) == 0:
+            # 裁剪后为空的帧
+            return points, attributes
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        pcd, index = pcd.remove_radius_outlier(nb_points=self.nb_points, radius=self.radius)
+        return np.asarray(pcd.points), select_attributes(attributes, index)
+
+
+class TransformStage(IStage):
+    '''
+    位姿变换：旋转+平移合并为一次齐次变换
+    '''
+    type = 'transform'
+
+    def __init__(self, center=ROTATE_CENTER, name=None):
+        super().__init__(name)
+        self.center = tuple(center)
+
+    def process(self, points, attributes, translation_vector, rotation_matrix):
+        transform = make_transform(translation_vector, rotation_matrix, center=self.center)
+        return apply_transform(points, transform), attributes
+
+
+STAGE_TYPES = {stage.type: stage for stage in
+               (CropStage, VoxelStage, StatisticalOutlierStage, RadiusOutlierStage, TransformStage)}
+
+ACCUMULATE_STAGE = 'accumulate'
+
+
+class MergePipeline:
+    '''
+    合并流程：stages依次作用于每一帧，然后并入累加器
+    传入metrics时记录每个步骤的耗时和输入/输出点数
+    '''
+
+    def __init__(self, stages: list, accumulate_voxel_size: float = VOXEL_SIZE):
+        '''
+        :param stages: IStage列表
+        :param accumulate_voxel_size: 累加时的体素大小，<=0时直接拼接不降采样
+        '''
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names) or ACCUMULATE_STAGE in names:
+            raise ValueError(f'步骤名重复：{names}，可通过name区分')
+        if not any(isinstance(stage, TransformStage) for stage in stages):
+            logger.warning('合并流程中没有transform步骤，各帧不会变换到地图坐标系')
+        self.stages = stages
+        self.accumulate_voxel_size = accumulate_voxel_size
+
+    @classmethod
+    def default(cls):
+        '''
+        与conf/pc_conf.py一致的默认流程：裁剪 -> 降采样 -> 统计滤波 -> 变换 -> 体素累加
+        '''
+        return cls([
+            CropStage(min_distance=MIN_DISTANCE, max_distance=MAX_DISTANCE, min_z=MIN_Z, max_z=MAX_Z, box=CROP_BOX),
+            VoxelStage(VOXEL_SIZE),
+            StatisticalOutlierStage(NB_NEIGHBORS, STD_RATIO),
+            TransformStage(ROTATE_CENTER),
+        ], VOXEL_SIZE)
+
+    @classmethod
+    def from_dict(cls, profile: dict):
+        '''
+        :param profile: {'stages': [{'type': 'crop', ...}, ...], 'accumulate': {'voxel_size': ...}}
+        :return:
+        '''
+        stages = []
+        for stage_conf in profile.get('stages', []):
+            stage_conf = dict(stage_conf)
+            stage_type = stage_conf.pop('type')
+            if stage_type not in STAGE_TYPES:
+                raise ValueError(f'未知的步骤类型：{stage_type}，可选：{list(STAGE_TYPES)}')
+            stages.append(STAGE_TYPES[stage_type](**stage_conf))
+        accumulate_conf = profile.get('accumulate') or {}
+        return cls(stages, accumulate_conf.get('voxel_size', VOXEL_SIZE))
+
+    @classmethod
+    def from_profile(cls, profile_filepath: str):
+        '''
+        从yaml或toml配置文件加载；toml在python3.11以下需要tomli
+        :param profile_filepath:
+        :return:
+        '''
+        if osp.splitext(profile_filepath)[1].lower() == '.toml':
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ImportError('python3.11以下读取toml配置需要tomli：pip install tomli，或改用yaml配置')
+            with open(profile_filepath, 'rb') as f:
+                profile = tomllib.load(f)
+        else:
+            with open(profile_filepath, 'r', encoding='utf-8') as f:
+                profile = yaml.safe_load(f)
+        logger.info(f'合并流程配置：{profile_filepath}')
+        return cls.from_dict(profile or {})
+
+    @property
+    def transform_center(self):
+        '''
+        transform步骤的旋转中心，用于把传感器外参并入位姿
+        '''
+        for stage in self.stages:
+            if isinstance(stage, TransformStage):
+                return stage.center
+        return ROTATE_CENTER
+
+    def to_dict(self):
+        '''
+        :return: 与from_dict的参数相同的格式，用于记录和比较合并参数
+        '''
+        return {'stages': [stage.to_dict() for stage in self.stages],
+                'accumulate': {'voxel_size': self.accumulate_voxel_size}}
+
+    def __repr__(self):
+        return ' -> '.join([stage.name for stage in self.stages] + [ACCUMULATE_STAGE])
+
+    def process(self, points, attributes, translation_vector, rotation_matrix, metrics: Metrics = None):
+        '''
+        依次执行各步骤
+        :param metrics: 不为None时记录各步骤的统计
+        :return: 处理后的坐标和属性
+        '''
+        metrics = metrics or Metrics()
+        for stage in self.stages:
+            with metrics.measure(stage.name, len(points)) as measurement:
+                points, attributes = stage.process(points, attributes, translation_vector, rotation_matrix)
+                measurement.points_out = len(points)
+        return points, attributes
+
+    def make_accumulator(self):
+        if self.accumulate_voxel_size > 0:
+            return VoxelAccumulator(self.accumulate_voxel_size)
+        return PointAccumulator()
+
+    def accumulate(self, accumulator, points, attributes, metrics: Metrics = None):
+        '''
+        将一帧并入累加器
+        :param metrics: 不为None时记录统计
+        '''
+        metrics = metrics or Metrics()
+        with metrics.measure(ACCUMULATE_STAGE, len(points)):
+            accumulator.add(points, attributes)
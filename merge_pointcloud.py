@@ -1,13 +1,107 @@
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 import os.path as osp
 import yaml
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 import open3d as o3d
 from loguru import logger
-from conf.pc_conf import MAX_DISTANCE, MIN_DISTANCE, ROTATE_CENTER, VOXEL_SIZE, NB_NEIGHBORS, STD_RATIO
-from utils.math_utils import get_translation_and_rotation_matrix_from
+from utils.pose_utils import PoseIndex, get_stamp_from_filepath, get_sensor_from_filepath, load_sensor_extrinsics
+from utils.math_utils import compose_extrinsic
+from utils.cloud_utils import XYZ_FIELDS, split_cloud
+from utils.pcd_utils import read_pcd, read_pcd_header
+from utils.cloud_writer import FrameWriter, write_cloud
+from merge_pipeline import MergePipeline
+from utils.metrics import Metrics
+
+
+# 合并方式：posed - 按位姿变换、滤波、降采样后拼接；raw - 不做任何处理直接拼接；both - 一次读取同时生成两种结果
+MERGE_MODES = ('posed', 'raw', 'both')
+
+
+def preprocess_frame(points, attributes, translation_vector, rotation_matrix, pipeline: MergePipeline = None,
+                     metrics: Metrics = None):
+    '''
+    单帧处理：按合并流程依次过滤、降采样、滤波、位姿变换，各帧之间相互独立
+    :param points: (N, 3)坐标
+    :param attributes: {字段名: (N,)数组}
+    :param translation_vector: 平移向量
+    :param rotation_matrix: 旋转矩阵
+    :param pipeline: 合并流程，为None时使用conf/pc_conf.py中的默认流程
+    :param metrics: 不为None时记录各步骤的统计
+    :return: 变换到地图坐标系的坐标, 属性
+    '''
+    pipeline = pipeline or MergePipeline.default()
+    return pipeline.process(points, attributes, translation_vector, rotation_matrix, metrics)
+
+
+def _shared_frame_dtype(pcd_filepath: str):
+    '''
+    根据pcd文件头确定共享内存中帧的布局：float64的xyz + 文件中的其他单值字段
+    :param pcd_filepath:
+    :return: 结构化dtype, 文件中的点数（处理后的点数不会超过它）
+    '''
+    dtype, num_points = read_pcd_header(pcd_filepath)
+    fields = [(name, '<f8') for name in ('x', 'y', 'z')]
+    fields += [(name, dtype.fields[name][0]) for name in dtype.names
+               if name not in ('x', 'y', 'z') and not name.startswith('_') and dtype.fields[name][0].shape == ()]
+    return np.dtype(fields), num_points
+
+
+def open_raw_writer(raw_pcd_filepath: str, pcd_files: list):
+    '''
+    raw合并结果逐帧写出，不在内存中拼接整个点云；只读取各文件头得到总点数和字段
+    字段为所有帧共有的单值字段（与_shared_frame_dtype一致，单进程和多进程的结果相同）
+    :param raw_pcd_filepath:
+    :param pcd_files: 所有参与raw合并的文件
+    :return: FrameWriter
+    '''
+    names, num_points = None, 0
+    for pcd_filepath in pcd_files:
+        dtype, frame_points = _shared_frame_dtype(pcd_filepath)
+        frame_names = [name for name in dtype.names if name not in XYZ_FIELDS]
+        names = frame_names if names is None else [name for name in names if name in frame_names]
+        num_points += frame_points
+    return FrameWriter(raw_pcd_filepath, names or [], num_points)
+
+
+def _write_frame_to_shared_memory(points, attributes, shm_name, dtype):
+    '''
+    在子进程中把一帧写入主进程创建的共享内存
+    '''
+    # 共享内存由主进程close()和unlink()，子进程只关闭自己的映射
+    shm = SharedMemory(name=shm_name)
+    try:
+        frame = np.ndarray(len(points), dtype=dtype, buffer=shm.buf)
+        for i, name in enumerate(('x', 'y', 'z')):
+            frame[name] = points[:, i]
+        for name in dtype.names[3:]:
+            frame[name] = attributes[name]
+        del frame
+    finally:
+        shm.close()
+
+
+def _preprocess_frame_to_shared_memory(pcd_filepath, translation_vector, rotation_matrix, shm_name, dtype,
+                                       pipeline: MergePipeline, raw_shm_name: str = None):
+    '''
+    在子进程中读取并处理一帧，结果写入主进程创建的共享内存
+    :param raw_shm_name: 不为None时，同时把未处理的帧写入该共享内存
+    :return: 处理后的点数, 该帧各步骤的统计
+    '''
+    metrics = Metrics()
+    with metrics.measure('read') as measurement:
+        points, attributes = split_cloud(read_pcd(pcd_filepath))
+        measurement.points_in = measurement.points_out = len(points)
+    if raw_shm_name is not None:
+        _write_frame_to_shared_memory(points, attributes, raw_shm_name, dtype)
+    points, attributes = pipeline.process(points, attributes, translation_vector, rotation_matrix, metrics)
+    _write_frame_to_shared_memory(points, attributes, shm_name, dtype)
+    return len(points), metrics.stages
 
 class IMerge(metaclass=ABCMeta):
     def __init__(self, pcd_dir: str, pcd_filepath: str):
@@ -30,70 +124,260 @@ class IMerge(metaclass=ABCMeta):
 
 
 class SimpleMerge(IMerge):
-    def __init__(self, pcd_dir: str, pcd_filepath: str):
+    def __init__(self, pcd_dir: str, pcd_filepath: str, workers: int = 1, pipeline: MergePipeline = None,
+                 metrics: Metrics = None, raw_pcd_filepath: str = None):
+        '''
+        :param pcd_dir: tmp目录
+        :param pcd_filepath: 合并结果路径，格式由扩展名决定（pcd、ply、las、laz），见utils.cloud_writer
+        :param workers: 单帧处理的进程数，>1时并行处理各帧
+        :param pipeline: 合并流程，为None时使用conf/pc_conf.py中的默认流程
+        :param metrics: 记录read、各处理步骤、accumulate、write的统计，为None时新建
+        :param raw_pcd_filepath: 不为None时，在同一次读取中把未处理的全部帧直接拼接写入该路径
+                                 （与SimpleMergeWithoutOdometer的结果相同）
+        '''
         super().__init__(pcd_dir, pcd_filepath)
         self.pcd_filepath = pcd_filepath
-        pcd_files = glob(osp.join(pcd_dir, '*.pcd'))
-        self.pcd_files = [pcd_file for pcd_file in pcd_files if osp.exists(pcd_file[:-4] + '.txt')]
-        logger.info(f'待合并的文件数：{len(self.pcd_files)}')
+        self.raw_pcd_filepath = raw_pcd_filepath
+        self.workers = workers
+        self.pipeline = pipeline or MergePipeline.default()
+        self.metrics = metrics or Metrics()
+        self.raw_writer = None
+        pcd_files = sorted(glob(osp.join(pcd_dir, '*.pcd')), key=get_stamp_from_filepath)
+        # 里程计与点云的时间戳一般不完全相同，按时间戳插值得到每一帧的位姿
+        self.pose_index = PoseIndex.from_dir(pcd_dir)
+        translations, rotations, valid = self.pose_index.lookup(
+            [get_stamp_from_filepath(pcd_file) for pcd_file in pcd_files])
+        self.pcd_files = [pcd_file for pcd_file, v in zip(pcd_files, valid) if v]
+        # 无法插值位姿的文件，只参与raw合并
+        self.unposed_pcd_files = [pcd_file for pcd_file, v in zip(pcd_files, valid) if not v]
+        self.translations = translations[valid]
+        self.rotations = rotations[valid]
+        if raw_pcd_filepath is not None:
+            self.raw_writer = open_raw_writer(raw_pcd_filepath, self.pcd_files + self.unposed_pcd_files)
+        # 多个雷达时，各雷达的外参并入该雷达每一帧的位姿
+        extrinsics = load_sensor_extrinsics(pcd_dir)
+        if extrinsics:
+            logger.info(f'传感器外参：{list(extrinsics)}')
+            for i, pcd_file in enumerate(self.pcd_files):
+                extrinsic = extrinsics.get(get_sensor_from_filepath(pcd_file))
+                if extrinsic is not None:
+                    self.translations[i], self.rotations[i] = compose_extrinsic(
+                        self.translations[i], self.rotations[i], extrinsic, self.pipeline.transform_center)
+        logger.info(f'里程计数：{len(self.pose_index)}，待合并的文件数：{len(self.pcd_files)}，'
+                    f'无法插值位姿而跳过的文件数：{len(pcd_files) - len(self.pcd_files)}')
+
+    def read_frames(self):
+        '''
+        依次读取待合并的帧及其插值得到的位姿
+        :return: 生成器，(坐标, 属性, 平移向量, 旋转矩阵)
+        '''
+        for pcd_filepath, translation_vector, rotation_matrix in zip(self.pcd_files, self.translations, self.rotations):
+            with self.metrics.measure('read') as measurement:
+                points, attributes = split_cloud(read_pcd(pcd_filepath))
+                measurement.points_in = measurement.points_out = len(points)
+            yield points, attributes, translation_vector, rotation_matrix
 
     def merge(self):
-        logger.info(f"降采样：{VOXEL_SIZE}")
-        txt_files = [pcd_filepath[:-4] + '.txt' for pcd_filepath in self.pcd_files]
-
-        # 创建目标点云
-        target_point_cloud = o3d.geometry.PointCloud()
-
-        for i, (pcd_filepath, txt_filepath) in enumerate(zip(self.pcd_files, txt_files)):
-            pcd: o3d.geometry.PointCloud = o3d.io.read_point_cloud(pcd_filepath)
-            # 过滤小于最小值大于最大值的点
-            points = np.asarray(pcd.points)
-            # 计算每个点到坐标原点的L2范数
-            distances = np.linalg.norm(points, axis=1)
-            # 根据索引保留点
-            point_cloud = pcd.select_by_index(
-                np.where((distances >= MIN_DISTANCE) & (distances <= MAX_DISTANCE))[0])
-
-            pcd = pcd.voxel_down_sample(VOXEL_SIZE)
-
-            pcd, _ = pcd.remove_statistical_outlier(nb_neighbors=NB_NEIGHBORS,
-                                                    std_ratio=STD_RATIO)  # 统计滤波
-            translation_vector, rotation_matrix = get_translation_and_rotation_matrix_from(txt_filepath)
-            # logger.info(f'before transformation: {np.asarray(pcd.points[:3])}')
-            pcd.rotate(rotation_matrix, center=ROTATE_CENTER)
-            # logger.info(f'after rotate: {np.asarray(pcd.points[:3])}')
-            pcd.translate(translation_vector)  # 平移
-            # logger.info(f'after translate: {np.asarray(pcd.points[:3])}')
-            target_point_cloud += pcd
-
-            logger.info(f"文件总数：{len(self.pcd_files)}, 处理完第{i + 1}个文件")
+        if self.raw_writer is None:
+            self._merge()
+            return
+        with self.raw_writer:
+            self._merge()
+            self.write_raw()
+
+    def _merge(self):
+        if self.workers > 1:
+            frames = self.preprocess_frames_parallel()
+        else:
+            frames = self.read_frames() if self.raw_writer is None else self._tap_raw(self.read_frames())
+            frames = (self.pipeline.process(*frame, self.metrics) for frame in frames)
+        self.accumulate_frames(frames, len(self.pcd_files))
+
+    def _tap_raw(self, frames):
+        '''
+        把读到的未处理帧同时写入raw合并结果
+        :param frames: read_frames()
+        :return: 生成器，与frames相同
+        '''
+        for frame in frames:
+            self._add_raw(frame[0], frame[1])
+            yield frame
+
+    def _add_raw(self, points, attributes):
+        with self.metrics.measure('write_raw', len(points)):
+            self.raw_writer.add(points, attributes)
+
+    def write_raw(self):
+        '''
+        补充读取无法插值位姿的文件，写入raw合并结果
+        '''
+        for pcd_filepath in self.unposed_pcd_files:
+            with self.metrics.measure('read') as measurement:
+                points, attributes = split_cloud(read_pcd(pcd_filepath))
+                measurement.points_in = measurement.points_out = len(points)
+            self._add_raw(points, attributes)
+        logger.info(f'未处理点云合并完成：{self.raw_pcd_filepath}')
+
+    def preprocess_frames_parallel(self):
+        '''
+        多进程处理各帧：子进程读取并按合并流程处理，结果通过共享内存传回，各步骤的统计并入self.metrics
+        按帧的顺序返回结果，保证合并结果与单进程一致；同时在处理中的帧不超过2 * workers
+        需要raw结果时，子进程把读到的未处理帧写入另一块共享内存，由主进程放入raw累加器
+        :return: 生成器，(坐标, 属性)
+        '''
+        logger.info(f'单帧处理进程数：{self.workers}')
+        in_flight = deque()
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn')) as executor:
+            try:
+                for pcd_filepath, translation_vector, rotation_matrix in \
+                        zip(self.pcd_files, self.translations, self.rotations):
+                    dtype, num_points = _shared_frame_dtype(pcd_filepath)
+                    shm = SharedMemory(create=True, size=max(1, num_points * dtype.itemsize))
+                    raw_shm = SharedMemory(create=True, size=max(1, num_points * dtype.itemsize)) \
+                        if self.raw_writer is not None else None
+                    in_flight.append((executor.submit(_preprocess_frame_to_shared_memory, pcd_filepath,
+                                                      translation_vector, rotation_matrix, shm.name, dtype,
+                                                      self.pipeline, raw_shm and raw_shm.name),
+                                      shm, dtype, raw_shm, num_points))
+                    if len(in_flight) >= 2 * self.workers:
+                        yield self._collect_frame(*in_flight.popleft())
+                while in_flight:
+                    yield self._collect_frame(*in_flight.popleft())
+            finally:
+                for future, shm, _, raw_shm, _ in in_flight:
+                    future.cancel()
+                    for block in (shm, raw_shm):
+                        if block is not None:
+                            block.close()
+                            block.unlink()
+
+    @staticmethod
+    def _copy_from_shared_memory(shm, num_points, dtype):
+        view = np.ndarray(num_points, dtype=dtype, buffer=shm.buf)
+        frame = view.copy()
+        del view
+        return frame
+
+    def _collect_frame(self, future, shm, dtype, raw_shm=None, raw_num_points=0):
+        '''
+        等待子进程处理完一帧，从共享内存中取出结果并释放共享内存
+        raw_shm不为None时，其中的未处理帧放入raw累加器
+        '''
+        try:
+            num_points, stats = future.result()
+            self.metrics.merge(stats)
+            frame = self._copy_from_shared_memory(shm, num_points, dtype)
+            if raw_shm is not None:
+                self._add_raw(*split_cloud(self._copy_from_shared_memory(raw_shm, raw_num_points, dtype)))
+        finally:
+            for block in (shm, raw_shm):
+                if block is not None:
+                    block.close()
+                    block.unlink()
+        return split_cloud(frame)
+
+    def merge_frames(self, frames, total=None):
+        '''
+        合并帧：逐帧按合并流程处理后拼接
+        :param frames: 可迭代对象，元素为(坐标, 属性, 平移向量, 旋转矩阵)
+        :param total: 帧总数，仅用于打印进度，未知时为None
+        :return:
+        '''
+        self.accumulate_frames((self.pipeline.process(*frame, self.metrics) for frame in frames), total)
+
+    def accumulate_frames(self, frames, total=None):
+        '''
+        拼接已经处理好的帧并写入结果文件
+        :param frames: 可迭代对象，元素为(地图坐标系下的坐标, 属性)
+        :param total: 帧总数，仅用于打印进度，未知时为None
+        :return:
+        '''
+        logger.info(f'合并流程：{self.pipeline}，累加降采样：{self.pipeline.accumulate_voxel_size}')
+
+        # 目标点云：逐帧把点和属性（intensity、ring、time）并入体素网格，边累加边降采样
+        accumulator = self.pipeline.make_accumulator()
+
+        for i, (points, attributes) in enumerate(frames):
+            self.pipeline.accumulate(accumulator, points, attributes, self.metrics)
+            logger.info(f"文件总数：{total if total is not None else '-'}, 处理完第{i + 1}个文件")
             pass
-        target_point_cloud = target_point_cloud.voxel_down_sample(VOXEL_SIZE)
-        o3d.io.write_point_cloud(self.pcd_filepath, target_point_cloud)
+        with self.metrics.measure('build') as measurement:
+            points, attributes = accumulator.build()
+            measurement.points_out = len(points)
+        with self.metrics.measure('write', len(points)):
+            write_cloud(self.pcd_filepath, points, attributes)
         logger.info(f'点云合并完成：{self.pcd_filepath}')
+        self.metrics.log_report()
+
+
+class StreamMerge(SimpleMerge):
+    '''
+    流式合并：从bag中逐帧读取点云和里程计，直接送入合并，不经过tmp目录
+    内存中只保留等待配对的少量消息（见BagExtractor.iter_posed_frames）
+    '''
+    def __init__(self, bag_file: str, pcd_filepath: str, dump_dir: str = None, encoding: str = 'binary',
+                 odometry_format: str = 'npy', pipeline: MergePipeline = None, metrics: Metrics = None,
+                 pcd_topics: list = None, odometry_topic: str = None, extrinsics: dict = None):
+        '''
+        :param bag_file: bag文件路径
+        :param pcd_filepath: 合并结果路径
+        :param dump_dir: 不为None时，同时把解析出的pcd和里程计写入该目录
+        :param encoding: 写入dump_dir的pcd文件编码
+        :param odometry_format: 写入dump_dir的里程计格式
+        :param pipeline: 合并流程，为None时使用conf/pc_conf.py中的默认流程
+        :param metrics: 与解析共用的统计，为None时新建
+        :param pcd_topics: 雷达topic列表，见BagExtractor
+        :param odometry_topic: 里程计topic，见BagExtractor
+        :param extrinsics: {雷达topic: 4x4外参}，见BagExtractor
+        '''
+        IMerge.__init__(self, dump_dir, pcd_filepath)
+        self.pcd_filepath = pcd_filepath
+        self.pipeline = pipeline or MergePipeline.default()
+        self.metrics = metrics or Metrics()
+        self.dump_dir = dump_dir
+        # 只有流式合并需要rosbag，合并已有的pcd目录时不导入
+        from extract_bag import BagExtractor
+        self.extractor = BagExtractor(bag_file, dump_dir, encoding, odometry_format, self.metrics,
+                                      pcd_topics, odometry_topic, extrinsics)
+
+    def read_frames(self):
+        '''
+        从bag中依次读取已配对的帧
+        :return: 生成器，(坐标, 属性, 平移向量, 旋转矩阵)
+        '''
+        for time_str, frame, translation_vector, rotation_matrix, extrinsic in \
+                self.extractor.iter_posed_frames(dump=self.dump_dir is not None):
+            if extrinsic is not None:
+                translation_vector, rotation_matrix = compose_extrinsic(translation_vector, rotation_matrix, extrinsic,
+                                                                        self.pipeline.transform_center)
+            points, attributes = split_cloud(frame)
+            yield points, attributes, translation_vector, rotation_matrix
+
+    def merge(self):
+        self.merge_frames(self.read_frames())
 
 
 class SimpleMergeWithoutOdometer(IMerge):
-    def __init__(self, pcd_dir: str, pcd_filepath: str):
+    def __init__(self, pcd_dir: str, pcd_filepath: str, metrics: Metrics = None):
         super().__init__(pcd_dir, pcd_filepath)
         self.pcd_filepath = pcd_filepath
+        self.metrics = metrics or Metrics()
         self.pcd_files = glob(osp.join(pcd_dir, '*.pcd'))
         logger.info(f'待合并的文件数：{len(self.pcd_files)}')
 
     def merge(self):
-        logger.info(f"降采样：{VOXEL_SIZE}")
-
-        # 创建目标点云
-        target_point_cloud = o3d.geometry.PointCloud()
-
-        for i, pcd_filepath in enumerate(self.pcd_files):
-            # logger.info(f'{pcd_filepath}')
-            point_cloud: o3d.geometry.PointCloud = o3d.io.read_point_cloud(pcd_filepath)
-            target_point_cloud += point_cloud
-            logger.info(f"文件总数：{len(self.pcd_files)}, 处理完第{i + 1}个文件")
-            pass
+        # 目标点云：逐帧写出，不在内存中拼接
+        with open_raw_writer(self.pcd_filepath, self.pcd_files) as writer:
+            for i, pcd_filepath in enumerate(self.pcd_files):
+                # logger.info(f'{pcd_filepath}')
+                with self.metrics.measure('read') as measurement:
+                    points, attributes = split_cloud(read_pcd(pcd_filepath))
+                    measurement.points_in = measurement.points_out = len(points)
+                with self.metrics.measure('write_raw', len(points)):
+                    writer.add(points, attributes)
+                logger.info(f"文件总数：{len(self.pcd_files)}, 处理完第{i + 1}个文件")
+                pass
         # target_point_cloud = target_point_cloud.voxel_down_sample(VOXEL_SIZE)
-        o3d.io.write_point_cloud(self.pcd_filepath, target_point_cloud)
         logger.info(f'点云合并完成：{self.pcd_filepath}')
 
 
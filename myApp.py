@@ -12,8 +12,15 @@ import numpy as np
 import copy
 import sys
 import platform
+import threading
 from functools import partial
 
+from utils.spatial_index import SpatialIndexCache, geometry_points
+from utils.lod import LodPyramid, LOD_VOXEL_SIZES
+from utils.cloud_loader import CloudLoader
+from utils.octree import Octree, OctreeStreamer, OCTREE_INDEX_FILENAME, overlaps
+from utils.cloud_distance import G2GDistance, distance_colors
+
 
 
 
@@ -33,6 +40,18 @@ class SceneMode(Enum):
 isMacOS = (platform.system() == "Darwin")
 logger.info(f'isMacOS: {isMacOS}')
 
+# 降采样滑动条停止拖动多少秒后才切换点云
+DOWNSAMPLE_DEBOUNCE = .2
+
+# 加载过程中预览点云在场景中的名字
+PREVIEW_GEOMETRY_NAME = 'preview'
+
+# 八叉树节点在场景中的名字前缀
+OCTREE_GEOMETRY_PREFIX = 'octree_'
+
+# 相机停止移动多少秒后重新选择八叉树节点
+OCTREE_UPDATE_DEBOUNCE = .2
+
 class App:
     '''
     主程序类
@@ -49,6 +68,8 @@ class App:
     MENU_FILE_SCREENSHOT = 3
     # 退出
     MENU_FILE_QUIT = 4
+    # 取消正在进行的加载
+    MENU_FILE_CANCEL_LOAD = 5
 
     # GEOMETRY
     # 从pcd文件中添加几何体
@@ -128,6 +149,24 @@ class App:
         # 初始化
         gui.Application.instance.initialize(resource_path)
 
+        # 各几何体的KD树缓存，key为几何体idx，选点和G2G距离计算共用
+        self._spatial_index = SpatialIndexCache()
+        # 各点云的LOD金字塔，key为几何体idx，降采样滑动条使用
+        self._lod_pyramids = {}
+        # 降采样滑动条的防抖定时器
+        self._downsample_timer = None
+        # 正在进行的后台加载
+        self._loader = None
+        # 打开的八叉树（比内存大的点云），不为None时场景中只显示视锥内的节点
+        self._octree = None
+        self._octree_streamer = None
+        # 当前需要显示的节点、场景中已显示的节点
+        self._octree_wanted = []
+        self._octree_shown = set()
+        self._octree_timer = None
+        # 正在进行的G2G距离计算
+        self._distance_job = None
+
         # 窗口
         self.window = gui.Application.instance.create_window("myApp", 800, 600)
         w = self.window
@@ -223,6 +262,7 @@ class App:
             # 文件菜单栏
             file_menu = gui.Menu()
             file_menu.add_item("Open...", App.MENU_FILE_OPEN)
+            file_menu.add_item("Cancel Loading", App.MENU_FILE_CANCEL_LOAD)
             file_menu.add_item("Save PCD", App.MENU_FILE_SAVE)
             file_menu.add_separator()
             file_menu.add_item("Scree Shot", App.MENU_FILE_SCREENSHOT)
@@ -301,6 +341,7 @@ class App:
 
             # -----注册菜单栏事件------
             w.set_on_menu_item_activated(App.MENU_FILE_OPEN, self._menu_file_open)
+            w.set_on_menu_item_activated(App.MENU_FILE_CANCEL_LOAD, self._menu_file_cancel_load)
             w.set_on_menu_item_activated(App.MENU_FILE_SAVE, self._menu_file_save)
             w.set_on_menu_item_activated(App.MENU_FILE_SCREENSHOT, self._menu_file_screenshot)
             w.set_on_menu_item_activated(App.MENU_FILE_QUIT, self._menu_file_quit)
@@ -338,37 +379,60 @@ class App:
             line0.add_child(gui.Label('down sample voxel:'))
             slider = gui.Slider(gui.Slider.DOUBLE) # 滑动条
             slider.double_value = 0 # 默认值
-            slider.set_limits(0, 0.5)
+            slider.set_limits(0, max(LOD_VOXEL_SIZES))
             def slider_changed(new_voxel_size: float):
                 '''
-                当滑动条改变时，重新绘制点云
-                注意这里不改变self._geometries[self._active_geometries_idx]中的点云指针
+                当滑动条改变时，停止拖动DOWNSAMPLE_DEBOUNCE秒后切换到最接近的LOD层
+                取层（可能需要等待后台构建）不在UI线程中进行
                 :param new_voxel_size:
                 :return:
                 '''
                 if self._active_geometries_idx < 0:
                     logger.info(f'没有激活的几何体')
                     return
-                logger.info(f'降采样 voxel：{new_voxel_size}')
-                active_geo = self._geometries[self._active_geometries_idx]
-                if new_voxel_size <= 0:
-                    new_geo = active_geo
-                else:
-                    new_geo = active_geo.voxel_down_sample(new_voxel_size)
-                # self._geometries[self._active_geometries_idx] = new_geo
-                # logger.info(f'移除...')
-                self._scene.scene.remove_geometry(str(self._active_geometries_idx))
-                # logger.info(f'再增加')
-                material = rendering.MaterialRecord()
-                material.sRGB_color = True
-                self._scene.scene.add_geometry(str(self._active_geometries_idx), new_geo, material)
-                # voxel_label.text = new_voxel_size
-                pass
+                if self._downsample_timer is not None:
+                    self._downsample_timer.cancel()
+                self._downsample_timer = threading.Timer(
+                    DOWNSAMPLE_DEBOUNCE, self._apply_downsample, (self._active_geometries_idx, new_voxel_size, slider))
+                self._downsample_timer.daemon = True
+                self._downsample_timer.start()
             slider.set_on_value_changed(slider_changed)
             line0.add_child(slider)
             attribute_panel.add_child(line0)
             self._attribute_panel_proxy.set_widget(attribute_panel)
 
+    def _apply_downsample(self, geometry_idx, voxel_size, slider):
+        '''
+        在防抖定时器线程中取得LOD层，再回到主线程重新绘制点云
+        注意这里不改变self._geometries[geometry_idx]中的点云指针
+        :param geometry_idx:
+        :param voxel_size: 滑动条的值
+        :param slider: 吸附到LOD层后更新其显示的值
+        :return:
+        '''
+        pyramid = self._lod_pyramids.get(geometry_idx)
+        if pyramid is None:
+            return
+        level = pyramid.snap(voxel_size)
+        new_geo = pyramid.get(level)
+        if new_geo is None:
+            return
+        logger.info(f'降采样 voxel：{level}，点数：{len(new_geo.points)}')
+
+        def redraw():
+            if self._lod_pyramids.get(geometry_idx) is not pyramid:
+                # 等待期间几何体已被移除
+                return
+            slider.double_value = level
+            self._scene.scene.remove_geometry(str(geometry_idx))
+            material = rendering.MaterialRecord()
+            material.sRGB_color = True
+            self._scene.scene.add_geometry(str(geometry_idx), new_geo, material)
+            self._scene.scene.show_geometry(str(geometry_idx), self._geometries_shown[geometry_idx])
+            self._scene.force_redraw()
+
+        gui.Application.instance.post_to_main_thread(self.window, redraw)
+
     def _menu_show_rightside_panel(self):
         '''
         显示or隐藏右侧面板
@@ -451,7 +515,127 @@ class App:
         pass
 
     def _menu_calcu_distance_g2g(self):
-        pass
+        '''
+        计算源几何体到目标几何体的距离（最小值、平均值、百分位数，双向的Hausdorff距离）
+        在后台线程中使用已缓存的KD树查询，先显示抽样预览，可选按距离给源几何体着色
+        :return:
+        '''
+        geometry_idx_list = [i for i, geo in enumerate(self._geometries) if geo is not None]
+        if len(geometry_idx_list) < 2:
+            logger.info(f'至少要加载两个几何体')
+            return
+        lines = gui.Vert()
+        line1 = gui.Horiz()
+        line1.add_child(gui.Label('source geometry: '))
+        combobox1 = gui.Combobox()
+        for i in geometry_idx_list:
+            combobox1.add_item(f'{i}')
+        if self._active_geometries_idx in geometry_idx_list:
+            combobox1.selected_index = geometry_idx_list.index(self._active_geometries_idx)
+        line1.add_child(combobox1)
+
+        line2 = gui.Horiz()
+        line2.add_child(gui.Label('target geometry: '))
+        combobox2 = gui.Combobox()
+        for i in geometry_idx_list:
+            combobox2.add_item(f'{i}')
+        combobox2.selected_index = 1 if combobox1.selected_index == 0 else 0
+        line2.add_child(combobox2)
+
+        colormap_checkbox = gui.Checkbox('color source by distance')
+        distance_res_label = gui.Label('-------------')
+
+        def format_result(result, preview):
+            percentiles = ', '.join(f'p{p}: {d:.4f}' for p, d in result['percentiles'].items())
+            title = f'preview ({result["num_points"]} points)' if preview else f'{result["num_points"]} points'
+            return (f'{title}\nmin: {result["min"]:.4f}  mean: {result["mean"]:.4f}  '
+                    f'hausdorff: {result["hausdorff"]:.4f}\n{percentiles}')
+
+        def update_label(job, text):
+            if self._distance_job is not job:
+                # 已取消或已开始新的计算
+                return
+            distance_res_label.text = text
+            self.window.set_needs_layout()
+
+        def on_done(job, source_idx, colormap, result):
+            if self._distance_job is not job:
+                return
+            update_label(job, format_result(result, False))
+            self._distance_job = None
+            if colormap:
+                self._show_distance_colormap(source_idx, result['distances'])
+
+        def calcu_clicked():
+            source_idx = geometry_idx_list[combobox1.selected_index]
+            target_idx = geometry_idx_list[combobox2.selected_index]
+            if source_idx == target_idx:
+                distance_res_label.text = 'select two different geometries'
+                return
+            if self._distance_job is not None:
+                self._distance_job.cancel()
+            # 回调在计算线程中调用，转到主线程更新界面
+            post = partial(gui.Application.instance.post_to_main_thread, self.window)
+            colormap = colormap_checkbox.checked
+            job = G2GDistance(self._spatial_index, source_idx, self._geometries[source_idx],
+                              target_idx, self._geometries[target_idx])
+            job.on_preview = lambda result: post(partial(update_label, job, format_result(result, True)))
+            job.on_progress = lambda fraction, message: post(partial(update_label, job, f'{message} ({fraction:.0%})'))
+            job.on_done = lambda result: post(partial(on_done, job, source_idx, colormap, result))
+            job.on_error = lambda e: post(partial(update_label, job, f'failed: {e}'))
+            self._distance_job = job
+            distance_res_label.text = 'computing ...'
+            job.start()
+
+        calcu_button = gui.Button('Calcu')
+        calcu_button.set_on_clicked(calcu_clicked)
+
+        def cancel_clicked():
+            if self._distance_job is not None:
+                self._distance_job.cancel()
+                self._distance_job = None
+            self.window.close_dialog()
+
+        cancel_button = gui.Button('Cancel')
+        cancel_button.set_on_clicked(cancel_clicked)
+
+        line3 = gui.Horiz()
+        line3.add_child(calcu_button)
+        line3.add_child(cancel_button)
+        distance_dialog = gui.Dialog('select 2 geometries')
+
+        lines.add_child(line1)
+        lines.add_child(line2)
+        lines.add_child(colormap_checkbox)
+        lines.add_child(distance_res_label)
+        lines.add_child(line3)
+        distance_dialog.add_child(lines)
+        self.window.show_dialog(distance_dialog)
+
+    def _show_distance_colormap(self, geometry_idx, distances):
+        '''
+        用按距离着色的副本替换场景中的几何体，由近到远依次为蓝、绿、红
+        注意这里不改变self._geometries[geometry_idx]中的点云指针，KD树和LOD金字塔仍然有效
+        :param geometry_idx:
+        :param distances: 几何体各点的距离
+        :return:
+        '''
+        geo = self._geometries[geometry_idx]
+        if geo is None or len(geometry_points(geo)) != len(distances):
+            # 计算期间几何体已被移除
+            return
+        colored = copy.deepcopy(geo)
+        colors = o3d.utility.Vector3dVector(distance_colors(distances))
+        if isinstance(colored, o3d.geometry.TriangleMesh):
+            colored.vertex_colors = colors
+        else:
+            colored.colors = colors
+        self._scene.scene.remove_geometry(str(geometry_idx))
+        material = rendering.MaterialRecord()
+        material.sRGB_color = True
+        self._scene.scene.add_geometry(str(geometry_idx), colored, material)
+        self._scene.scene.show_geometry(str(geometry_idx), self._geometries_shown[geometry_idx])
+        self._scene.force_redraw()
 
     @staticmethod
     def cal_distance_p2p(p1: np.ndarray, p2: np.ndarray):
@@ -618,6 +802,7 @@ class App:
         # 文件类型过滤
         # file_picker.add_filter('.obj', 'obj model files')
         file_picker.add_filter('.pcd', 'Point Cloud Data Files')
+        file_picker.add_filter('.json', f'Octree Index ({OCTREE_INDEX_FILENAME})')
         # file_picker.add_filter('', 'All files')
 
         # 初始文件路径
@@ -675,6 +860,14 @@ class App:
         # 激活的几何体name
         self._active_geometries_idx = -1
         self._next_idx = 0
+        if self._distance_job is not None:
+            self._distance_job.cancel()
+            self._distance_job = None
+        self._spatial_index.clear()
+        self.close_octree()
+        for pyramid in self._lod_pyramids.values():
+            pyramid.cancel()
+        self._lod_pyramids = {}
         self._scene.scene.clear_geometry()
 
 
@@ -740,6 +933,9 @@ class App:
                 logger.info(f'不能移除活动状态下的几何体')
                 return gui.Button.IGNORED
             self._geometries[geometry_idx] = None
+            self._spatial_index.invalidate(geometry_idx)
+            if geometry_idx in self._lod_pyramids:
+                self._lod_pyramids.pop(geometry_idx).cancel()
             self._scene.scene.remove_geometry(str(geometry_idx))
             self.refresh_geometries_list()
 
@@ -787,6 +983,13 @@ class App:
         self._geometries.append(geometry)
         self._geometries_shown.append(True)
         self._scene.scene.add_geometry(str(self._next_idx), geometry, material)
+        # 后台构建KD树，选点时直接查询
+        self._spatial_index.build_async(self._next_idx, geometry)
+        if isinstance(geometry, o3d.geometry.PointCloud):
+            # 后台构建降采样滑动条使用的LOD金字塔
+            pyramid = LodPyramid(geometry)
+            self._lod_pyramids[self._next_idx] = pyramid
+            pyramid.build_async()
         self._active_geometries_idx = self._next_idx
         self._next_idx += 1
         self.refresh_attribute_panel()
@@ -798,21 +1001,186 @@ class App:
 
     def load(self, filepath):
         '''
-        加载pcd文件到场景中
+        在后台线程中加载pcd文件到场景中：先显示抽样预览，读取完成后替换为完整点云
+        进度显示在左下角，加载过程中可通过 File -> Cancel Loading 取消
         :param filepath:
         :return:
         '''
         logger.info(f'open filename: {filepath}')
+        if self._loader is not None:
+            self._loader.cancel()
         logger.info(f'clear previous geometries')
         # 清空之前的几何体
         self.clear_all_geometries()
+        if osp.basename(filepath) == OCTREE_INDEX_FILENAME:
+            self._loader = None
+            self.open_octree(filepath)
+            return
+
+        # 回调在加载线程中调用，转到主线程更新界面
+        post = partial(gui.Application.instance.post_to_main_thread, self.window)
+        loader = CloudLoader(filepath)
+        loader.on_preview = lambda pcd: post(partial(self._on_load_preview, loader, pcd))
+        loader.on_progress = lambda fraction, message: post(partial(self._on_load_progress, loader, fraction, message))
+        loader.on_done = lambda pcd: post(partial(self._on_load_done, loader, pcd))
+        loader.on_error = lambda e: post(partial(self._on_load_error, loader, e))
+        self._loader = loader
+        self._show_info(f'loading {osp.basename(filepath)} ...')
+        loader.start()
+
+    def open_octree(self, index_filepath):
+        '''
+        打开分块八叉树（utils/octree.py，由convert_pcd_to_octree.py生成）：
+        只读取当前视锥内、与相机距离相称的节点，相机移动后重新选择，其余节点按LRU淘汰
+        八叉树不加入几何体列表，不能选点
+        :param index_filepath: octree.json的路径
+        :return:
+        '''
+        try:
+            octree = Octree.load(index_filepath)
+        except (OSError, ValueError) as e:
+            logger.error(f'八叉树读取失败：{index_filepath}，{e}')
+            self._show_info(f'failed to open octree: {e}')
+            return
+        logger.info(f'打开八叉树：{index_filepath}，点数：{octree.num_points}，节点数：{len(octree.nodes)}')
+        self._octree = octree
+        post = partial(gui.Application.instance.post_to_main_thread, self.window)
+        self._octree_streamer = OctreeStreamer(octree, on_loaded=lambda key: post(self._refresh_octree_scene))
+        lo, hi = octree.bounds()
+        bounds = o3d.geometry.AxisAlignedBoundingBox(lo, hi)
+        self._scene.setup_camera(60, bounds, bounds.get_center())
+        self._update_octree_view()
+
+    def close_octree(self):
+        if self._octree_streamer is not None:
+            self._octree_streamer.close()
+        if self._octree_timer is not None:
+            self._octree_timer.cancel()
+        for key in self._octree_shown:
+            self._scene.scene.remove_geometry(OCTREE_GEOMETRY_PREFIX + key)
+        self._octree = None
+        self._octree_streamer = None
+        self._octree_wanted = []
+        self._octree_shown = set()
+        self._octree_timer = None
+
+    def _schedule_octree_update(self):
+        '''
+        相机停止移动OCTREE_UPDATE_DEBOUNCE秒后在主线程中重新选择节点
+        '''
+        if self._octree_timer is not None:
+            self._octree_timer.cancel()
+        post = partial(gui.Application.instance.post_to_main_thread, self.window, self._update_octree_view)
+        self._octree_timer = threading.Timer(OCTREE_UPDATE_DEBOUNCE, post)
+        self._octree_timer.daemon = True
+        self._octree_timer.start()
+
+    def _update_octree_view(self):
+        '''
+        按当前相机选择需要显示的节点，交给后台线程读取
+        '''
+        if self._octree is None:
+            return
+        camera = self._scene.scene.camera
+        self._octree_wanted = self._octree.select(camera.get_view_matrix(), camera.get_projection_matrix(),
+                                                  self._scene.frame.height)
+        self._octree_streamer.request(self._octree_wanted)
+        self._refresh_octree_scene()
+
+    def _refresh_octree_scene(self):
+        '''
+        把已读取的需要显示的节点加入场景；不再需要的节点等与其重叠的新节点都读取完成后再移除，避免出现空洞
+        '''
+        if self._octree is None:
+            return
+        material = rendering.MaterialRecord()
+        material.sRGB_color = True
+        loaded = 0
+        for key in self._octree_wanted:
+            points = self._octree_streamer.get(key)
+            if points is None:
+                continue
+            loaded += 1
+            if key not in self._octree_shown:
+                pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+                self._scene.scene.add_geometry(OCTREE_GEOMETRY_PREFIX + key, pcd, material)
+                self._octree_shown.add(key)
+        wanted = set(self._octree_wanted)
+        for key in list(self._octree_shown - wanted):
+            if all(self._octree_streamer.is_cached(other) for other in wanted if overlaps(key, other)):
+                self._scene.scene.remove_geometry(OCTREE_GEOMETRY_PREFIX + key)
+                self._octree_shown.remove(key)
+        self._show_info(f'octree: {loaded}/{len(self._octree_wanted)} nodes' if loaded < len(self._octree_wanted)
+                        else '')
+        self._scene.force_redraw()
+
+    def _is_current_loader(self, loader):
+        return loader is self._loader and not loader.cancelled
+
+    def _show_info(self, text):
+        '''
+        在左下角显示提示信息，text为空时隐藏
+        '''
+        self._info.text = text
+        self._info.visible = (text != "")
+        self.window.set_needs_layout()
 
-        # 读取模型文件
-        geometry: o3d.geometry.PointCloud = o3d.io.read_point_cloud(filepath)
+    def _remove_preview(self):
+        if self._scene.scene.has_geometry(PREVIEW_GEOMETRY_NAME):
+            self._scene.scene.remove_geometry(PREVIEW_GEOMETRY_NAME)
 
+    def _on_load_preview(self, loader, pcd):
+        '''
+        显示抽样预览，预览不加入几何体列表，不能选点
+        '''
+        if not self._is_current_loader(loader):
+            return
+        bounds = pcd.get_axis_aligned_bounding_box()
+        self._scene.setup_camera(60, bounds, bounds.get_center())
+        material = rendering.MaterialRecord()
+        material.sRGB_color = True
+        self._scene.scene.add_geometry(PREVIEW_GEOMETRY_NAME, pcd, material)
+        self._scene.force_redraw()
+
+    def _on_load_progress(self, loader, fraction, message):
+        if not self._is_current_loader(loader):
+            return
+        self._show_info(f'{osp.basename(loader.filepath)}: {message} ({fraction:.0%})')
+
+    def _on_load_done(self, loader, geometry):
+        if not self._is_current_loader(loader):
+            return
+        self._loader = None
+        self._remove_preview()
+        self._show_info("")
         logger.info(f'add a geometry idx : {self._next_idx}')
         self.add_a_geometry(geometry)
 
+    def _on_load_error(self, loader, e):
+        if not self._is_current_loader(loader):
+            return
+        self._loader = None
+        self._remove_preview()
+        self._show_info(f'failed to load {osp.basename(loader.filepath)}: {e}')
+
+    def _menu_file_cancel_load(self):
+        '''
+        取消正在进行的加载
+        :return:
+        '''
+        if self._loader is None:
+            logger.info(f'没有正在进行的加载')
+            return
+        logger.info(f'取消加载：{self._loader.filepath}')
+        if self._loader.interruptible is False:
+            # open3d一次性读取的格式无法中断，后台读取完成后结果被丢弃
+            logger.info(f'{self._loader.filepath} 的读取无法中断，完成后丢弃')
+        self._loader.cancel()
+        self._loader = None
+        self._remove_preview()
+        self._show_info("")
+        self._scene.force_redraw()
+
 
     # 切换显示模型
     # def _menu_show(self):
@@ -858,16 +1226,18 @@ class App:
     def run(self):
         gui.Application.instance.run()
 
-    def _calc_prefer_indicate(self, geo, point):
+    def _calc_prefer_indicate(self, geo, point, geometry_idx=None):
         '''
         根据世界坐标搜索点云坐标，返回在选中点在点云中的索引值
+        使用add_a_geometry时在后台构建的KD树，构建尚未完成时等待
         :param self:
         :param point:
+        :param geometry_idx: 几何体idx，为None时使用激活的几何体
         :return:
         '''
-        pcd_tree = o3d.geometry.KDTreeFlann(geo)
-        [k, picked_idx, _] = pcd_tree.search_knn_vector_3d(point, 1)
-        return picked_idx[-1]
+        if geometry_idx is None:
+            geometry_idx = self._active_geometries_idx
+        return self._spatial_index.search_nearest(geometry_idx, geo, point)
 
     def _mouse_event(self, event):
         '''
@@ -884,7 +1254,8 @@ class App:
                 return gui.Widget.EventCallbackResult.IGNORED
 
             # 获得操作对象
-            geo = self._geometries[self._active_geometries_idx]
+            geometry_idx = self._active_geometries_idx
+            geo = self._geometries[geometry_idx]
             assert geo
             logger.info(f'选点...')
 
@@ -904,7 +1275,7 @@ class App:
 
                     text = "({:.3f}, {:.3f}, {:.3f})".format(world[0], world[1], world[2])
 
-                    idx = self._calc_prefer_indicate(geo, world)
+                    idx = self._calc_prefer_indicate(geo, world, geometry_idx)
                     true_point = np.asarray(geo.points)[idx]
 
                     self._pick_num += 1
@@ -951,6 +1322,10 @@ class App:
             else:
                 logger.info("Undo no point!")
             return gui.Widget.EventCallbackResult.HANDLED
+        if self._octree is not None and event.type in (gui.MouseEvent.Type.DRAG, gui.MouseEvent.Type.WHEEL,
+                                                       gui.MouseEvent.Type.BUTTON_UP):
+            # 相机可能已改变，停止移动后重新选择八叉树节点；事件仍交给默认的相机控制处理
+            self._schedule_octree_update()
         return gui.Widget.EventCallbackResult.IGNORED
 
 
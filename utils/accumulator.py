@@ -0,0 +1,208 @@
+import numpy as np
+
+from utils.cloud_utils import concat_attributes
+
+
+class PointAccumulator:
+    '''
+    点云累加器：收集每一帧的点和属性，最后一次性拼接
+    代替 target_point_cloud += pcd，避免每加一帧都重新分配并复制已累加的全部点
+    '''
+
+    def __init__(self):
+        # 每一帧的点 (N_i, 3)
+        self._points = []
+        # 每一帧的属性 {字段名: (N_i,)数组}
+        self._attributes = []
+        self.num_points = 0
+
+    def __len__(self):
+        return self.num_points
+
+    def add(self, points: np.ndarray, attributes: dict = None):
+        '''
+        加入一帧
+        :param points: (N, 3)
+        :param attributes: {字段名: (N,)数组}
+        :return:
+        '''
+        self._points.append(np.asarray(points, dtype=np.float64).reshape(-1, 3))
+        self._attributes.append(attributes if attributes is not None else {})
+        self.num_points += len(self._points[-1])
+
+    def build(self):
+        '''
+        按累计点数预分配结果数组，逐帧复制后释放该帧，峰值内存约为结果大小加一帧
+        调用后累加器被清空
+        :return: (N, 3)坐标, {字段名: (N,)数组}
+        '''
+        attributes = concat_attributes(self._attributes)
+        self._attributes = []
+        points = np.empty((self.num_points, 3), dtype=np.float64)
+        start = 0
+        self._points.reverse()
+        while self._points:
+            chunk = self._points.pop()
+            points[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        self.num_points = 0
+        return points, attributes
+
+
+# 体素坐标编码为int64：每个轴21位，相对原点体素的坐标绝对值需小于2^20
+VOXEL_KEY_BITS = 21
+VOXEL_KEY_OFFSET = 1 << (VOXEL_KEY_BITS - 1)
+
+
+class VoxelAccumulator:
+    '''
+    增量体素累加器：边累加边降采样
+    以整数体素坐标为键，每个体素保存点坐标之和与点数（结果取质心），
+    浮点属性（intensity、time）保存和（结果取均值），其他属性（ring）保存第一个点的值。
+    体素坐标相对第一帧中心所在的体素编码，因此UTM等大坐标的地图也可以累加。
+    内存占用取决于地图中的体素数，而不是帧数
+    '''
+
+    def __init__(self, voxel_size: float, compact_ratio: float = .25, min_compact: int = 1 << 20):
+        '''
+        :param voxel_size: 体素大小
+        :param compact_ratio: 新体素的缓存数量超过已有体素数的该比例时合并
+        :param min_compact: 新体素的缓存数量至少达到该值才合并
+        '''
+        if voxel_size <= 0:
+            raise ValueError(f'体素大小必须大于0：{voxel_size}')
+        self.voxel_size = voxel_size
+        self.compact_ratio = compact_ratio
+        self.min_compact = min_compact
+        # 已合并的体素，按键升序
+        self._keys = np.empty(0, dtype=np.int64)
+        self._sums = np.empty((0, 3), dtype=np.float64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._attributes = {}
+        # 属性名 -> 原始dtype
+        self._attribute_dtypes = None
+        # 编码体素坐标时的原点体素，取第一帧的中心
+        self._origin = None
+        # 尚未合并的新体素：[(键, 坐标和, 点数, 属性), ...]
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self):
+        self._compact()
+        return len(self._keys)
+
+    def _is_mean(self, name):
+        dtype = self._attribute_dtypes[name]
+        return dtype.kind == 'f'
+
+    def _voxel_keys(self, points):
+        coords = np.floor(points / self.voxel_size).astype(np.int64)
+        if self._origin is None:
+            self._origin = (coords.min(axis=0) + coords.max(axis=0)) // 2
+        coords -= self._origin
+        if np.abs(coords).max() >= VOXEL_KEY_OFFSET:
+            raise ValueError(f'点云范围超出体素编码范围：距第一帧±{VOXEL_KEY_OFFSET * self.voxel_size}')
+        coords += VOXEL_KEY_OFFSET
+        return (coords[:, 0] << (2 * VOXEL_KEY_BITS)) | (coords[:, 1] << VOXEL_KEY_BITS) | coords[:, 2]
+
+    def _restrict_attributes(self, names):
+        '''
+        只保留所有帧都有的属性（与concat_attributes一致）
+        '''
+        dropped = [name for name in self._attribute_dtypes if name not in names]
+        for name in dropped:
+            del self._attribute_dtypes[name]
+            self._attributes.pop(name, None)
+            for _, _, _, attributes in self._pending:
+                attributes.pop(name, None)
+
+    def add(self, points: np.ndarray, attributes: dict = None):
+        '''
+        加入一帧（已变换到地图坐标系）
+        :param points: (N, 3)
+        :param attributes: {字段名: (N,)数组}
+        :return:
+        '''
+        attributes = {name: values for name, values in (attributes or {}).items() if np.ndim(values) == 1}
+        if self._attribute_dtypes is None:
+            self._attribute_dtypes = {name: values.dtype for name, values in attributes.items()}
+            self._attributes = {name: np.empty(0, dtype=np.float64 if self._is_mean(name) else values.dtype)
+                                for name, values in attributes.items()}
+        else:
+            self._restrict_attributes(attributes)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        finite = np.isfinite(points).all(axis=1)
+        points = points[finite]
+        if len(points) == 0:
+            return
+
+        # 帧内先按体素归并
+        keys, first, inverse, counts = np.unique(self._voxel_keys(points), return_index=True,
+                                                 return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        sums = np.column_stack([np.bincount(inverse, weights=points[:, i], minlength=len(keys)) for i in range(3)])
+        frame_attributes = {}
+        for name in self._attribute_dtypes:
+            values = attributes[name][finite]
+            if self._is_mean(name):
+                frame_attributes[name] = np.bincount(inverse, weights=values, minlength=len(keys))
+            else:
+                frame_attributes[name] = values[first]
+
+        # 已有体素直接累加
+        pos = np.searchsorted(self._keys, keys)
+        found = pos < len(self._keys)
+        found[found] = self._keys[pos[found]] == keys[found]
+        hit = pos[found]
+        self._sums[hit] += sums[found]
+        self._counts[hit] += counts[found]
+        for name, values in frame_attributes.items():
+            if self._is_mean(name):
+                self._attributes[name][hit] += values[found]
+
+        # 新体素先缓存，攒够一批再合并，避免每帧都重排全部体素
+        new = ~found
+        if new.any():
+            self._pending.append((keys[new], sums[new], counts[new],
+                                  {name: values[new] for name, values in frame_attributes.items()}))
+            self._pending_size += int(new.sum())
+            if self._pending_size >= max(self.min_compact, self.compact_ratio * len(self._keys)):
+                self._compact()
+
+    def _compact(self):
+        '''
+        将缓存的新体素合并进已有体素
+        '''
+        if not self._pending:
+            return
+        keys = np.concatenate([self._keys] + [pending[0] for pending in self._pending])
+        sums = np.concatenate([self._sums] + [pending[1] for pending in self._pending])
+        counts = np.concatenate([self._counts] + [pending[2] for pending in self._pending])
+        attributes = {name: np.concatenate([self._attributes[name]] + [pending[3][name] for pending in self._pending])
+                      for name in self._attribute_dtypes}
+        self._pending = []
+        self._pending_size = 0
+
+        # 已有体素排在前面，return_index得到的是最早的体素
+        self._keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        num = len(self._keys)
+        self._sums = np.column_stack([np.bincount(inverse, weights=sums[:, i], minlength=num) for i in range(3)])
+        self._counts = np.bincount(inverse, weights=counts, minlength=num).astype(np.int64)
+        for name, values in attributes.items():
+            if self._is_mean(name):
+                self._attributes[name] = np.bincount(inverse, weights=values, minlength=num)
+            else:
+                self._attributes[name] = values[first]
+
+    def build(self):
+        '''
+        :return: (M, 3)体素质心, {字段名: (M,)数组}
+        '''
+        self._compact()
+        points = self._sums / self._counts[:, None]
+        attributes = {}
+        for name, dtype in (self._attribute_dtypes or {}).items():
+            values = self._attributes[name]
+            attributes[name] = (values / self._counts).astype(dtype) if self._is_mean(name) else values
+        return points, attributes
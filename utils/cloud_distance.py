@@ -0,0 +1,196 @@
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+from scipy.spatial import cKDTree
+
+from utils.spatial_index import geometry_points
+
+
+# 统计的距离百分位数
+DISTANCE_PERCENTILES = (50, 90, 95, 99)
+
+# 预览时从每个几何体中抽取的查询点数
+DISTANCE_PREVIEW_POINTS = 100000
+
+# 每批查询的点数，两批之间检查是否已取消并报告进度
+DISTANCE_BATCH_SIZE = 1 << 18
+
+# 颜色映射的上限取源几何体距离的该百分位数，避免少数离群点把其他点都压成同一种颜色
+COLORMAP_PERCENTILE = 95
+
+
+class DistanceCancelled(Exception):
+    pass
+
+
+def nearest_distances(tree: cKDTree, points: np.ndarray, batch_size: int = DISTANCE_BATCH_SIZE, on_batch=None):
+    '''
+    查询每个点到KD树中最近点的距离：每批一次多线程批量查询，每批之后调用on_batch(已查询的点数)，可在其中检查取消
+    :param tree: SpatialIndexCache中的KD树
+    :param points: (N, 3)
+    :param batch_size:
+    :param on_batch:
+    :return: (N,) 距离
+    '''
+    distances = np.empty(len(points), dtype=np.float64)
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        distances[start:start + len(batch)] = tree.query(batch, k=1, workers=-1)[0]
+        if on_batch is not None:
+            on_batch(start + len(batch))
+    return distances
+
+
+def distance_statistics(distances: np.ndarray, percentiles=DISTANCE_PERCENTILES):
+    '''
+    :param distances: (N,) 距离
+    :param percentiles:
+    :return: {'min', 'mean', 'max', 'percentiles': {百分位: 距离}}
+    '''
+    return {'min': float(distances.min()), 'mean': float(distances.mean()), 'max': float(distances.max()),
+            'percentiles': dict(zip(percentiles, np.percentile(distances, percentiles).tolist()))}
+
+
+def distance_colors(distances: np.ndarray, max_distance: float = None):
+    '''
+    距离 -> 颜色，由近到远依次为蓝、绿、红
+    :param distances: (N,) 距离
+    :param max_distance: 映射为红色的距离，默认取COLORMAP_PERCENTILE百分位数
+    :return: (N, 3) 0~1的rgb
+    '''
+    if max_distance is None:
+        max_distance = np.percentile(distances, COLORMAP_PERCENTILE) if len(distances) else 0
+    t = np.clip(distances / max_distance, 0, 1) if max_distance > 0 else np.zeros(len(distances))
+    stops = [0, .5, 1]
+    return np.stack([np.interp(t, stops, [0, 0, 1]), np.interp(t, stops, [0, 1, 0]),
+                     np.interp(t, stops, [1, 0, 0])], axis=1)
+
+
+class G2GDistance:
+    '''
+    在后台线程中计算两个几何体之间的距离：
+    源几何体每个点到目标几何体最近点的距离的最小值、平均值、百分位数，以及双向的Hausdorff距离
+    KD树取自选点共用的SpatialIndexCache，每个几何体只构建一次，
+    先抽样查询给出预览，再分批查询全部点
+    回调在计算线程中调用，更新界面时需要post_to_main_thread
+    '''
+
+    def __init__(self, index_cache, source_key, source, target_key, target, on_preview=None, on_progress=None,
+                 on_done=None, on_error=None, preview_points: int = DISTANCE_PREVIEW_POINTS,
+                 batch_size: int = DISTANCE_BATCH_SIZE):
+        '''
+        :param index_cache: SpatialIndexCache
+        :param source_key: 源几何体id
+        :param source:
+        :param target_key: 目标几何体id
+        :param target:
+        :param on_preview: on_preview(结果)，抽样结果，Hausdorff距离为下界
+        :param on_progress: on_progress(已查询的比例 0~1, 说明)
+        :param on_done: on_done(结果)，结果见_result()
+        :param on_error: on_error(异常)，计算失败时调用；取消时不调用
+        :param preview_points: 预览时每个几何体抽取的点数，两个几何体都不超过该点数时不做预览
+        :param batch_size: 每批查询的点数
+        '''
+        self.index_cache = index_cache
+        self.source_key = source_key
+        self.source = source
+        self.target_key = target_key
+        self.target = target
+        self.on_preview = on_preview
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.preview_points = preview_points
+        self.batch_size = batch_size
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _check_cancelled(self):
+        if self.cancelled:
+            raise DistanceCancelled()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            result = self._compute()
+            self._check_cancelled()
+        except DistanceCancelled:
+            logger.info(f'已取消几何体 {self.source_key} 到 {self.target_key} 的距离计算')
+            return
+        except Exception as e:
+            logger.error(f'几何体 {self.source_key} 到 {self.target_key} 的距离计算失败：{e}')
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        logger.info(f'几何体 {self.source_key} 到 {self.target_key} 的距离：min {result["min"]:.4f}，'
+                    f'mean {result["mean"]:.4f}，hausdorff {result["hausdorff"]:.4f}，'
+                    f'耗时：{time.perf_counter() - start:.1f}s')
+        if self.on_done is not None:
+            self.on_done(result)
+
+    def _compute(self):
+        source_points = geometry_points(self.source)
+        target_points = geometry_points(self.target)
+        if len(source_points) == 0 or len(target_points) == 0:
+            raise ValueError('几何体没有点')
+        self._progress(0, 'waiting for KD-trees ...')
+        source_tree = self.index_cache.get(self.source_key, self.source)
+        target_tree = self.index_cache.get(self.target_key, self.target)
+        self._check_cancelled()
+
+        if self.on_preview is not None and max(len(source_points), len(target_points)) > self.preview_points:
+            rng = np.random.default_rng(0)
+            source_index = self._subsample(rng, len(source_points))
+            target_index = self._subsample(rng, len(target_points))
+            forward = nearest_distances(target_tree, source_points[source_index], self.batch_size,
+                                        lambda n: self._check_cancelled())
+            backward = nearest_distances(source_tree, target_points[target_index], self.batch_size,
+                                         lambda n: self._check_cancelled())
+            self.on_preview(self._result(forward, backward, source_index))
+
+        total = len(source_points) + len(target_points)
+        forward = nearest_distances(target_tree, source_points, self.batch_size,
+                                    lambda n: self._batch_done(n, total))
+        backward = nearest_distances(source_tree, target_points, self.batch_size,
+                                     lambda n: self._batch_done(len(source_points) + n, total))
+        return self._result(forward, backward)
+
+    def _subsample(self, rng, num_points: int):
+        if num_points <= self.preview_points:
+            return np.arange(num_points)
+        return np.sort(rng.choice(num_points, self.preview_points, replace=False))
+
+    def _batch_done(self, queried: int, total: int):
+        self._check_cancelled()
+        self._progress(queried / total, f'querying {queried}/{total} points')
+
+    def _progress(self, fraction: float, message: str):
+        if self.on_progress is not None:
+            self.on_progress(fraction, message)
+
+    @staticmethod
+    def _result(forward: np.ndarray, backward: np.ndarray, source_index: np.ndarray = None):
+        '''
+        :param forward: 源几何体各点到目标几何体的距离
+        :param backward: 目标几何体各点到源几何体的距离
+        :param source_index: 抽样时forward对应的源几何体点的索引，全部点时为None
+        :return: distance_statistics(forward)，以及hausdorff、num_points、distances（即forward）、source_index
+        '''
+        result = distance_statistics(forward)
+        result.update(hausdorff=max(result['max'], float(backward.max())), num_points=len(forward),
+                      distances=forward, source_index=source_index)
+        return result
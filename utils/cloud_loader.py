@@ -0,0 +1,185 @@
+import io
+import itertools
+import os.path as osp
+import threading
+import time
+
+import numpy as np
+import open3d as o3d
+from loguru import logger
+
+from utils.pc2_utils import structured_to_xyz
+from utils.pcd_utils import read_pcd_layout
+
+
+# 每次读取的点数，两次读取之间检查是否已取消并报告进度
+LOAD_CHUNK_SIZE = 1 << 20
+
+# 预览的点数
+PREVIEW_POINTS = 200000
+
+# 预览从文件中均匀分布的多少段连续数据中抽取，每段一次seek，避免逐点跳读整个文件
+PREVIEW_BLOCKS = 64
+
+# open3d读取时才能保留的字段（颜色、法向量），含有这些字段的pcd交给open3d读取
+_OPEN3D_FIELDS = ('rgb', 'rgba', 'normal_x')
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+class CloudLoader:
+    '''
+    在后台线程中加载点云，回调在加载线程中调用，更新界面时需要post_to_main_thread
+    - binary编码的pcd（bag2pcd的合并结果）：先给出整个文件均匀抽样的预览，再分块读取，可报告进度、随时取消
+    - ascii编码的pcd：逐块解析文本，可报告进度、随时取消，预览为文件开头的一块（文本无法按点跳读）
+    - binary_compressed编码、含颜色或法向量的pcd及其他格式：交给open3d一次性读取，没有预览，读取过程中无法中断，
+      取消后读取完成的结果被丢弃（interruptible为False，进度信息中会注明）
+    '''
+
+    def __init__(self, filepath: str, on_preview=None, on_progress=None, on_done=None, on_error=None,
+                 chunk_size: int = LOAD_CHUNK_SIZE, preview_points: int = PREVIEW_POINTS):
+        '''
+        :param filepath:
+        :param on_preview: on_preview(PointCloud)，预览可用时调用
+        :param on_progress: on_progress(已读取的比例 0~1, 说明)
+        :param on_done: on_done(PointCloud)，完整点云读取完成时调用
+        :param on_error: on_error(异常)，读取失败时调用；取消时不调用
+        :param chunk_size: 每次读取的点数
+        :param preview_points: 预览的点数
+        '''
+        self.filepath = filepath
+        self.on_preview = on_preview
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.chunk_size = chunk_size
+        self.preview_points = preview_points
+        self._cancelled = threading.Event()
+        self._thread = None
+        # 读取过程中能否中断，确定读取方式后设置，之前为None
+        self.interruptible = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _check_cancelled(self):
+        if self.cancelled:
+            raise LoadCancelled(self.filepath)
+
+    def _progress(self, fraction: float, message: str):
+        if self.on_progress is not None:
+            self.on_progress(fraction, message)
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            pcd = self._load()
+            self._check_cancelled()
+        except LoadCancelled:
+            logger.info(f'已取消加载：{self.filepath}')
+            return
+        except Exception as e:
+            logger.error(f'加载失败：{self.filepath}，{e}')
+            if self.on_error is not None:
+                self.on_error(e)
+            return
+        logger.info(f'加载完成：{self.filepath}，点数：{len(pcd.points)}，耗时：{time.perf_counter() - start:.1f}s')
+        if self.on_done is not None:
+            self.on_done(pcd)
+
+    def _load(self):
+        layout = self._pcd_layout()
+        encoding = layout[0] if layout is not None else None
+        self.interruptible = encoding in ('binary', 'ascii')
+        if encoding == 'binary':
+            return self._load_binary(*layout[1:])
+        if encoding == 'ascii':
+            return self._load_ascii(*layout[1:])
+        self._progress(0, f'loading {osp.basename(self.filepath)} (no preview, cannot cancel) ...')
+        pcd = o3d.io.read_point_cloud(self.filepath)
+        self._progress(1, f'loaded {len(pcd.points)} points')
+        return pcd
+
+    def _load_binary(self, dtype: np.dtype, num_points: int, offset: int):
+        with open(self.filepath, 'rb') as f:
+            self._preview(f, dtype, num_points, offset)
+            f.seek(offset)
+            points = np.empty((num_points, 3), dtype=np.float64)
+            loaded = 0
+            while loaded < num_points:
+                self._check_cancelled()
+                chunk = np.fromfile(f, dtype=dtype, count=min(self.chunk_size, num_points - loaded))
+                if len(chunk) == 0:
+                    logger.warning(f'{self.filepath} 数据不完整：{loaded}/{num_points}')
+                    break
+                points[loaded:loaded + len(chunk)] = structured_to_xyz(chunk)
+                loaded += len(chunk)
+                self._progress(loaded / num_points, f'loading {loaded}/{num_points} points')
+        return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[:loaded]))
+
+    def _load_ascii(self, dtype: np.dtype, num_points: int, offset: int):
+        '''
+        每次解析chunk_size行，只取x、y、z列
+        '''
+        columns = {}
+        column = 0
+        for name in dtype.names:
+            columns[name] = column
+            column += max(1, int(np.prod(dtype.fields[name][0].shape)))
+        usecols = [columns[name] for name in ('x', 'y', 'z')]
+        points = np.empty((num_points, 3), dtype=np.float64)
+        loaded = 0
+        with open(self.filepath, 'rb') as f:
+            f.seek(offset)
+            lines = io.TextIOWrapper(f, encoding='ascii', errors='ignore')
+            while loaded < num_points:
+                self._check_cancelled()
+                chunk = list(itertools.islice(lines, min(self.chunk_size, num_points - loaded)))
+                if len(chunk) == 0:
+                    logger.warning(f'{self.filepath} 数据不完整：{loaded}/{num_points}')
+                    break
+                data = np.loadtxt(chunk, dtype=np.float64, ndmin=2, usecols=usecols)
+                points[loaded:loaded + len(data)] = data
+                if loaded == 0 and self.on_preview is not None and num_points > max(len(data), self.preview_points):
+                    step = max(1, len(data) // self.preview_points)
+                    self.on_preview(o3d.geometry.PointCloud(o3d.utility.Vector3dVector(data[::step])))
+                loaded += len(data)
+                self._progress(loaded / num_points, f'loading {loaded}/{num_points} points')
+        return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points[:loaded]))
+
+    def _pcd_layout(self):
+        '''
+        :return: 不含颜色、法向量的pcd返回(编码, dtype, 点数, 数据偏移)，否则为None
+        '''
+        if osp.splitext(self.filepath)[1].lower() != '.pcd':
+            return None
+        layout = read_pcd_layout(self.filepath)
+        if any(name in layout[1].names for name in _OPEN3D_FIELDS):
+            return None
+        return layout
+
+    def _preview(self, f, dtype: np.dtype, num_points: int, offset: int):
+        '''
+        从文件中均匀分布的PREVIEW_BLOCKS段中各读取一段，拼成预览
+        '''
+        if self.on_preview is None or num_points <= self.preview_points:
+            return
+        block_points = max(1, self.preview_points // PREVIEW_BLOCKS)
+        blocks = []
+        for begin in np.linspace(0, num_points - block_points, PREVIEW_BLOCKS).astype(np.int64):
+            self._check_cancelled()
+            f.seek(offset + int(begin) * dtype.itemsize)
+            blocks.append(structured_to_xyz(np.fromfile(f, dtype=dtype, count=block_points)))
+        preview = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(np.concatenate(blocks)))
+        self.on_preview(preview)
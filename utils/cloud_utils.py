@@ -0,0 +1,139 @@
+import numpy as np
+
+from utils.pc2_utils import structured_to_xyz
+
+
+XYZ_FIELDS = ('x', 'y', 'z')
+
+
+def split_cloud(cloud: np.ndarray):
+    '''
+    将结构化数组拆分为坐标和属性
+    :param cloud: 含x、y、z字段的结构化数组
+    :return: (N, 3) float64坐标, {字段名: (N,)数组}
+    '''
+    points = structured_to_xyz(cloud)
+    attributes = {name: np.asarray(cloud[name]) for name in cloud.dtype.names if name not in XYZ_FIELDS}
+    return points, attributes
+
+
+def join_cloud(points: np.ndarray, attributes: dict):
+    '''
+    split_cloud的逆操作，坐标以float32保存
+    :param points: (N, 3)坐标
+    :param attributes: {字段名: (N,)数组}
+    :return: 结构化数组
+    '''
+    dtype = [(name, '<f4') for name in XYZ_FIELDS]
+    dtype += [(name, values.dtype.newbyteorder('<'), values.shape[1:]) for name, values in attributes.items()]
+    cloud = np.empty(len(points), dtype=dtype)
+    for i, name in enumerate(XYZ_FIELDS):
+        cloud[name] = points[:, i]
+    for name, values in attributes.items():
+        cloud[name] = values
+    return cloud
+
+
+def select_attributes(attributes: dict, index):
+    '''
+    按索引选取属性，与PointCloud.select_by_index配合使用
+    :param attributes:
+    :param index: 索引或bool mask
+    :return:
+    '''
+    index = np.asarray(index)
+    if index.dtype != bool:
+        # open3d返回的空索引列表会被转换为float64，不能用于索引
+        index = index.astype(np.int64)
+    return {name: values[index] for name, values in attributes.items()}
+
+
+def concat_attributes(attributes_list: list):
+    '''
+    拼接多帧的属性，只保留所有帧都有的字段
+    :param attributes_list: [{字段名: 数组}, ...]
+    :return:
+    '''
+    if len(attributes_list) == 0:
+        return {}
+    names = [name for name in attributes_list[0] if all(name in attributes for attributes in attributes_list)]
+    return {name: np.concatenate([attributes[name] for attributes in attributes_list]) for name in names}
+
+
+def voxel_down_sample(points: np.ndarray, attributes: dict, voxel_size: float):
+    '''
+    带属性的体素降采样，与PointCloud.voxel_down_sample一致，坐标取体素内的均值
+    浮点属性（intensity、time）取均值，整型属性（ring）取体素内第一个点的值
+    :param points: (N, 3)坐标
+    :param attributes: {字段名: (N,)数组}
+    :param voxel_size: 体素大小，<=0时不降采样
+    :return: 降采样后的坐标和属性
+    '''
+    finite = np.isfinite(points).all(axis=1)
+    if not finite.all():
+        points = points[finite]
+        attributes = select_attributes(attributes, finite)
+    if voxel_size <= 0 or len(points) == 0:
+        return points, attributes
+
+    keys = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64)
+    dims = keys.max(axis=0) + 1
+    linear_keys = (keys[:, 0] * dims[1] + keys[:, 1]) * dims[2] + keys[:, 2]
+    _, first, inverse, counts = np.unique(linear_keys, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    voxel_points = np.column_stack(
+        [np.bincount(inverse, weights=points[:, i], minlength=len(counts)) for i in range(3)]
+    ) / counts[:, None]
+    voxel_attributes = {}
+    for name, values in attributes.items():
+        if values.dtype.kind == 'f' and values.ndim == 1:
+            voxel_attributes[name] = (np.bincount(inverse, weights=values, minlength=len(counts)) / counts) \
+                .astype(values.dtype)
+        else:
+            voxel_attributes[name] = values[first]
+    return voxel_points, voxel_attributes
+
+
+def crop_mask(points: np.ndarray, min_distance: float = None, max_distance: float = None,
+              min_z: float = None, max_z: float = None, box=None):
+    '''
+    裁剪条件组合为一个bool mask，各条件为None时不生效
+    :param points: (N, 3)坐标（传感器坐标系）
+    :param min_distance: 到原点的最小距离
+    :param max_distance: 到原点的最大距离
+    :param min_z: z的下限
+    :param max_z: z的上限
+    :param box: 轴对齐包围盒 ((x_min, y_min, z_min), (x_max, y_max, z_max))
+    :return: (N,) bool
+    '''
+    mask = np.isfinite(points).all(axis=1)
+    if min_distance is not None or max_distance is not None:
+        # 比较距离的平方，省去开方
+        squared_distances = np.einsum('ij,ij->i', points, points)
+        if min_distance is not None:
+            mask &= squared_distances >= min_distance ** 2
+        if max_distance is not None:
+            mask &= squared_distances <= max_distance ** 2
+    if min_z is not None:
+        mask &= points[:, 2] >= min_z
+    if max_z is not None:
+        mask &= points[:, 2] <= max_z
+    if box is not None:
+        box_min, box_max = np.asarray(box, dtype=np.float64)
+        mask &= ((points >= box_min) & (points <= box_max)).all(axis=1)
+    return mask
+
+
+def crop(points: np.ndarray, attributes: dict, **kwargs):
+    '''
+    按crop_mask裁剪点和属性
+    :param points: (N, 3)坐标
+    :param attributes: {字段名: (N,)数组}
+    :param kwargs: crop_mask的裁剪条件
+    :return: 裁剪后的坐标和属性
+    '''
+    mask = crop_mask(points, **kwargs)
+    if mask.all():
+        return points, attributes
+    return points[mask], select_attributes(attributes, mask)
@@ -0,0 +1,293 @@
+from abc import ABCMeta, abstractmethod
+import os.path as osp
+
+import numpy as np
+from loguru import logger
+
+from utils.cloud_utils import XYZ_FIELDS, join_cloud
+from utils.pcd_utils import packed_dtype, build_pcd_header
+
+
+# 合并结果支持的格式（由文件扩展名决定）
+CLOUD_FORMATS = ('pcd', 'ply', 'las', 'laz')
+
+# 每次转换并写出的点数，写出时只额外占用一个块的内存
+WRITE_CHUNK_SIZE = 1 << 20
+
+# LAS坐标以整数保存，坐标 = 整数 * scale + offset
+LAS_SCALE = .001
+
+# numpy类型 -> ply property类型
+_PLY_TYPES = {'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort', 'i4': 'int', 'u4': 'uint',
+              'f4': 'float', 'f8': 'double'}
+
+
+class CloudWriter(metaclass=ABCMeta):
+    '''
+    分块写点云：构造时写文件头，write()逐块写入结构化数组，close()结束
+        with open_cloud_writer(path, dtype, num_points) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    '''
+
+    def __init__(self, filepath: str, dtype: np.dtype, num_points: int):
+        '''
+        :param filepath:
+        :param dtype: 各块的结构化dtype，至少包含x、y、z字段
+        :param num_points: 总点数，写入文件头
+        '''
+        self.filepath = filepath
+        self.dtype = dtype
+        self.num_points = num_points
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # 出现异常时只关闭文件，不再检查点数，避免掩盖原来的异常
+        if exc_type is None:
+            self.close()
+        else:
+            self._close()
+
+    def write(self, cloud: np.ndarray):
+        self._write(cloud)
+        self.written += len(cloud)
+
+    @abstractmethod
+    def _write(self, cloud: np.ndarray):
+        '''
+        :param cloud: 结构化数组，dtype为构造时的dtype
+        '''
+        pass
+
+    @abstractmethod
+    def _close(self):
+        '''
+        关闭文件，可能被调用多次
+        '''
+        pass
+
+    def close(self):
+        self._close()
+        if self.written != self.num_points:
+            raise ValueError(f'{self.filepath} 写入的点数与文件头不一致：{self.written} != {self.num_points}')
+
+
+class _BinaryCloudWriter(CloudWriter):
+    '''
+    文件头之后直接写入紧凑的小端二进制记录，pcd（binary）和ply（binary_little_endian）共用
+    '''
+
+    def __init__(self, filepath: str, dtype: np.dtype, num_points: int):
+        super().__init__(filepath, dtype, num_points)
+        self.packed_dtype = packed_dtype(dtype)
+        self.f = open(filepath, 'wb')
+        self.f.write(self.build_header().encode())
+
+    @abstractmethod
+    def build_header(self):
+        '''
+        :return: 文件头字符串
+        '''
+        pass
+
+    def _write(self, cloud: np.ndarray):
+        buffer = np.empty(len(cloud), dtype=self.packed_dtype)
+        for name in self.packed_dtype.names:
+            buffer[name] = cloud[name]
+        buffer.tofile(self.f)
+
+    def _close(self):
+        if not self.f.closed:
+            self.f.close()
+
+
+class PcdWriter(_BinaryCloudWriter):
+    '''
+    binary编码的pcd，结果与utils.pcd_utils.write_pcd_binary相同
+    '''
+
+    def build_header(self):
+        return build_pcd_header(self.packed_dtype, self.num_points, 'binary')
+
+
+class PlyWriter(_BinaryCloudWriter):
+    '''
+    binary_little_endian编码的ply，多维字段按分量展开为name_0、name_1...
+    '''
+
+    def build_header(self):
+        lines = ['ply', 'format binary_little_endian 1.0', f'element vertex {self.num_points}']
+        for name in self.packed_dtype.names:
+            field_dtype = self.packed_dtype.fields[name][0]
+            ply_type = _PLY_TYPES.get(field_dtype.base.str[1:])
+            if ply_type is None:
+                raise ValueError(f'ply不支持的字段类型：{name}, {field_dtype.base}')
+            count = int(np.prod(field_dtype.shape))
+            names = [name] if not field_dtype.shape else [f'{name}_{i}' for i in range(count)]
+            lines += [f'property {ply_type} {property_name}' for property_name in names]
+        lines.append('end_header')
+        return '\n'.join(lines) + '\n'
+
+
+class LasWriter(CloudWriter):
+    '''
+    LAS/LAZ（由扩展名决定，LAZ需要laspy的lazrs或laszip后端），通过laspy分块写入
+    intensity写入LAS的intensity（截断到uint16），其他单值字段作为extra bytes保留原名和类型
+    LAS坐标是整数，坐标不是有限值的点（raw合并中的NaN点）不写入，文件头的点数为实际写入的点数
+    '''
+
+    def __init__(self, filepath: str, dtype: np.dtype, num_points: int, offset=(0, 0, 0)):
+        '''
+        :param offset: 坐标偏移，一般取点云的最小值，保证LAS_SCALE精度下不溢出
+        '''
+        super().__init__(filepath, dtype, num_points)
+        try:
+            import laspy
+        except ImportError:
+            raise ImportError('写LAS/LAZ需要laspy：pip install laspy[lazrs]')
+        self.laspy = laspy
+        header = laspy.LasHeader(point_format=0, version='1.4')
+        header.scales = np.full(3, LAS_SCALE)
+        header.offsets = np.asarray(offset, dtype=np.float64)
+        self.extra_names = [name for name in dtype.names
+                            if name not in XYZ_FIELDS and name != 'intensity' and not dtype.fields[name][0].shape]
+        header.add_extra_dims([laspy.ExtraBytesParams(name=name, type=dtype.fields[name][0].base.newbyteorder('<'))
+                               for name in self.extra_names])
+        self.header = header
+        self.writer = laspy.open(filepath, mode='w', header=header,
+                                 do_compress=osp.splitext(filepath)[1].lower() == '.laz')
+        self.dropped = 0
+
+    def _write(self, cloud: np.ndarray):
+        finite = np.isfinite(cloud['x']) & np.isfinite(cloud['y']) & np.isfinite(cloud['z'])
+        if not finite.all():
+            self.dropped += int(len(cloud) - finite.sum())
+            cloud = cloud[finite]
+        record = self.laspy.ScaleAwarePointRecord.zeros(len(cloud), header=self.header)
+        record.x, record.y, record.z = cloud['x'], cloud['y'], cloud['z']
+        if 'intensity' in cloud.dtype.names:
+            record.intensity = np.clip(np.rint(cloud['intensity']), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+        for name in self.extra_names:
+            record[name] = cloud[name]
+        self.writer.write_points(record)
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.dropped:
+                logger.warning(f'{self.filepath} 跳过了{self.dropped}个坐标不是有限值的点')
+
+
+class FrameWriter:
+    '''
+    逐帧写点云：每一帧转换为结构化数组后直接写出，内存中只保留一帧，用于raw合并等不需要处理整个点云的场景
+    第一帧到达时才打开写入器，文件头的字段由第一帧决定，LAS/LAZ的坐标偏移取第一帧中有限点的最小值
+        with FrameWriter(path, attribute_names, num_points) as writer:
+            for points, attributes in frames:
+                writer.add(points, attributes)
+    '''
+
+    def __init__(self, filepath: str, attribute_names: list, num_points: int):
+        '''
+        :param filepath: 格式由扩展名决定，见CLOUD_FORMATS
+        :param attribute_names: 写出的属性，每一帧都需要包含
+        :param num_points: 所有帧的总点数
+        '''
+        get_cloud_format(filepath)
+        self.filepath = filepath
+        self.attribute_names = list(attribute_names)
+        self.num_points = num_points
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.writer is not None:
+            self.writer._close()
+
+    def add(self, points: np.ndarray, attributes: dict):
+        cloud = join_cloud(points, {name: attributes[name] for name in self.attribute_names})
+        if self.writer is None:
+            self._open(cloud.dtype, points)
+        self.writer.write(cloud)
+
+    def _open(self, dtype: np.dtype, points: np.ndarray):
+        offset = finite_min(points)
+        offset = np.floor(offset) if offset is not None else (0, 0, 0)
+        self.writer = open_cloud_writer(self.filepath, dtype, self.num_points, offset)
+
+    def close(self):
+        if self.writer is None:
+            # 没有任何帧
+            self._open(join_cloud(np.empty((0, 3)), {}).dtype, np.empty((0, 3)))
+        self.writer.close()
+
+
+def finite_min(points: np.ndarray, chunk_size: int = WRITE_CHUNK_SIZE):
+    '''
+    分块计算坐标都是有限值的点的逐轴最小值，不生成过滤后的副本
+    :param points: (N, 3)
+    :param chunk_size:
+    :return: (3,)，没有这样的点时为None
+    '''
+    result = None
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        chunk = chunk[np.isfinite(chunk).all(axis=1)]
+        if len(chunk):
+            result = chunk.min(axis=0) if result is None else np.minimum(result, chunk.min(axis=0))
+    return result
+
+
+def get_cloud_format(filepath: str):
+    '''
+    :param filepath:
+    :return: 由扩展名得到的格式，见CLOUD_FORMATS
+    '''
+    cloud_format = osp.splitext(filepath)[1][1:].lower()
+    if cloud_format not in CLOUD_FORMATS:
+        raise ValueError(f'不支持的点云格式：{filepath}，可选：{CLOUD_FORMATS}')
+    return cloud_format
+
+
+def open_cloud_writer(filepath: str, dtype: np.dtype, num_points: int, offset=(0, 0, 0)):
+    '''
+    按扩展名创建分块写入器
+    :param filepath: .pcd、.ply、.las或.laz
+    :param dtype: 结构化dtype
+    :param num_points: 总点数
+    :param offset: LAS/LAZ的坐标偏移，需为有限值
+    :return: CloudWriter
+    '''
+    cloud_format = get_cloud_format(filepath)
+    if cloud_format == 'pcd':
+        return PcdWriter(filepath, dtype, num_points)
+    if cloud_format == 'ply':
+        return PlyWriter(filepath, dtype, num_points)
+    return LasWriter(filepath, dtype, num_points, offset)
+
+
+def write_cloud(filepath: str, points: np.ndarray, attributes: dict, chunk_size: int = WRITE_CHUNK_SIZE):
+    '''
+    分块写合并结果：每次只把chunk_size个点转换为结构化数组，不再生成整个点云的副本
+    :param filepath: 格式由扩展名决定，见CLOUD_FORMATS
+    :param points: (N, 3)
+    :param attributes: {字段名: (N,)数组}
+    :param chunk_size: 每块的点数
+    :return:
+    '''
+    dtype = join_cloud(points[:0], {name: values[:0] for name, values in attributes.items()}).dtype
+    # NaN点（raw合并中保留）不参与偏移的计算，LAS/LAZ写出时跳过
+    offset = finite_min(points)
+    offset = np.floor(offset) if offset is not None else (0, 0, 0)
+    with open_cloud_writer(filepath, dtype, len(points), offset) as writer:
+        for start in range(0, len(points), chunk_size):
+            end = start + chunk_size
+            writer.write(join_cloud(points[start:end], {name: values[start:end] for name, values in attributes.items()}))
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import numpy as np
+import open3d as o3d
+from loguru import logger
+
+
+# 降采样滑动条可选的体素大小，0为原始点云
+LOD_VOXEL_SIZES = (.05, .1, .2, .3, .5)
+
+
+class LodPyramid:
+    '''
+    点云的多分辨率金字塔：每一层是上一层（更细的一层）按更大的体素降采样的结果，
+    各层只依赖上一层，总耗时约等于对原始点云做一次降采样
+    在后台线程中由细到粗构建，滑动条只在已构建的层之间切换
+    '''
+
+    def __init__(self, geometry: o3d.geometry.PointCloud, voxel_sizes=LOD_VOXEL_SIZES):
+        '''
+        :param geometry: 原始点云，作为体素大小0的一层
+        :param voxel_sizes: 各层的体素大小
+        '''
+        self.geometry = geometry
+        self.voxel_sizes = tuple(sorted(voxel_sizes))
+        self._levels = {0: geometry}
+        self._ready = {voxel_size: threading.Event() for voxel_size in self.voxel_sizes}
+        self._cancelled = False
+
+    def build_async(self):
+        threading.Thread(target=self.build, daemon=True).start()
+
+    def build(self):
+        '''
+        由细到粗依次构建各层
+        '''
+        previous = self.geometry
+        for voxel_size in self.voxel_sizes:
+            if self._cancelled:
+                return
+            start = time.perf_counter()
+            previous = previous.voxel_down_sample(voxel_size)
+            self._levels[voxel_size] = previous
+            self._ready[voxel_size].set()
+            logger.info(f'LOD voxel {voxel_size}：{len(previous.points)}个点，耗时：{time.perf_counter() - start:.3f}s')
+
+    def cancel(self):
+        '''
+        几何体被移除时调用，尚未构建的层不再构建
+        '''
+        self._cancelled = True
+        for ready in self._ready.values():
+            ready.set()
+
+    def snap(self, voxel_size: float):
+        '''
+        :param voxel_size: 滑动条的值
+        :return: 最接近的层的体素大小（0或voxel_sizes之一）
+        '''
+        candidates = (0,) + self.voxel_sizes
+        return candidates[int(np.argmin([abs(voxel_size - candidate) for candidate in candidates]))]
+
+    def is_ready(self, voxel_size: float):
+        return voxel_size in self._levels
+
+    def get(self, voxel_size: float, timeout: float = None):
+        '''
+        :param voxel_size: snap()的结果
+        :param timeout: 该层尚未构建完成时最多等待的秒数，None为一直等待
+        :return: 该层的点云，超时或已取消时为None
+        '''
+        if voxel_size in self._levels:
+            return self._levels[voxel_size]
+        self._ready[voxel_size].wait(timeout)
+        return self._levels.get(voxel_size)
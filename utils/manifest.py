@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import os.path as osp
+
+from loguru import logger
+
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# 计算bag指纹时读取文件头尾各多少字节；完整计算几十GB的bag的哈希太慢
+FINGERPRINT_BYTES = 1 << 20
+
+
+def bag_fingerprint(bag_filepath: str):
+    '''
+    bag文件指纹：大小、修改时间、文件大小+头尾各FINGERPRINT_BYTES字节的sha1
+    :param bag_filepath:
+    :return: {size, mtime, hash}
+    '''
+    stat = os.stat(bag_filepath)
+    sha1 = hashlib.sha1(str(stat.st_size).encode())
+    with open(bag_filepath, 'rb') as f:
+        sha1.update(f.read(FINGERPRINT_BYTES))
+        if stat.st_size > 2 * FINGERPRINT_BYTES:
+            f.seek(-FINGERPRINT_BYTES, os.SEEK_END)
+            sha1.update(f.read(FINGERPRINT_BYTES))
+        else:
+            sha1.update(f.read())
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha1.hexdigest()}
+
+
+def _normalize(params: dict):
+    '''
+    统一为json中的形式（tuple -> list等），便于比较
+    '''
+    return json.loads(json.dumps(params))
+
+
+class Manifest:
+    '''
+    每个结果目录一个manifest.json，记录bag指纹、解析进度和参数、合并参数和结果
+    重新运行时据此跳过已完成的bag、从中断处继续解析、合并参数变化时只重新合并
+    '''
+
+    def __init__(self, manifest_filepath: str, bag: dict):
+        self.manifest_filepath = manifest_filepath
+        self.bag = bag
+        # {params, written, total, done}
+        self.extract = None
+        # {params, outputs, done}
+        self.merge = None
+
+    @classmethod
+    def load(cls, res_dir: str, bag_filepath: str, fresh: bool = False):
+        '''
+        读取结果目录中的manifest；不存在、版本不同或bag已改变时返回空的manifest
+        :param res_dir: 结果目录
+        :param bag_filepath:
+        :param fresh: 为True时忽略已有的manifest（全部重新处理）
+        :return:
+        '''
+        manifest_filepath = osp.join(res_dir, MANIFEST_FILENAME)
+        bag = dict(bag_fingerprint(bag_filepath), path=osp.abspath(bag_filepath))
+        manifest = cls(manifest_filepath, bag)
+        if fresh or not osp.exists(manifest_filepath):
+            return manifest
+        try:
+            with open(manifest_filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'{manifest_filepath} 读取失败，重新处理：{e}')
+            return manifest
+        if data.get('version') != MANIFEST_VERSION:
+            logger.info(f'{manifest_filepath} 版本不同，重新处理')
+        elif (data['bag']['size'], data['bag']['hash']) != (bag['size'], bag['hash']):
+            logger.info(f'{bag_filepath} 与上次处理时不同，重新处理')
+        else:
+            manifest.extract = data.get('extract')
+            manifest.merge = data.get('merge')
+        return manifest
+
+    def save(self):
+        '''
+        先写临时文件再替换，避免中断时留下不完整的manifest
+        '''
+        tmp_filepath = self.manifest_filepath + '.tmp'
+        with open(tmp_filepath, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'bag': self.bag, 'extract': self.extract, 'merge': self.merge},
+                      f, ensure_ascii=False, indent=2)
+        os.replace(tmp_filepath, self.manifest_filepath)
+
+    def extract_done(self, params: dict):
+        return self.extract is not None and self.extract['done'] and self.extract['params'] == _normalize(params)
+
+    def resume_extract(self, params: dict):
+        '''
+        开始或继续解析
+        :param params: 解析参数，与上次不同时从头解析
+        :return: 已写入的消息数
+        '''
+        params = _normalize(params)
+        if self.extract is None or self.extract['params'] != params:
+            self.extract = {'params': params, 'written': 0, 'total': None, 'done': False}
+        self.extract['done'] = False
+        # tmp目录将发生变化，之前的合并结果失效
+        self.merge = None
+        self.save()
+        return self.extract['written']
+
+    def update_extract_progress(self, written: int):
+        self.extract['written'] = written
+        self.save()
+
+    def finish_extract(self, total: int):
+        self.extract.update(written=total, total=total, done=True)
+        self.save()
+
+    def merge_done(self, params: dict, outputs: list):
+        '''
+        :param params: 合并参数
+        :param outputs: 合并结果路径，文件被删除时视为未完成
+        :return:
+        '''
+        return self.merge is not None and self.merge['done'] and self.merge['params'] == _normalize(params) \
+            and all(osp.exists(output) for output in outputs)
+
+    def start_merge(self, params: dict):
+        self.merge = {'params': _normalize(params), 'outputs': [], 'done': False}
+        self.save()
+
+    def finish_merge(self, outputs: list):
+        self.merge.update(outputs=outputs, done=True)
+        self.save()
@@ -10,6 +10,18 @@ def get_translation_and_rotation_matrix_from(txt_full_path):
     辅助函数：从txt文件中读取平移向量xyz和旋转四元数
     返回平移向量和旋转矩阵
     '''
+    translation_vector, quaternion = get_translation_and_quaternion_from(txt_full_path)
+
+    # 将四元数转换为旋转矩阵
+    rotation_matrix = R.from_quat(quaternion).as_matrix()
+    return translation_vector, rotation_matrix
+
+
+def get_translation_and_quaternion_from(txt_full_path):
+    '''
+    辅助函数：从txt文件中读取平移向量xyz和旋转四元数
+    返回平移向量和四元数(x, y, z, w)
+    '''
     with open(txt_full_path, 'r', encoding='utf-8') as f:
         result = yaml.load(f.read(), Loader=yaml.FullLoader)
 
@@ -23,7 +35,93 @@ def get_translation_and_rotation_matrix_from(txt_full_path):
     # 定义平移向量
     translation_vector = np.array([pos_x, pos_y, pos_z])
     quaternion = np.array([ori_x, ori_y, ori_z, ori_w])  # 定义四元数
+    return translation_vector, quaternion
 
-    # 将四元数转换为旋转矩阵
-    rotation_matrix = R.from_quat(quaternion).as_matrix()
-    return translation_vector, rotation_matrix
\ No newline at end of file
+
+def get_translation_and_quaternion_from_msg(msg):
+    '''
+    辅助函数：从nav_msgs/Odometry消息中读取平移向量xyz和旋转四元数
+    返回平移向量和四元数(x, y, z, w)
+    '''
+    position = msg.pose.pose.position
+    orientation = msg.pose.pose.orientation
+    translation_vector = np.array([position.x, position.y, position.z])
+    quaternion = np.array([orientation.x, orientation.y, orientation.z, orientation.w])
+    return translation_vector, quaternion
+
+
+def make_transform(translation_vector, rotation_matrix, center=(0, 0, 0)):
+    '''
+    辅助函数：生成4x4齐次变换矩阵
+    等价于先pcd.rotate(rotation_matrix, center=center)，再pcd.translate(translation_vector)，
+    即 p' = R (p - c) + c + t
+    '''
+    rotation_matrix = np.asarray(rotation_matrix, dtype=np.float64)
+    center = np.asarray(center, dtype=np.float64)
+    transform = np.eye(4)
+    transform[:3, :3] = rotation_matrix
+    transform[:3, 3] = center - rotation_matrix @ center + np.asarray(translation_vector, dtype=np.float64)
+    return transform
+
+
+def compose_extrinsic(translation_vector, rotation_matrix, extrinsic, center=(0, 0, 0)):
+    '''
+    辅助函数：把传感器外参并入位姿
+    返回t'、R'，使make_transform(t', R', center)等于make_transform(t, R, center) @ extrinsic，
+    即先用外参变换到里程计坐标系，再用位姿变换到地图坐标系
+    :param translation_vector: 位姿的平移向量
+    :param rotation_matrix: 位姿的旋转矩阵
+    :param extrinsic: 4x4，传感器坐标系 -> 里程计坐标系
+    :param center: 旋转中心
+    :return: 平移向量, 旋转矩阵
+    '''
+    center = np.asarray(center, dtype=np.float64)
+    transform = make_transform(translation_vector, rotation_matrix, center) @ np.asarray(extrinsic, dtype=np.float64)
+    rotation_matrix = transform[:3, :3]
+    return transform[:3, 3] - center + rotation_matrix @ center, rotation_matrix
+
+
+def make_transforms(translation_vectors, rotation_matrices, center=(0, 0, 0)):
+    '''
+    辅助函数：批量生成4x4齐次变换矩阵
+    :param translation_vectors: (N, 3)
+    :param rotation_matrices: (N, 3, 3)
+    :param center: 旋转中心
+    :return: (N, 4, 4)
+    '''
+    rotation_matrices = np.asarray(rotation_matrices, dtype=np.float64).reshape(-1, 3, 3)
+    translation_vectors = np.asarray(translation_vectors, dtype=np.float64).reshape(-1, 3)
+    center = np.asarray(center, dtype=np.float64)
+    transforms = np.tile(np.eye(4), (len(rotation_matrices), 1, 1))
+    transforms[:, :3, :3] = rotation_matrices
+    transforms[:, :3, 3] = center - rotation_matrices @ center + translation_vectors
+    return transforms
+
+
+def apply_transform(points, transform):
+    '''
+    辅助函数：对(N, 3)的点做一次齐次变换，只遍历一次点
+    '''
+    return points @ transform[:3, :3].T + transform[:3, 3]
+
+
+# apply_transforms每次处理的点数，限制按点展开的旋转矩阵占用的内存
+TRANSFORM_CHUNK_SIZE = 1 << 20
+
+
+def apply_transforms(points, frame_ids, transforms):
+    '''
+    辅助函数：对已经拼接在一起的多帧点分别做齐次变换
+    :param points: (N, 3) 多帧拼接后的点
+    :param frame_ids: (N,) 每个点所属帧的序号
+    :param transforms: (F, 4, 4) 每一帧的变换矩阵
+    :return: (N, 3)
+    '''
+    frame_ids = np.asarray(frame_ids)
+    result = np.empty((len(points), 3), dtype=np.float64)
+    for start in range(0, len(points), TRANSFORM_CHUNK_SIZE):
+        end = start + TRANSFORM_CHUNK_SIZE
+        chunk_transforms = transforms[frame_ids[start:end]]
+        result[start:end] = np.einsum('nij,nj->ni', chunk_transforms[:, :3, :3], points[start:end]) \
+            + chunk_transforms[:, :3, 3]
+    return result
@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+from loguru import logger
+
+try:
+    import resource
+except ImportError:
+    # windows下没有resource模块
+    resource = None
+
+
+def get_peak_rss(children: bool = False):
+    '''
+    进程的峰值常驻内存
+    :param children: True时返回已结束的子进程中最大的峰值（仅posix）
+    :return: 字节数，无法获取时为None
+    '''
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # linux下ru_maxrss的单位为KB，macOS下为字节
+        return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    if children:
+        return None
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory_info = psutil.Process(os.getpid()).memory_info()
+    return getattr(memory_info, 'peak_wset', memory_info.rss)
+
+
+class StageStats:
+    '''
+    单个步骤的统计：调用次数、墙上时间、CPU时间、输入/输出点数、步骤结束时的进程峰值内存
+    '''
+
+    def __init__(self, calls=0, seconds=0., cpu_seconds=0., points_in=0, points_out=0, peak_rss=None):
+        self.calls = calls
+        self.seconds = seconds
+        self.cpu_seconds = cpu_seconds
+        self.points_in = points_in
+        self.points_out = points_out
+        self.peak_rss = peak_rss
+
+    def add(self, other):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.points_in += other.points_in
+        self.points_out += other.points_out
+        if other.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, other.peak_rss)
+
+    def to_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'cpu_seconds': self.cpu_seconds,
+                'points_in': self.points_in, 'points_out': self.points_out,
+                'peak_rss_mb': None if self.peak_rss is None else self.peak_rss / 2 ** 20}
+
+
+class Measurement:
+    '''
+    measure()中由调用方填写输出点数
+    '''
+
+    def __init__(self, points_in=0):
+        self.points_in = points_in
+        self.points_out = points_in
+
+
+class Metrics:
+    '''
+    按步骤名累计耗时、点数和内存，用于定位性能退化以及评估各现场所需的硬件
+    子进程中的统计通过stages传回主进程后用merge()合并
+    '''
+
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def measure(self, name: str, points_in: int = 0):
+        '''
+        统计with块的耗时
+            with metrics.measure('decode', n) as m:
+                ...
+                m.points_out = len(frame)
+        :param name: 步骤名
+        :param points_in: 输入点数
+        :return: Measurement
+        '''
+        measurement = Measurement(points_in)
+        start, cpu_start = time.perf_counter(), time.process_time()
+        yield measurement
+        self.record(name, time.perf_counter() - start, time.process_time() - cpu_start,
+                    measurement.points_in, measurement.points_out)
+
+    def timed_iter(self, name: str, iterable, size=None):
+        '''
+        统计每次从iterable中取下一个元素的耗时，例如读取bag、读取pcd
+        :param name: 步骤名
+        :param iterable:
+        :param size: 元素 -> 点数，为None时每个元素计为1
+        :return: 生成器，元素与iterable相同
+        '''
+        iterator = iter(iterable)
+        while True:
+            start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            num = 1 if size is None else size(item)
+            self.record(name, time.perf_counter() - start, time.process_time() - cpu_start, num, num)
+            yield item
+
+    def record(self, name, seconds, cpu_seconds, points_in, points_out):
+        if name not in self.stages:
+            self.stages[name] = StageStats()
+        self.stages[name].add(StageStats(1, seconds, cpu_seconds, points_in, points_out, get_peak_rss()))
+
+    def merge(self, stages: dict):
+        '''
+        合并其他进程中的统计
+        :param stages: {步骤名: StageStats}
+        '''
+        for name, stage_stats in stages.items():
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(stage_stats)
+
+    def report(self, **extra):
+        '''
+        :param extra: 附加到报告中的信息，例如bag路径、参数
+        :return: dict
+        '''
+        peak_rss, children_peak_rss = get_peak_rss(), get_peak_rss(children=True)
+        report = dict(extra)
+        report.update({
+            'wall_seconds': time.perf_counter() - self.start,
+            'cpu_seconds': time.process_time() - self.cpu_start,
+            'peak_rss_mb': None if peak_rss is None else peak_rss / 2 ** 20,
+            'children_peak_rss_mb': None if children_peak_rss is None else children_peak_rss / 2 ** 20,
+            'stages': {name: stage_stats.to_dict() for name, stage_stats in self.stages.items()},
+        })
+        return report
+
+    def dump(self, json_filepath: str, **extra):
+        '''
+        将报告写为json文件
+        :param json_filepath:
+        :param extra: 见report()
+        :return:
+        '''
+        with open(json_filepath, 'w', encoding='utf-8') as f:
+            json.dump(self.report(**extra), f, ensure_ascii=False, indent=2)
+        logger.info(f'性能统计：{json_filepath}')
+
+    def log_report(self):
+        for name, stage_stats in self.stages.items():
+            logger.info(f'{name}: 调用{stage_stats.calls}次, 耗时{stage_stats.seconds:.3f}s, '
+                        f'CPU{stage_stats.cpu_seconds:.3f}s, 点数 {stage_stats.points_in} -> {stage_stats.points_out}')
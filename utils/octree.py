@@ -0,0 +1,405 @@
+'''
+分块八叉树格式：用于显示比内存大的合并结果
+目录结构：
+    <name>.octree/
+        octree.json     元数据：根节点范围、每个节点的范围、点数、子节点
+        nodes/<key>.npy 每个节点的点，(N, 3) float32，相对根节点原点的坐标
+节点key为 'r' + 从根节点开始每一层的子节点序号（0~7），例如 r、r0、r07
+叶子节点保存其范围内的全部点；内部节点保存其子树的体素抽样（LOD），显示时按相机距离选择层级
+'''
+from collections import OrderedDict
+import heapq
+import json
+import math
+import os
+import os.path as osp
+import shutil
+import threading
+import time
+
+import numpy as np
+from loguru import logger
+
+from utils.pc2_utils import structured_to_xyz
+from utils.pcd_utils import read_pcd_layout
+
+
+OCTREE_INDEX_FILENAME = 'octree.json'
+OCTREE_VERSION = 1
+
+# 每个节点最多保存的点数，叶子节点超过时继续细分
+NODE_POINTS = 100000
+# 内部节点按 节点边长 / SAMPLE_GRID 的体素抽样
+SAMPLE_GRID = 128
+# 最大深度，达到该深度的叶子节点不再细分
+MAX_DEPTH = 12
+# 转换时先把点分到该深度以内的格子中（每个格子一个临时文件），再逐个格子在内存中构建子树
+MAX_PARTITION_DEPTH = 5
+# 转换时每次读取的点数
+CONVERT_CHUNK_SIZE = 1 << 22
+
+# 同时显示的最多点数
+POINT_BUDGET = 3000000
+# 内存中缓存的最多点数，超过时按LRU淘汰不再显示的节点
+CACHE_POINTS = 12000000
+# 节点的抽样间距投影到屏幕上超过多少像素时显示其子节点
+POINT_PIXELS = 2.
+
+
+def _octant_offset(octant: int):
+    return np.array([(octant >> 2) & 1, (octant >> 1) & 1, octant & 1], dtype=np.float64)
+
+
+def node_bounds(key: str, size: float):
+    '''
+    :param key: 节点key
+    :param size: 根节点边长
+    :return: 节点原点（相对根节点原点）, 节点边长
+    '''
+    origin = np.zeros(3)
+    for octant in key[1:]:
+        size /= 2
+        origin += _octant_offset(int(octant)) * size
+    return origin, size
+
+
+def _sample(points: np.ndarray, origin: np.ndarray, size: float, max_points: int, rng):
+    '''
+    体素抽样：每个 size / SAMPLE_GRID 的体素保留一个点，仍然超过max_points时随机抽取
+    '''
+    if len(points) <= max_points:
+        return points
+    cells = np.clip(((points - origin) / (size / SAMPLE_GRID)).astype(np.int64), 0, SAMPLE_GRID - 1)
+    _, index = np.unique((cells[:, 0] * SAMPLE_GRID + cells[:, 1]) * SAMPLE_GRID + cells[:, 2], return_index=True)
+    if len(index) > max_points:
+        index = rng.choice(index, max_points, replace=False)
+    return points[np.sort(index)]
+
+
+def _iter_pcd_points(pcd_filepath: str, chunk_size: int = CONVERT_CHUNK_SIZE):
+    '''
+    分块读取binary编码的pcd的坐标
+    :return: 生成器，(N, 3) float64，已去掉含nan的点
+    '''
+    encoding, dtype, num_points, offset = read_pcd_layout(pcd_filepath)
+    if encoding != 'binary':
+        raise ValueError(f'{pcd_filepath} 只支持binary编码的pcd，当前：{encoding}')
+    with open(pcd_filepath, 'rb') as f:
+        f.seek(offset)
+        read = 0
+        while read < num_points:
+            chunk = np.fromfile(f, dtype=dtype, count=min(chunk_size, num_points - read))
+            if len(chunk) == 0:
+                break
+            read += len(chunk)
+            yield structured_to_xyz(chunk, remove_nans=True)
+
+
+class OctreeConverter:
+    '''
+    把合并结果（binary pcd）转换为分块八叉树，内存占用与文件大小无关：
+    1. 分块读取一遍，得到范围和点数
+    2. 再分块读取一遍，把点按所在的格子追加到临时文件
+    3. 逐个格子在内存中构建子树，再由下向上对各层内部节点抽样
+    '''
+
+    def __init__(self, pcd_filepath: str, octree_dir: str, node_points: int = NODE_POINTS,
+                 chunk_size: int = CONVERT_CHUNK_SIZE):
+        self.pcd_filepath = pcd_filepath
+        self.octree_dir = octree_dir
+        self.nodes_dir = osp.join(octree_dir, 'nodes')
+        self.node_points = node_points
+        self.chunk_size = chunk_size
+        self.nodes = {}
+        self.rng = np.random.default_rng(0)
+
+    def convert(self):
+        '''
+        :return: octree.json的路径
+        '''
+        start = time.perf_counter()
+        if osp.exists(self.octree_dir):
+            shutil.rmtree(self.octree_dir)
+        os.makedirs(self.nodes_dir)
+
+        lo, hi, total = np.full(3, np.inf), np.full(3, -np.inf), 0
+        for points in _iter_pcd_points(self.pcd_filepath, self.chunk_size):
+            if len(points):
+                lo, hi = np.minimum(lo, points.min(axis=0)), np.maximum(hi, points.max(axis=0))
+            total += len(points)
+        if total == 0:
+            raise ValueError(f'{self.pcd_filepath} 中没有有效的点')
+        # 根节点为立方体，稍微放大避免最大值落在边界上
+        self.size = float(max((hi - lo).max(), 1e-3)) * (1 + 1e-6)
+        self.offset = (lo + hi) / 2 - self.size / 2
+        depth = min(MAX_PARTITION_DEPTH, max(0, math.ceil(math.log(total / self.node_points, 8))))
+        logger.info(f'{self.pcd_filepath}：点数 {total}，范围 {lo} - {hi}，分块深度 {depth}')
+
+        partition_dir = osp.join(self.octree_dir, 'partition')
+        os.makedirs(partition_dir)
+        keys = self._partition(partition_dir, depth)
+        for i, key in enumerate(sorted(keys)):
+            points = np.fromfile(osp.join(partition_dir, f'{key}.bin'), dtype=np.float32).reshape(-1, 3)
+            self._build_subtree(key, points)
+            logger.info(f'构建子树 {i + 1}/{len(keys)}：{key}，点数 {len(points)}')
+        shutil.rmtree(partition_dir)
+
+        # 由下向上对分块深度以上的内部节点抽样
+        level_keys = set(keys)
+        for level in range(depth - 1, -1, -1):
+            level_keys = {key[:-1] for key in level_keys}
+            for key in sorted(level_keys):
+                children = [key + str(octant) for octant in range(8) if key + str(octant) in self.nodes]
+                points = np.concatenate([self._read(child) for child in children])
+                self._write_node(key, self._sample(key, points), children)
+
+        index_filepath = osp.join(self.octree_dir, OCTREE_INDEX_FILENAME)
+        with open(index_filepath, 'w', encoding='utf-8') as f:
+            json.dump({'version': OCTREE_VERSION, 'source': osp.abspath(self.pcd_filepath), 'num_points': total,
+                       'offset': self.offset.tolist(), 'size': self.size, 'node_points': self.node_points,
+                       'sample_grid': SAMPLE_GRID, 'nodes': self.nodes}, f)
+        logger.info(f'八叉树转换完成：{index_filepath}，节点数 {len(self.nodes)}，'
+                    f'耗时 {time.perf_counter() - start:.1f}s')
+        return index_filepath
+
+    def _partition(self, partition_dir: str, depth: int):
+        '''
+        把点按深度depth的格子追加到临时文件，坐标转换为相对根节点原点的float32
+        :return: 非空格子的key
+        '''
+        cells = 1 << depth
+        keys = set()
+        for points in _iter_pcd_points(self.pcd_filepath, self.chunk_size):
+            points = (points - self.offset).astype(np.float32)
+            ijk = np.clip((points / self.size * cells).astype(np.int64), 0, cells - 1)
+            codes = (ijk[:, 0] * cells + ijk[:, 1]) * cells + ijk[:, 2]
+            order = np.argsort(codes, kind='stable')
+            codes, points, ijk = codes[order], points[order], ijk[order]
+            bounds = np.flatnonzero(np.diff(codes)) + 1
+            for begin, end in zip(np.r_[0, bounds], np.r_[bounds, len(codes)]):
+                key = 'r' + ''.join(str((((ijk[begin, 0] >> bit) & 1) << 2) | (((ijk[begin, 1] >> bit) & 1) << 1)
+                                        | ((ijk[begin, 2] >> bit) & 1))
+                                    for bit in range(depth - 1, -1, -1))
+                with open(osp.join(partition_dir, f'{key}.bin'), 'ab') as f:
+                    points[begin:end].tofile(f)
+                keys.add(key)
+        return keys
+
+    def _build_subtree(self, key: str, points: np.ndarray):
+        '''
+        在内存中构建以key为根的子树
+        :return: None，节点写入nodes目录
+        '''
+        if len(points) <= self.node_points or len(key) - 1 >= MAX_DEPTH:
+            self._write_node(key, points, [])
+            return
+        origin, size = node_bounds(key, self.size)
+        octants = ((points >= origin + size / 2).astype(np.int64) * (4, 2, 1)).sum(axis=1)
+        children = []
+        for octant in range(8):
+            child_points = points[octants == octant]
+            if len(child_points):
+                self._build_subtree(key + str(octant), child_points)
+                children.append(key + str(octant))
+        # 子节点的文件最多node_points个点（达到MAX_DEPTH的叶子节点除外），拼接后再抽样
+        points = np.concatenate([self._read(child) for child in children])
+        self._write_node(key, self._sample(key, points), children)
+
+    def _sample(self, key: str, points: np.ndarray):
+        origin, size = node_bounds(key, self.size)
+        return _sample(points, origin, size, self.node_points, self.rng)
+
+    def _read(self, key: str):
+        return np.load(osp.join(self.nodes_dir, f'{key}.npy'))
+
+    def _write_node(self, key: str, points: np.ndarray, children: list):
+        np.save(osp.join(self.nodes_dir, f'{key}.npy'), np.ascontiguousarray(points, dtype=np.float32))
+        self.nodes[key] = {'num_points': len(points), 'children': children}
+
+
+class Octree:
+    '''
+    读取分块八叉树的元数据，按相机选择要显示的节点
+    '''
+
+    def __init__(self, octree_dir: str, index: dict):
+        self.octree_dir = octree_dir
+        self.offset = np.asarray(index['offset'], dtype=np.float64)
+        self.size = index['size']
+        self.sample_grid = index['sample_grid']
+        self.num_points = index['num_points']
+        self.nodes = index['nodes']
+
+    @classmethod
+    def load(cls, index_filepath: str):
+        '''
+        :param index_filepath: octree.json的路径，或者其所在的目录
+        '''
+        if osp.isdir(index_filepath):
+            index_filepath = osp.join(index_filepath, OCTREE_INDEX_FILENAME)
+        with open(index_filepath, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') != OCTREE_VERSION:
+            raise ValueError(f'{index_filepath} 版本不支持：{index.get("version")}')
+        return cls(osp.dirname(index_filepath), index)
+
+    def bounds(self, key: str = 'r'):
+        '''
+        :return: 节点范围的最小值, 最大值（世界坐标）
+        '''
+        origin, size = node_bounds(key, self.size)
+        return self.offset + origin, self.offset + origin + size
+
+    def read_node(self, key: str):
+        '''
+        :return: (N, 3) float64 世界坐标
+        '''
+        return np.load(osp.join(self.octree_dir, 'nodes', f'{key}.npy')).astype(np.float64) + self.offset
+
+    def _visible(self, key: str, view_projection: np.ndarray):
+        '''
+        节点包围盒与视锥是否相交（保守判断：8个角点都在同一个裁剪平面外侧时不可见）
+        '''
+        lo, hi = self.bounds(key)
+        corners = np.array([[x, y, z, 1.] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+        clip = corners @ view_projection.T
+        w = clip[:, 3]
+        for axis in range(3):
+            if (clip[:, axis] < -w).all() or (clip[:, axis] > w).all():
+                return False
+        return True
+
+    def _pixels(self, key: str, camera_position: np.ndarray, focal_pixels: float):
+        '''
+        节点的抽样间距投影到屏幕上的像素数
+        '''
+        lo, hi = self.bounds(key)
+        radius = np.linalg.norm(hi - lo) / 2
+        distance = max(np.linalg.norm((lo + hi) / 2 - camera_position) - radius, 1e-6)
+        return (hi[0] - lo[0]) / self.sample_grid * focal_pixels / distance
+
+    def select(self, view_matrix, projection_matrix, viewport_height: int, point_budget: int = POINT_BUDGET,
+               point_pixels: float = POINT_PIXELS):
+        '''
+        选择要显示的节点：从根节点开始，优先细分投影最大的节点，直到点数达到point_budget
+        视锥外的节点不显示；节点被细分后由其可见的子节点代替
+        :param view_matrix: 4x4，Camera.get_view_matrix()
+        :param projection_matrix: 4x4，Camera.get_projection_matrix()
+        :param viewport_height: 视口高度（像素）
+        :param point_budget: 最多显示的点数
+        :param point_pixels: 抽样间距投影超过该像素数时细分
+        :return: 节点key列表
+        '''
+        view_matrix = np.asarray(view_matrix, dtype=np.float64)
+        projection_matrix = np.asarray(projection_matrix, dtype=np.float64)
+        view_projection = projection_matrix @ view_matrix
+        camera_position = np.linalg.inv(view_matrix)[:3, 3]
+        focal_pixels = projection_matrix[1, 1] * viewport_height / 2
+        if not self._visible('r', view_projection):
+            return []
+        selected = {'r'}
+        used = self.nodes['r']['num_points']
+        heap = [(-self._pixels('r', camera_position, focal_pixels), 'r')]
+        while heap:
+            negative_pixels, key = heapq.heappop(heap)
+            if -negative_pixels <= point_pixels or not self.nodes[key]['children']:
+                continue
+            children = [child for child in self.nodes[key]['children'] if self._visible(child, view_projection)]
+            extra = sum(self.nodes[child]['num_points'] for child in children) - self.nodes[key]['num_points']
+            if used + extra > point_budget:
+                continue
+            selected.remove(key)
+            selected.update(children)
+            used += extra
+            for child in children:
+                heapq.heappush(heap, (-self._pixels(child, camera_position, focal_pixels), child))
+        return sorted(selected)
+
+
+def overlaps(key1: str, key2: str):
+    '''
+    两个节点的范围是否重叠，即一个是另一个的祖先或相同
+    '''
+    return key1.startswith(key2) or key2.startswith(key1)
+
+
+class OctreeStreamer:
+    '''
+    在后台线程中按需读取节点，LRU缓存
+    request()给出当前需要显示的节点，未缓存的按顺序读取，读完一个调用一次on_loaded(key)（在读取线程中）
+    缓存超过cache_points时淘汰最久未使用且当前不需要的节点
+    '''
+
+    def __init__(self, octree: Octree, cache_points: int = CACHE_POINTS, on_loaded=None):
+        self.octree = octree
+        self.cache_points = cache_points
+        self.on_loaded = on_loaded
+        # key -> (N, 3)
+        self._cache = OrderedDict()
+        self._cached_points = 0
+        self._wanted = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, keys: list):
+        '''
+        :param keys: 当前需要显示的节点，按优先级排列
+        '''
+        with self._condition:
+            self._wanted = list(keys)
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+            self._condition.notify()
+
+    def get(self, key: str):
+        '''
+        :return: 已缓存的节点坐标，未缓存时为None
+        '''
+        with self._condition:
+            return self._cache.get(key)
+
+    def is_cached(self, key: str):
+        with self._condition:
+            return key in self._cache
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _next_missing(self):
+        for key in self._wanted:
+            if key not in self._cache:
+                return key
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and self._next_missing() is None:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                key = self._next_missing()
+            try:
+                points = self.octree.read_node(key)
+            except Exception as e:
+                logger.error(f'八叉树节点读取失败：{key}，{e}')
+                points = np.empty((0, 3))
+            with self._condition:
+                self._cache[key] = points
+                self._cached_points += len(points)
+                self._evict()
+            if self.on_loaded is not None:
+                self.on_loaded(key)
+
+    def _evict(self):
+        wanted = set(self._wanted)
+        for key in list(self._cache):
+            if self._cached_points <= self.cache_points:
+                break
+            if key not in wanted:
+                self._cached_points -= len(self._cache.pop(key))
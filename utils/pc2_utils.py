@@ -0,0 +1,111 @@
+import numpy as np
+
+
+# sensor_msgs/PointField 中datatype到numpy类型的映射
+# INT8=1, UINT8=2, INT16=3, UINT16=4, INT32=5, UINT32=6, FLOAT32=7, FLOAT64=8
+POINT_FIELD_DTYPES = {
+    1: 'i1',
+    2: 'u1',
+    3: 'i2',
+    4: 'u2',
+    5: 'i4',
+    6: 'u4',
+    7: 'f4',
+    8: 'f8',
+}
+
+
+def fields_to_dtype(fields, point_step, is_bigendian=False):
+    '''
+    根据PointCloud2的fields构造numpy结构化dtype
+    dtype的itemsize等于point_step，字段之间的padding会被自动跳过
+    :param fields: msg.fields
+    :param point_step: msg.point_step
+    :param is_bigendian: msg.is_bigendian
+    :return: np.dtype
+    '''
+    endian = '>' if is_bigendian else '<'
+    names, formats, offsets = [], [], []
+    for field in fields:
+        if field.datatype not in POINT_FIELD_DTYPES:
+            raise ValueError(f'不支持的PointField类型：{field.name}, datatype={field.datatype}')
+        base = endian + POINT_FIELD_DTYPES[field.datatype]
+        names.append(field.name)
+        formats.append(base if field.count == 1 else (base, (field.count,)))
+        offsets.append(field.offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': point_step})
+
+
+def pointcloud2_to_array(msg):
+    '''
+    将sensor_msgs/PointCloud2消息解析为numpy结构化数组（一维，长度为width * height）
+    直接通过np.frombuffer读取msg.data，不做逐点的python处理
+    :param msg: PointCloud2消息
+    :return: np.ndarray，字段与msg.fields一致
+    '''
+    dtype = fields_to_dtype(msg.fields, msg.point_step, msg.is_bigendian)
+    num_points = msg.width * msg.height
+    if msg.height <= 1 or msg.row_step == msg.width * msg.point_step:
+        return np.frombuffer(msg.data, dtype=dtype, count=num_points)
+    # 行尾存在padding时，先按行切掉多余的字节
+    raw = np.frombuffer(msg.data, dtype=np.uint8, count=msg.height * msg.row_step)
+    raw = raw.reshape(msg.height, msg.row_step)[:, :msg.width * msg.point_step]
+    return np.ascontiguousarray(raw).view(dtype).reshape(-1)
+
+
+def pointcloud2_to_xyz(msg, remove_nans=False):
+    '''
+    解析PointCloud2消息中的xyz坐标
+    :param msg: PointCloud2消息
+    :param remove_nans: 是否去掉含nan的点
+    :return: (N, 3) float64数组
+    '''
+    cloud = pointcloud2_to_array(msg)
+    return structured_to_xyz(cloud, remove_nans)
+
+
+def structured_to_xyz(cloud, remove_nans=False):
+    '''
+    从结构化数组中取出xyz三列，组成(N, 3)的float64数组
+    :param cloud: 含x、y、z字段的结构化数组
+    :param remove_nans: 是否去掉含nan的点
+    :return:
+    '''
+    xyz = np.empty((len(cloud), 3), dtype=np.float64)
+    xyz[:, 0] = cloud['x']
+    xyz[:, 1] = cloud['y']
+    xyz[:, 2] = cloud['z']
+    if remove_nans:
+        xyz = xyz[np.isfinite(xyz).all(axis=1)]
+    return xyz
+
+
+# 抽取帧时保留的字段，即tmp中每个pcd文件的字段：x y z intensity ring time
+FRAME_DTYPE = np.dtype([
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('intensity', '<f4'),
+    ('ring', '<u2'),
+    ('time', '<f4'),
+])
+
+
+def to_frame_array(cloud):
+    '''
+    将PointCloud2解析出的结构化数组转换为FRAME_DTYPE
+    不同驱动的字段名不同：ouster的时间字段为t（纳秒，uint32），velodyne为time（秒，float32）
+    缺失的字段置0
+    :param cloud: pointcloud2_to_array的结果
+    :return:
+    '''
+    frame = np.zeros(len(cloud), dtype=FRAME_DTYPE)
+    names = cloud.dtype.names
+    for name in ('x', 'y', 'z', 'intensity', 'ring'):
+        if name in names:
+            frame[name] = cloud[name]
+    if 'time' in names:
+        frame['time'] = cloud['time']
+    elif 't' in names:
+        frame['time'] = cloud['t'] * 1e-9
+    return frame
@@ -0,0 +1,243 @@
+import numpy as np
+import open3d as o3d
+
+from utils.pc2_utils import structured_to_xyz
+
+
+# 支持的pcd编码方式
+PCD_ENCODINGS = ('ascii', 'binary', 'binary_compressed')
+
+PCD_HEADER_TEMPLATE = """# .PCD v0.7 - Point Cloud Data file format
+VERSION 0.7
+FIELDS {fields}
+SIZE {sizes}
+TYPE {types}
+COUNT {counts}
+WIDTH {num}
+HEIGHT 1
+VIEWPOINT 0 0 0 1 0 0 0
+POINTS {num}
+DATA {encoding}
+"""
+
+# numpy类型 -> pcd TYPE
+_PCD_TYPES = {'f': 'F', 'u': 'U', 'i': 'I'}
+
+
+def packed_dtype(dtype: np.dtype):
+    '''
+    去掉结构化dtype中的padding，并统一为小端
+    :param dtype:
+    :return:
+    '''
+    fields = []
+    for name in dtype.names:
+        field_dtype = dtype.fields[name][0]
+        base, shape = field_dtype.base, field_dtype.shape
+        if base.kind not in _PCD_TYPES:
+            raise ValueError(f'pcd不支持的字段类型：{name}, {base}')
+        fields.append((name, base.newbyteorder('<'), shape) if shape else (name, base.newbyteorder('<')))
+    return np.dtype(fields)
+
+
+def build_pcd_header(dtype: np.dtype, num_points: int, encoding: str):
+    '''
+    根据结构化dtype生成pcd文件头
+    :param dtype: 结构化dtype，字段名即pcd的FIELDS
+    :param num_points: 点数
+    :param encoding: ascii、binary、binary_compressed
+    :return: str
+    '''
+    names = dtype.names
+    bases = [dtype.fields[name][0].base for name in names]
+    counts = [int(np.prod(dtype.fields[name][0].shape)) for name in names]
+    return PCD_HEADER_TEMPLATE.format(
+        fields=' '.join(names),
+        sizes=' '.join(str(base.itemsize) for base in bases),
+        types=' '.join(_PCD_TYPES[base.kind] for base in bases),
+        counts=' '.join(str(count) for count in counts),
+        num=num_points,
+        encoding=encoding,
+    )
+
+
+def write_pcd(pcd_path: str, cloud: np.ndarray, encoding: str = 'binary'):
+    '''
+    将结构化数组写为pcd文件
+    :param pcd_path: 文件路径
+    :param cloud: 结构化数组，至少包含x、y、z字段
+    :param encoding: ascii、binary、binary_compressed
+    :return:
+    '''
+    if encoding == 'ascii':
+        write_pcd_ascii(pcd_path, cloud)
+    elif encoding == 'binary':
+        write_pcd_binary(pcd_path, cloud)
+    elif encoding == 'binary_compressed':
+        write_pcd_binary_compressed(pcd_path, cloud)
+    else:
+        raise ValueError(f'不支持的pcd编码：{encoding}，可选：{PCD_ENCODINGS}')
+
+
+def write_pcd_ascii(pcd_path: str, cloud: np.ndarray):
+    '''
+    以文本形式写pcd
+    :param pcd_path:
+    :param cloud:
+    :return:
+    '''
+    dtype = packed_dtype(cloud.dtype)
+    fmt = []
+    for name in dtype.names:
+        field_dtype = dtype.fields[name][0]
+        fmt += ['%.8g' if field_dtype.base.kind == 'f' else '%d'] * max(1, int(np.prod(field_dtype.shape)))
+    columns = np.column_stack([np.asarray(cloud[name]).reshape(len(cloud), -1) for name in dtype.names]) \
+        if len(cloud) else np.empty((0, len(fmt)))
+    with open(pcd_path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(build_pcd_header(dtype, len(cloud), 'ascii'))
+        np.savetxt(f, columns, fmt=fmt)
+
+
+def write_pcd_binary(pcd_path: str, cloud: np.ndarray):
+    '''
+    以二进制形式写pcd：文件头之后直接写入预分配的紧凑numpy缓冲区
+    :param pcd_path:
+    :param cloud:
+    :return:
+    '''
+    dtype = packed_dtype(cloud.dtype)
+    buffer = np.empty(len(cloud), dtype=dtype)
+    for name in dtype.names:
+        buffer[name] = cloud[name]
+    with open(pcd_path, 'wb') as f:
+        f.write(build_pcd_header(dtype, len(cloud), 'binary').encode())
+        buffer.tofile(f)
+
+
+def write_pcd_binary_compressed(pcd_path: str, cloud: np.ndarray):
+    '''
+    以binary_compressed（LZF）形式写pcd，压缩交给open3d的tensor接口
+    :param pcd_path:
+    :param cloud:
+    :return:
+    '''
+    pcd = o3d.t.geometry.PointCloud()
+    pcd.point['positions'] = o3d.core.Tensor(structured_to_xyz(cloud).astype(np.float32))
+    for name in cloud.dtype.names:
+        if name in ('x', 'y', 'z'):
+            continue
+        pcd.point[name] = o3d.core.Tensor(np.ascontiguousarray(cloud[name]).reshape(len(cloud), -1))
+    o3d.t.io.write_point_cloud(pcd_path, pcd, write_ascii=False, compressed=True)
+
+
+def read_pcd(pcd_path: str):
+    '''
+    读取pcd文件，返回包含文件中全部字段的结构化数组（与write_pcd对应）
+    ascii和binary直接用numpy解析，binary_compressed交给open3d的tensor接口
+    :param pcd_path:
+    :return: 结构化数组
+    '''
+    with open(pcd_path, 'rb') as f:
+        header = _read_header(f, pcd_path)
+        dtype = _header_dtype(header)
+        num_points = int(header['POINTS'][0])
+        encoding = header['DATA'][0].lower()
+        if encoding == 'binary':
+            return np.fromfile(f, dtype=dtype, count=num_points)
+        if encoding == 'ascii':
+            lines = f.read().decode('ascii', errors='ignore').splitlines()
+            data = np.loadtxt(lines, dtype=np.float64, ndmin=2, max_rows=num_points)
+            cloud = np.empty(len(data), dtype=dtype)
+            col = 0
+            for name in dtype.names:
+                field_dtype = dtype.fields[name][0]
+                count = max(1, int(np.prod(field_dtype.shape)))
+                cloud[name] = data[:, col:col + count].reshape((len(data),) + field_dtype.shape)
+                col += count
+            return cloud
+    if encoding == 'binary_compressed':
+        return _read_pcd_with_open3d(pcd_path, dtype)
+    raise ValueError(f'{pcd_path} 不支持的pcd编码：{encoding}')
+
+
+def read_pcd_header(pcd_path: str):
+    '''
+    只读取pcd文件头
+    :param pcd_path:
+    :return: 结构化dtype, 点数
+    '''
+    _, dtype, num_points, _ = read_pcd_layout(pcd_path)
+    return dtype, num_points
+
+
+def read_pcd_layout(pcd_path: str):
+    '''
+    读取pcd文件头，得到分块读取数据部分所需的信息
+    :param pcd_path:
+    :return: 编码（小写）, 结构化dtype, 点数, 数据部分在文件中的偏移
+    '''
+    with open(pcd_path, 'rb') as f:
+        header = _read_header(f, pcd_path)
+        offset = f.tell()
+    return header['DATA'][0].lower(), _header_dtype(header), int(header['POINTS'][0]), offset
+
+
+def _read_header(f, pcd_path: str):
+    '''
+    读取文件头，读完后f位于数据部分的开头
+    :param f: 以'rb'打开的文件
+    :param pcd_path:
+    :return: {FIELDS: [...], SIZE: [...], ...}
+    '''
+    header = {}
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError(f'{pcd_path} 不是合法的pcd文件')
+        line = line.decode('ascii', errors='ignore').strip()
+        if not line or line.startswith('#'):
+            continue
+        key, *values = line.split()
+        header[key.upper()] = values
+        if key.upper() == 'DATA':
+            return header
+
+
+def _header_dtype(header: dict):
+    '''
+    根据pcd文件头生成结构化dtype
+    :param header: {FIELDS: [...], SIZE: [...], TYPE: [...], COUNT: [...]}
+    :return:
+    '''
+    names = header['FIELDS']
+    sizes = header['SIZE']
+    types = header['TYPE']
+    counts = header.get('COUNT', ['1'] * len(names))
+    fields = []
+    for i, (name, size, type_, count) in enumerate(zip(names, sizes, types, counts)):
+        kind = {'F': 'f', 'U': 'u', 'I': 'i'}[type_.upper()]
+        if name == '_':
+            # pcl中的padding字段
+            name = f'_{i}'
+        base = np.dtype(f'<{kind}{size}')
+        fields.append((name, base, (int(count),)) if int(count) > 1 else (name, base))
+    return np.dtype(fields)
+
+
+def _read_pcd_with_open3d(pcd_path: str, dtype: np.dtype):
+    '''
+    用open3d的tensor接口读取pcd，并转换为结构化数组
+    :param pcd_path:
+    :param dtype: 根据文件头得到的dtype
+    :return:
+    '''
+    pcd = o3d.t.io.read_point_cloud(pcd_path)
+    positions = pcd.point['positions'].numpy()
+    cloud = np.zeros(len(positions), dtype=dtype)
+    for i, name in enumerate(('x', 'y', 'z')):
+        cloud[name] = positions[:, i]
+    for name in dtype.names:
+        if name in ('x', 'y', 'z') or name not in pcd.point:
+            continue
+        cloud[name] = pcd.point[name].numpy().reshape(cloud[name].shape)
+    return cloud
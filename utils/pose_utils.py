@@ -0,0 +1,229 @@
+import json
+import os.path as osp
+from glob import glob
+
+import numpy as np
+import yaml
+from scipy.spatial.transform import Rotation as R, Slerp
+
+from conf.pc_conf import MAX_POSE_GAP
+from utils.math_utils import get_translation_and_quaternion_from
+
+
+# 每个bag的里程计轨迹文件（位于tmp目录中），一行一条里程计
+TRAJECTORY_FILENAME = 'trajectory.npy'
+TRAJECTORY_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+    ('z', '<f8'),
+    ('qx', '<f8'),
+    ('qy', '<f8'),
+    ('qz', '<f8'),
+    ('qw', '<f8'),
+])
+
+
+def save_trajectory(filepath: str, stamps, translations, quaternions):
+    '''
+    一次性写入整条轨迹
+    :param filepath: .npy文件路径
+    :param stamps: (N,) 时间戳
+    :param translations: (N, 3) 平移向量
+    :param quaternions: (N, 4) 四元数 (x, y, z, w)
+    :return:
+    '''
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+    quaternions = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    trajectory = np.empty(len(translations), dtype=TRAJECTORY_DTYPE)
+    trajectory['time'] = np.asarray(stamps, dtype=np.float64).reshape(-1)
+    for i, name in enumerate(('x', 'y', 'z')):
+        trajectory[name] = translations[:, i]
+    for i, name in enumerate(('qx', 'qy', 'qz', 'qw')):
+        trajectory[name] = quaternions[:, i]
+    np.save(filepath, trajectory)
+
+
+def load_trajectory(filepath: str):
+    '''
+    读取save_trajectory写入的轨迹
+    :param filepath:
+    :return: 时间戳(N,)，平移向量(N, 3)，四元数(N, 4)
+    '''
+    trajectory = np.load(filepath)
+    translations = np.column_stack([trajectory[name] for name in ('x', 'y', 'z')])
+    quaternions = np.column_stack([trajectory[name] for name in ('qx', 'qy', 'qz', 'qw')])
+    return trajectory['time'], translations.reshape(-1, 3), quaternions.reshape(-1, 4)
+
+
+def get_stamp_from_filepath(filepath: str):
+    '''
+    tmp目录中的文件以时间戳命名，例如 1699085419.203.pcd；多个雷达时带有传感器名，例如 1699085419.203_os1_points.pcd
+    返回其中的时间戳
+    :param filepath:
+    :return: float
+    '''
+    return float(osp.splitext(osp.basename(filepath))[0].split('_', 1)[0])
+
+
+def get_sensor_from_filepath(filepath: str):
+    '''
+    :param filepath: tmp目录中的pcd文件
+    :return: 文件名中的传感器名，没有时为None
+    '''
+    parts = osp.splitext(osp.basename(filepath))[0].split('_', 1)
+    return parts[1] if len(parts) > 1 else None
+
+
+def get_sensor_name(topic: str):
+    '''
+    由topic得到文件名中使用的传感器名，例如 /os1/points -> os1_points
+    '''
+    return topic.strip('/').replace('/', '_')
+
+
+# tmp目录中各传感器的外参，{传感器名: 4x4}
+EXTRINSICS_FILENAME = 'extrinsics.json'
+
+
+def load_extrinsics(filepath: str):
+    '''
+    读取外参配置（yaml），每个雷达topic一项，为传感器坐标系到里程计坐标系的变换：
+        /os1/points:
+          translation: [x, y, z]
+          rotation: [qx, qy, qz, qw]
+    或者直接给出4x4矩阵：
+        /os2/points:
+          matrix: [[...], [...], [...], [...]]
+    :param filepath:
+    :return: {topic: 4x4}
+    '''
+    with open(filepath, 'r', encoding='utf-8') as f:
+        conf = yaml.safe_load(f) or {}
+    extrinsics = {}
+    for topic, extrinsic in conf.items():
+        if 'matrix' in extrinsic:
+            transform = np.asarray(extrinsic['matrix'], dtype=np.float64).reshape(4, 4)
+        else:
+            transform = np.eye(4)
+            transform[:3, :3] = R.from_quat(extrinsic.get('rotation', (0, 0, 0, 1))).as_matrix()
+            transform[:3, 3] = extrinsic.get('translation', (0, 0, 0))
+        extrinsics[topic] = transform
+    return extrinsics
+
+
+def save_sensor_extrinsics(dirpath: str, extrinsics: dict):
+    '''
+    :param dirpath: tmp目录
+    :param extrinsics: {传感器名: 4x4}
+    '''
+    with open(osp.join(dirpath, EXTRINSICS_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump({name: np.asarray(transform).tolist() for name, transform in extrinsics.items()}, f, indent=2)
+
+
+def load_sensor_extrinsics(dirpath: str):
+    '''
+    :param dirpath: tmp目录
+    :return: {传感器名: 4x4}，没有外参文件时为空
+    '''
+    filepath = osp.join(dirpath, EXTRINSICS_FILENAME)
+    if not osp.exists(filepath):
+        return {}
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return {name: np.asarray(transform, dtype=np.float64) for name, transform in json.load(f).items()}
+
+
+class PoseIndex:
+    '''
+    位姿索引：按时间戳排序的里程计平移向量和四元数
+    查询时通过二分查找找到前后两个里程计，平移线性插值，旋转球面插值（Slerp）
+    '''
+
+    def __init__(self, stamps, translations, quaternions, max_gap: float = MAX_POSE_GAP):
+        '''
+        :param stamps: (N,) 时间戳
+        :param translations: (N, 3) 平移向量
+        :param quaternions: (N, 4) 四元数 (x, y, z, w)
+        :param max_gap: 前后两个里程计的最大时间间隔（秒），超过则认为该时刻没有可靠位姿
+        '''
+        stamps = np.asarray(stamps, dtype=np.float64).reshape(-1)
+        translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)
+        quaternions = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+        # 排序并去掉重复的时间戳（Slerp要求时间严格递增）
+        stamps, index = np.unique(stamps, return_index=True)
+        self.stamps = stamps
+        self.translations = translations[index]
+        self.quaternions = quaternions[index]
+        self.max_gap = max_gap
+        self._slerp = Slerp(self.stamps, R.from_quat(self.quaternions)) if len(self.stamps) > 1 else None
+
+    def __len__(self):
+        return len(self.stamps)
+
+    @classmethod
+    def from_txt_files(cls, txt_files: list, max_gap: float = MAX_POSE_GAP):
+        '''
+        从tmp目录中的里程计txt文件构建位姿索引
+        :param txt_files: txt文件列表，文件名为时间戳
+        :param max_gap:
+        :return:
+        '''
+        stamps = [get_stamp_from_filepath(txt_file) for txt_file in txt_files]
+        poses = [get_translation_and_quaternion_from(txt_file) for txt_file in txt_files]
+        translations = [translation for translation, _ in poses]
+        quaternions = [quaternion for _, quaternion in poses]
+        return cls(stamps, translations, quaternions, max_gap)
+
+    @classmethod
+    def from_trajectory_file(cls, filepath: str, max_gap: float = MAX_POSE_GAP):
+        '''
+        从save_trajectory写入的轨迹文件构建位姿索引
+        :param filepath:
+        :param max_gap:
+        :return:
+        '''
+        return cls(*load_trajectory(filepath), max_gap)
+
+    @classmethod
+    def from_dir(cls, pcd_dir: str, max_gap: float = MAX_POSE_GAP):
+        '''
+        从tmp目录构建位姿索引：优先读取轨迹文件，没有时读取逐条的里程计txt文件
+        :param pcd_dir:
+        :param max_gap:
+        :return:
+        '''
+        trajectory_filepath = osp.join(pcd_dir, TRAJECTORY_FILENAME)
+        if osp.exists(trajectory_filepath):
+            return cls.from_trajectory_file(trajectory_filepath, max_gap)
+        return cls.from_txt_files(glob(osp.join(pcd_dir, '*.txt')), max_gap)
+
+    def lookup(self, stamps):
+        '''
+        查询若干时刻的位姿
+        :param stamps: (M,) 时间戳
+        :return: 平移向量(M, 3)，旋转矩阵(M, 3, 3)，是否有效(M,)
+        '''
+        stamps = np.asarray(stamps, dtype=np.float64).reshape(-1)
+        translations = np.zeros((len(stamps), 3))
+        rotations = np.tile(np.eye(3), (len(stamps), 1, 1))
+        if len(self.stamps) == 0:
+            return translations, rotations, np.zeros(len(stamps), dtype=bool)
+        if len(self.stamps) == 1:
+            valid = np.abs(stamps - self.stamps[0]) <= 1e-6
+            translations[valid] = self.translations[0]
+            rotations[valid] = R.from_quat(self.quaternions[0]).as_matrix()
+            return translations, rotations, valid
+
+        # stamps[lo] <= t <= stamps[hi]
+        hi = np.clip(np.searchsorted(self.stamps, stamps, side='right'), 1, len(self.stamps) - 1)
+        lo = hi - 1
+        gap = self.stamps[hi] - self.stamps[lo]
+        valid = (stamps >= self.stamps[0]) & (stamps <= self.stamps[-1]) & (gap <= self.max_gap)
+        if not valid.any():
+            return translations, rotations, valid
+
+        t = stamps[valid]
+        alpha = ((t - self.stamps[lo[valid]]) / gap[valid])[:, None]
+        translations[valid] = (1 - alpha) * self.translations[lo[valid]] + alpha * self.translations[hi[valid]]
+        rotations[valid] = self._slerp(t).as_matrix()
+        return translations, rotations, valid
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import numpy as np
+import open3d as o3d
+from loguru import logger
+from scipy.spatial import cKDTree
+
+
+def geometry_points(geometry):
+    '''
+    :param geometry: 点云或三角网格
+    :return: (N, 3) 点云的点或网格的顶点
+    '''
+    if isinstance(geometry, o3d.geometry.TriangleMesh):
+        return np.asarray(geometry.vertices)
+    return np.asarray(geometry.points)
+
+
+class _IndexEntry:
+    '''
+    一个几何体的KD树，构建完成前ready未被设置
+    '''
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.tree = None
+        self.error = None
+        self.ready = threading.Event()
+
+
+class SpatialIndexCache:
+    '''
+    按几何体id缓存KD树：增加几何体时在后台线程构建，选点时直接查询，不再每次点击都重新构建
+    KD树为scipy的cKDTree，选点（单点查询）和G2G距离计算（批量、多线程查询）共用，每个几何体只构建一棵
+    几何体被移除或改变时需要调用invalidate()
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def build_async(self, key, geometry):
+        '''
+        在后台线程中构建KD树，已有的同id缓存失效
+        :param key: 几何体id
+        :param geometry: 点云等几何体
+        :return:
+        '''
+        entry = _IndexEntry(geometry)
+        with self._lock:
+            self._entries[key] = entry
+        threading.Thread(target=self._build, args=(key, entry), daemon=True).start()
+
+    def _build(self, key, entry):
+        start = time.perf_counter()
+        try:
+            entry.tree = cKDTree(geometry_points(entry.geometry))
+            logger.info(f'几何体 {key} 的KD树构建完成，耗时：{time.perf_counter() - start:.3f}s')
+        except Exception as e:
+            logger.error(f'几何体 {key} 的KD树构建失败：{e}')
+            entry.error = e
+        finally:
+            entry.ready.set()
+
+    def get(self, key, geometry):
+        '''
+        获取几何体的KD树：后台仍在构建时等待其完成；没有缓存或缓存的不是该几何体时同步构建
+        :param key: 几何体id
+        :param geometry:
+        :return: cKDTree
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.geometry is not geometry:
+            entry = _IndexEntry(geometry)
+            with self._lock:
+                self._entries[key] = entry
+            self._build(key, entry)
+        entry.ready.wait()
+        if entry.error is not None:
+            raise entry.error
+        return entry.tree
+
+    def search_nearest(self, key, geometry, point):
+        '''
+        :param key: 几何体id
+        :param geometry:
+        :param point: 世界坐标
+        :return: 最近点在几何体中的索引
+        '''
+        return int(self.get(key, geometry).query(point)[1])
+
+    def invalidate(self, key):
+        '''
+        几何体被移除或改变时调用；正在构建的线程结束后结果被丢弃
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()